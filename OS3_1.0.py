@@ -1,17 +1,30 @@
 # OS3 Version 1.0
 
 # Import relevant files
+# gphoto2 and the tracking modules are slow to import, so they are imported when first needed
 import RPi.GPIO as gpio
-import gphoto2 as gp
 import threading
 import time
 import csv
-import numpy
-import math
-import shutil
+import os
 from datetime import datetime
 from motor import motor
+from motionPlanner import moveAxes, slewDuration
+from pointing import solvePointing
+from schedulePlanner import planNight, SETTLE_TIME
+from durationModel import DurationModel
+from imagingSequence import parseSequence, planShots, checkShots, sequenceSpan, exposureSeconds
+from eventLog import EventLog, LOG_FILE_PATTERN
+from pulseBackend import createBackend
+from timerScheduler import TimerScheduler, wallTime
 from scheduleManager import Schedule
+from mountState import saveMountState, loadMountState, restoreAxis, MOVING, STOPPED, PARKED
+from startupTimer import StartupTimer
+from metrics import Metrics, loadAverage, processCpuTime
+
+# Times each stage of start up from when the process started
+startupTimer = StartupTimer()
+startupTimer.mark("imports")
 
 # Define & setup motor control pins and limit switch input
 # CONFIG pins put motor driver into INDEX mode
@@ -26,6 +39,35 @@ TILT_BELT_RATIO = 17.5
 
 TILT_0_ANGLE = 468.79
 
+# Shortest travel (steps between the limit switches) a full calibration accepts. The mount measures
+# about 60210 pan and 47491 tilt steps, so a much shorter travel means a switch was found in the wrong place
+PAN_MIN_STEPS = 45000
+TILT_MIN_STEPS = 35000
+
+# Speed profile of every move: "ramp" (ramp.csv, as before. The MAX_SPEED values are then the speed
+# moves run at), "trapezoid" (constant acceleration) or "scurve" (jerk limited).
+# The limits are for the motor shafts. The defaults are the old 60 RPM, and ramp.csv's average
+# acceleration up to it. The steppers are open loop, so nothing notices missed steps: raise the
+# limits a little at a time on the mount, running a night with VERIFY_PARKED_START = True after
+# each change to see the position error, and keep them a third below where steps start to be missed
+PROFILE_SHAPE = "ramp"
+PAN_MAX_SPEED = 60      # RPM
+PAN_MAX_ACCEL = 30      # RPM per second
+PAN_MAX_JERK = 150      # RPM per second squared
+TILT_MAX_SPEED = 60     # RPM
+TILT_MAX_ACCEL = 30     # RPM per second
+TILT_MAX_JERK = 150     # RPM per second squared
+MOVE_SPEED = None       # Speed (RPM) of the axis with the furthest to go in each move. None for its MAX_SPEED
+
+# Each move starts just in time for the first image, from the time of its motion profile corrected
+# by the moves measured so far (saved in SLEW_MODEL_FILE), plus SLEW_MARGIN and the model's own
+# error. The mount stays on the last target, and the USB copy gets the time, until it has to go.
+# A number starts every move that many seconds before culmination instead. Tracking moves go to
+# the start of the track, so in tracking mode None means 120
+MOVE_LEAD = None
+SLEW_MARGIN = 5.0       # Seconds spare at the end of every predicted slew
+SLEW_MODEL_FILE = "slew_model.csv"
+
 # For PAN motor controller
 PAN_DIRECTION = 33  # Connecs to DIR pin
 PAN_STEP = 31       # Connect to STEP pin
@@ -54,14 +96,104 @@ LED_FREQ = 15
 
 skipCalibration = False  # Skip the auto-calibration on startup (for testing without motors connected)
 copySchedule = True     # Copy the schedule from USB drive. If False, the schedule will be taken from current directory
-copyLog = True          # Copy the log file to the USB drive. The file will also be in the current directory
-
-FILE_SOURCE = "/mnt/usb/schedule.csv"
+copyLog = True          # Copy the log files to the USB drive. The files will also be in LOG_DIRECTORY
+copyImages = True       # Copy the downloaded images to the USB drive. They will also be in IMAGE_DIRECTORY
+optimizeSchedule = True # Choose the targets to image so that slews don't overlap. If False, every target is attempted in file order
+
+USB_DIRECTORY = "/mnt/usb"  # Where the USB drive is mounted
+FILE_SOURCE = USB_DIRECTORY + "/schedule.csv"
+
+# Logs and images are copied to the USB drive during the night, in the gaps between passes, and
+# whatever is left at the end. Only new and changed files are copied. A copy cut short by a pass
+# coming up, or by the drive being pulled out, carries on where it stopped
+SYNC_GUARD = 60         # Copying stops this many seconds before the next move or image
+SYNC_RATE = 2000000     # Most bytes per second written to the drive, so camera downloads on the same USB bus aren't slowed
+SYNC_INTERVAL = 30      # Seconds between checks for new files
+USB_MOUNT_CHECK = True  # Only copy while a drive is mounted at USB_DIRECTORY, not to the empty folder on the SD card
+
+# Tracking mode follows each target along its pass instead of pointing at the culmination position.
+# Needs a TLE for the target (matched by catalog number) and the sgp4 module: python3 -m pip install sgp4
+trackingMode = False
+TLE_SOURCE = USB_DIRECTORY + "/tle.txt"
+TRACK_MARGIN = 5        # Seconds tracked before the first image and after the last image
+
+# Station location, used to work out where tracked satellites appear in the sky
+STATION_LATITUDE = 51.2426      # Degrees north
+STATION_LONGITUDE = -0.5889     # Degrees east
+STATION_ALTITUDE = 70           # Metres above the WGS84 ellipsoid
+
+# Pulse generation for the STEP pins: "sleep" (bit-banged from Python), "waveform" (hardware
+# timed, needs the pigpio daemon running) or "simulated" (no motor output, for testing)
+PULSE_BACKEND = "sleep"
+
+# Camera settings. A schedule can set them for each target with optional "Shutter Speed" and
+# "Aperture" columns. Only settings that differ from the last image are sent to the camera, just
+# before each image, so they can change between targets and between the images of a target
+SHUTTER_SPEED = "8"
+APERTURE = "4.5"
+
+# Imaging sequences, by name. Each step of a sequence takes one or more images:
+# - "offset": seconds from culmination of the step's first image
+# - "count": images to take (default 1). Leave it out and give "until" to fit in as many as the
+#   camera's measured capture time allows
+# - "until": seconds from culmination by which the step's images must be finished
+# - "interval": seconds between the starts of the images (default as close as the camera allows)
+# - "shutterSpeed", "aperture": camera settings for the step (default the target's)
+# - "burst": True to take the step's images with one trigger in the camera's continuous drive mode
+# A target uses the sequence named in the schedule's optional "Sequence" column, or DEFAULT_SEQUENCE
+SEQUENCES = {
+    "standard": [{"offset": -20}, {"offset": -10}, {"offset": 0}, {"offset": 10}, {"offset": 20}],
+    "packed": [{"offset": -20, "until": 28, "shutterSpeed": "2"}],
+    "burst": [{"offset": -20}, {"offset": -10}, {"offset": 0, "count": 5, "burst": True, "shutterSpeed": "1/4"},
+              {"offset": 10}, {"offset": 20}],
+}
+DEFAULT_SEQUENCE = "standard"
+
+# Camera settings for the continuous drive mode of "burst" steps, and for single images, which are
+# only sent if a sequence has a burst. They differ between makes; these are for Nikon. The number
+# of images in each burst is written to BURST_COUNT_SETTING
+BURST_SETTINGS = {"capturemode": "Burst"}
+SINGLE_SETTINGS = {"capturemode": "Single Shot"}
+BURST_COUNT_SETTING = "burstnumber"
+
+# Capture and readout time of the camera, measured from every image and used to pack sequences
+CAPTURE_MODEL_FILE = "capture_model.csv"
+
+# Images are downloaded from the camera into a sub folder per night in this directory
+IMAGE_DIRECTORY = "images"
+CAPTURE_QUEUE_LEAD = 1  # Seconds before each image that it is handed to the capture thread
+
+# The capture log (YYYYMMDD.csv) and event log (YYYYMMDD_events.csv) are written here, one pair per night
+LOG_DIRECTORY = "."
+
+# The position and limits of both axes are saved here before and after every move and at shutdown.
+# After a clean shutdown the saved position is trusted and homing is skipped. If the program stopped
+# between moves, the position is checked against the nearest limit switch. Homing only runs if the
+# program stopped part way through a move, or the check fails
+STATE_FILE = "mount_state.csv"
+VERIFY_PARKED_START = False  # Also check the position after a clean shutdown
+
+# Slew, step timing, capture and scheduling metrics are served in the Prometheus text format at
+# http://<address>:<port>/metrics while the program runs. None turns the server off
+METRICS_PORT = 9101
+METRICS_ADDRESS = "127.0.0.1"   # This machine only. "" listens on every interface, for scraping from another machine
+
+# Stations run together by coordinator.py get their schedule from it instead of the USB drive, and
+# send their capture results back to it. None runs the station on its own
+COORDINATOR_URL = None  # e.g. "http://192.168.1.10:8700"
+STATION_NAME = "os3"    # This station's name in the coordinator's stations file
+
+# Each downloaded image gets a quick look (background level, star count and satellite streak) from
+# a pool of worker processes, and the results go in the event log, so cloud or bad pointing is seen
+# during the night. JPEGs need Pillow: python3 -m pip install pillow
+QUICKLOOK_WORKERS = 3   # Worker processes. One core of the Pi is left for capture and motion. 0 turns it off
+QUICKLOOK_LIMIT = 6     # Most images waiting or being looked at. Images beyond this are skipped
+QUICKLOOK_MIN_STARS = 10  # Fewer stars than this is reported as possible cloud or bad pointing
 
 
 def setCamera(setShutterSpeed = "N", setAperture = "N"):
     ######## setCamera ########
-    # Function: Set camera shutter speed and aperture
+    # Function: Set camera shutter speed and aperture. Only values the camera doesn't already have are sent
     #
     # Inputs:
     # - setShutterSpeed: optional. Enter desired shutter speed as str
@@ -70,64 +202,269 @@ def setCamera(setShutterSpeed = "N", setAperture = "N"):
     # Return Values: None
     ##########################
     if cameraConnected:
-        if setShutterSpeed != "N" or setAperture != "N":
-            try:
-                config = camera.get_config()
-            except:
-                print("Error: Camera Disconnected.")
-                return
-            if setShutterSpeed != "N":
-                OK, shutterSpeedConfig = gp.gp_widget_get_child_by_name(config, 'shutterspeed')
-                if OK >= gp.GP_OK:
-                    print("Setting shutter speed to ", setShutterSpeed)
-                    shutterSpeedConfig.set_value(setShutterSpeed)
-            if setAperture != "N":
-                OK, apertureConfig = gp.gp_widget_get_child_by_name(config, 'aperture')
-                if OK >= gp.GP_OK:
-                    print("Setting aperutre to ", setAperture)
-                    apertureConfig.set_value(setAperture)
-            try:
-                camera.set_config(config)
-            except:
-                print("Error: Camera Disconnected.")
-                return
-            time.sleep(0.1)
+        settings = {}
+        if setShutterSpeed != "N":
+            settings["shutterspeed"] = setShutterSpeed
+        if setAperture != "N":
+            settings["aperture"] = setAperture
+        if settings:
+            with cameraLock:
+                try:
+                    changed = cameraSettings.apply(settings)
+                except Exception:
+                    print("Error: Camera Disconnected.")
+                    return
+            for name in changed:
+                print("Set", name, "to", settings[name])
         else:
             print("No arguments given.")
     else:
         print("Cannot set values without camera connected.")
 
 
-def takeImage(satelliteName, numInSequence, logFile):
+def loadSequences():
+    ######## loadSequences ########
+    # Function: Check the imaging sequences in SEQUENCES
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - sequences: dictionary of name to list of SequenceStep. Invalid sequences are left out, and
+    #              if DEFAULT_SEQUENCE is one of them, five images 10 seconds apart are used instead
+    ##########################
+    sequences = {}
+    for name, definition in SEQUENCES.items():
+        try:
+            sequences[name] = parseSequence(definition)
+        except ValueError as error:
+            print("Error: Imaging sequence", name, "is invalid (" + str(error) + ")")
+    if DEFAULT_SEQUENCE not in sequences:
+        print("Error: No default imaging sequence. Taking five images 10 seconds apart.")
+        sequences[DEFAULT_SEQUENCE] = parseSequence([{"offset": offset} for offset in (-20, -10, 0, 10, 20)])
+    return sequences
+
+
+def captureTime(exposure):
+    # Time the camera is predicted to take for one image. captureModel.margin() is allowed on top
+    return float(captureModel.predict(exposure))
+
+
+def targetShots(satellite):
+    ######## targetShots ########
+    # Function: Work out the camera triggers of a target's imaging sequence, packed using the
+    #           camera's measured capture time
+    #
+    # Inputs:
+    # - satellite: schedule entry for the target
+    #
+    # Return Values:
+    # - sequenceName: name of the target's sequence
+    # - shots: list of imagingSequence.Shot, in time order
+    ##########################
+    sequenceName = satellite.sequence or DEFAULT_SEQUENCE
+
+    def exposure(step):
+        return exposureSeconds(step.shutterSpeed or satellite.shutterSpeed or SHUTTER_SPEED) or 0
+
+    return sequenceName, planShots(sequences[sequenceName], exposure, captureTime, captureModel.margin())
+
+
+def shotSettings(satellite, shot):
+    ######## shotSettings ########
+    # Function: Find the camera settings for one trigger of a target's sequence
+    #
+    # Inputs:
+    # - satellite: schedule entry for the target
+    # - shot: imagingSequence.Shot to take
+    #
+    # Return Values:
+    # - settings: dictionary of camera setting name to value
+    ##########################
+    settings = {"shutterspeed": shot.shutterSpeed or satellite.shutterSpeed or SHUTTER_SPEED,
+                "aperture": shot.aperture or satellite.aperture or APERTURE}
+    # The drive mode is left alone unless a sequence needs it, as not every camera has the setting
+    if burstsUsed:
+        if shot.burst:
+            settings.update(BURST_SETTINGS)
+            settings[BURST_COUNT_SETTING] = str(shot.frames)
+        else:
+            settings.update(SINGLE_SETTINGS)
+    return settings
+
+
+def takeImage(satelliteName, numInSequence, imageTime, settings=None, frames=1, sequence="", step=0):
     ######## takeImage ########
-    # Function: Start camera exposure
+    # Function: Queue a camera exposure. The capture thread starts it at imageTime
     #
     # Inputs:
     # - satelliteName: target name to print in the log file
     # - numInSequene: sequence number to print in log file
-    # - logFile: fileobject for the log file
+    # - imageTime: UTC timestamp to start the exposure at
+    # - settings: optional. Camera settings for the exposure, changed just before it if needed
+    # - frames: optional. Images to take in a burst, with settings for the continuous drive mode
+    # - sequence: optional. Name of the imaging sequence, for the log file
+    # - step: optional. Step of the sequence, for the log file
     #
     # Return Values: None
     ##########################
-    ledOn = gpio.input(YELLOW_LED)
-    gpio.output(YELLOW_LED, gpio.LOW)
     if cameraConnected:
-        imageTime = datetime.utcnow()
-        try:
-            filePath = camera.capture(gp.GP_CAPTURE_IMAGE)
-        except:
-            print("Error: Camera Disconnected.")
-        logFile.write("\n" + filePath.name + "," + satelliteName + "," + imageTime.strftime("%H:%M:%S") + "," + str(numInSequence))
+        cameraManager.queueCapture(imageTime, satelliteName, numInSequence, settings, frames, sequence, step)
     else:
         gpio.output(RED_LED, gpio.HIGH)
         print("Cannot take image without camera connected.")
         time.sleep(0.5)
         gpio.output(RED_LED, gpio.LOW)
-    if ledOn:
-        gpio.output(YELLOW_LED, gpio.HIGH)
     return
 
 
+def logCapture(result):
+    ######## logCapture ########
+    # Function: Write a finished exposure to the log file. Called from the capture thread
+    #
+    # Inputs:
+    # - result: CaptureResult of the exposure
+    #
+    # Return Values: None
+    ##########################
+    if result.error is not None:
+        print("Error: Camera Disconnected.")
+        gpio.output(RED_LED, gpio.HIGH)
+        eventLog.event("error", result.satelliteName, image=result.numInSequence, error=result.error)
+        capturesTaken.inc(result="error")
+        if stationAgent is not None:
+            stationAgent.report(result)
+        return
+    capturesTaken.inc(result="ok")
+    captureLatency.observe(result.completeTime - result.triggerTime)
+    shotOffset.observe(result.triggerTime - result.scheduledTime, step=result.step)
+    # Single images measure the camera's capture and readout time. Saved after the sequence
+    exposure = exposureSeconds((result.settings or {}).get("shutterspeed", ""))
+    if result.captureTime is not None and exposure is not None:
+        captureModel.record(exposure, result.captureTime)
+    if stationAgent is not None:
+        stationAgent.report(result)
+    imageTime = datetime.fromtimestamp(result.triggerTime)
+    print("Image", result.numInSequence, "of", result.satelliteName, "taken at", imageTime.strftime("%H:%M:%S.%f")[:-3])
+    # Only queued here. The log thread writes the files
+    eventLog.capture(result)
+    eventLog.event("capture", result.satelliteName, image=result.numInSequence, sequence=result.sequence, step=result.step, file=result.fileName,
+                   late="%.4f" % (result.triggerTime - result.scheduledTime),
+                   duration="%.3f" % (result.completeTime - result.triggerTime))
+
+
+def queueQuickLook(result, path):
+    ######## queueQuickLook ########
+    # Function: Hand a downloaded image to the quick-look workers. Called from the download thread
+    #
+    # Inputs:
+    # - result: CaptureResult of the image
+    # - path: where the image was saved
+    #
+    # Return Values: None
+    ##########################
+    if not quickLook.submit(result, path):
+        quickLooks.inc(result="skipped")
+        eventLog.event("quicklook", result.satelliteName, image=result.numInSequence, file=result.fileName,
+                       error="Skipped, " + str(QUICKLOOK_LIMIT) + " images already waiting")
+
+
+def logQuickLook(result, stats, error):
+    ######## logQuickLook ########
+    # Function: Log the quick look of an image. Called from a thread of the quick-look pool
+    #
+    # Inputs:
+    # - result: CaptureResult of the image
+    # - stats: dictionary from quickLook.analyseImage, or None if the image couldn't be read
+    # - error: why the image couldn't be read
+    #
+    # Return Values: None
+    ##########################
+    if stats is None:
+        # Every image fails the same way if e.g. Pillow is missing, so each reason is only printed once
+        if error not in quickLookErrors:
+            quickLookErrors.add(error)
+            print("Warning: Quick look failed for", result.fileName, "(" + error + ")")
+        quickLooks.inc(result="error")
+        eventLog.event("quicklook", result.satelliteName, image=result.numInSequence, file=result.fileName, error=error)
+        return
+    quickLooks.inc(result="ok")
+    imageStars.set(stats["stars"])
+    imageBackground.set(stats["background"])
+    if stats["streak"]:
+        streaksFound.inc()
+    if stats["stars"] < QUICKLOOK_MIN_STARS:
+        print("Warning: Only", stats["stars"], "stars in", result.fileName, "- cloud or bad pointing?")
+    eventLog.event("quicklook", result.satelliteName, image=result.numInSequence, file=result.fileName,
+                   background="%.1f" % stats["background"], noise="%.1f" % stats["noise"], stars=stats["stars"],
+                   streak=stats["streak"], streakLength="%.0f" % stats["streakLength"], streakAngle="%.0f" % stats["streakAngle"])
+
+
+def syncFiles():
+    ######## syncFiles ########
+    # Function: List the files to copy to the USB drive. Called from the sync thread
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - files: list of (path, name on the drive). Logs go in the top folder, images in "images"
+    ##########################
+    files = []
+    if copyLog:
+        for name in sorted(os.listdir(LOG_DIRECTORY)):
+            if LOG_FILE_PATTERN.match(name):
+                files.append((os.path.join(LOG_DIRECTORY, name), name))
+    if copyImages:
+        for directory, folders, names in os.walk(IMAGE_DIRECTORY):
+            folders.sort()
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                files.append((path, os.path.join("images", os.path.relpath(path, IMAGE_DIRECTORY))))
+    return files
+
+
+def syncIdle():
+    ######## syncIdle ########
+    # Function: Check that copying to the USB drive can't hold up a move or an image. Called from
+    #           the sync thread
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - idle: True if nothing is due for SYNC_GUARD seconds and no images are waiting to download
+    ##########################
+    nextTime = scheduler.nextTime()
+    if nextTime is None or nextTime - wallTime() < SYNC_GUARD:
+        return False
+    if cameraConnected:
+        nextCapture = cameraManager.nextCaptureTime()
+        if nextCapture is not None or cameraManager.downloadQueue.qsize() > 0:
+            return False
+    return True
+
+
+def calcTargetSteps(azimuth, elevation):
+    ######## calcTargetSteps ########
+    # Function: Find the motor positions needed to point at targets, against the calibrated limits.
+    #           Accepts single values or numpy arrays of targets
+    #
+    # Inputs:
+    # - azimuth: The target azimuth angle(s) in degrees
+    # - elevation: The target elevation angle(s) in degrees
+    #
+    # Return Values:
+    # - panValid: False if the pan position can't be reached
+    # - tiltValid: False if the tilt position can't be reached
+    # - panStep: pan motor position in steps
+    # - tiltStep: tilt motor position in steps
+    # - flipped: True if the mount points over the top
+    ##########################
+    panDegPerStep = (1.8/pan.uSteps) / PAN_BELT_RATIO
+    tiltDegPerStep = (1.8/tilt.uSteps) / TILT_BELT_RATIO
+    panLimits = (pan.minStep*panDegPerStep, pan.maxStep*panDegPerStep)
+    tiltLimits = (tilt.minStep*tiltDegPerStep, tilt.maxStep*tiltDegPerStep)
+    panValid, tiltValid, mountAzimuth, mountElevation, flipped = solvePointing(azimuth, elevation, panLimits, tiltLimits)
+    return panValid, tiltValid, mountAzimuth/panDegPerStep, mountElevation/tiltDegPerStep, flipped
+
 
 def calcRotation(azimuth, elevation):
     ######## calcRotation ########
@@ -142,62 +479,291 @@ def calcRotation(azimuth, elevation):
     # - panRotation: required rotation of the pan motor
     # - tiltRotation: required rotation of the tilt motor
     ##########################
-    ROTATION_ANGLE = math.radians(-40)
-    azimuth = math.radians(azimuth)
-    elevation = math.radians(elevation)
-    
-    posE = math.sin(azimuth) * math.cos(elevation)
-    posN = math.cos(azimuth) * math.cos(elevation)
-    posU = math.sin(elevation)
-
-    RposE = posE
-    RposN = (posN * math.cos(ROTATION_ANGLE)) + (posU * math.sin(ROTATION_ANGLE))
-    RposU = (-posN * math.sin(ROTATION_ANGLE)) + (posU * math.cos(ROTATION_ANGLE))
-
-    mountAzimuth = math.atan2(RposE, RposN)
-    mountElevation = math.asin(RposU)
-
-    mountAzimuth = math.degrees(mountAzimuth)
-    mountElevation = math.degrees(mountElevation)
-
-    currentPanAngle = (pan.position*(1.8/pan.uSteps)) / PAN_BELT_RATIO
-    currentTiltAngle = (tilt.position*(1.8/tilt.uSteps)) / TILT_BELT_RATIO
-
+    panValid, tiltValid, panStep, tiltStep, flipped = calcTargetSteps(azimuth, elevation)
 
     success = True
-    if mountAzimuth > (pan.maxStep*(1.8/pan.uSteps)) / PAN_BELT_RATIO:
-        mountAzimuth = mountAzimuth - 180
-        mountElevation = 180 - mountElevation
-    elif mountAzimuth < (pan.minStep*(1.8/pan.uSteps)) / PAN_BELT_RATIO:
-        mountAzimuth = mountAzimuth + 180
-        mountElevation = 180 - mountElevation
-
-    mountElevation = -mountElevation
-
-    if mountAzimuth < (pan.maxStep*(1.8/pan.uSteps)) / PAN_BELT_RATIO and mountAzimuth > (pan.minStep*(1.8/pan.uSteps)) / PAN_BELT_RATIO:
-        panRotation = PAN_BELT_RATIO*(mountAzimuth - currentPanAngle)
+    if panValid:
+        panRotation = (panStep - pan.position)*(1.8/pan.uSteps)
     else:
         panRotation = 0
         success = False
 
-    if mountElevation < (tilt.maxStep*(1.8/tilt.uSteps)) / TILT_BELT_RATIO and mountElevation > (tilt.minStep*(1.8/tilt.uSteps)) / TILT_BELT_RATIO:
-        tiltRotation = TILT_BELT_RATIO*(mountElevation - currentTiltAngle)
+    if tiltValid:
+        tiltRotation = (tiltStep - tilt.position)*(1.8/tilt.uSteps)
     else:
         tiltRotation = 0
         success = False
-    
+
     return success, panRotation, tiltRotation
 
 
+def saveState(state):
+    ######## saveState ########
+    # Function: Save the position and limits of both axes to the state file
+    #
+    # Inputs:
+    # - state: MOVING, STOPPED or PARKED
+    #
+    # Return Values: None
+    ##########################
+    # Positions made up for testing must not be trusted by the next run
+    if skipCalibration:
+        return
+    saveMountState(STATE_FILE, state, {"pan": pan, "tilt": tilt})
+
+
+def slewSteps(panRotation, tiltRotation):
+    # Steps each motor makes to turn through the rotations, as moveAxes counts them
+    return [int(abs(rotation)/(1.8/axis.uSteps)) for axis, rotation in ((pan, panRotation), (tilt, tiltRotation))]
+
+
+def predictSlew(panSteps, tiltSteps):
+    ######## predictSlew ########
+    # Function: Find the time to allow for slews, from their motion profiles and the slew model.
+    #           Accepts single values or numpy arrays
+    #
+    # Inputs:
+    # - panSteps: steps the pan motor makes
+    # - tiltSteps: steps the tilt motor makes
+    #
+    # Return Values:
+    # - duration: predicted time of each slew plus the margin, in seconds
+    ##########################
+    profileTime = slewDuration([pan, tilt], [panSteps, tiltSteps], MOVE_SPEED)
+    return slewModel.predict(profileTime) + slewModel.margin() + SLEW_MARGIN
+
+
+def moveMotors(panRotation, tiltRotation, satelliteName=""):
+    ######## moveMotors ########
+    # Function: Turn the pan and tilt motors through the given rotations
+    #
+    # Inputs:
+    # - panRotation: required rotation of the pan motor
+    # - tiltRotation: required rotation of the tilt motor
+    # - satelliteName: optional. Target name for the event log
+    #
+    # Return Values: None
+    ##########################
+    # Both axes are stepped from one timeline so they start and finish together
+    ledPulse.ChangeFrequency(LED_FREQ)
+    ledPulse.start(50)
+    eventLog.event("move start", satelliteName, pan=round(panRotation, 2), tilt=round(tiltRotation, 2))
+    profileTime = float(slewDuration([pan, tilt], slewSteps(panRotation, tiltRotation), MOVE_SPEED))
+    plannedTime = float(slewModel.predict(profileTime))
+    saveState(MOVING)
+    # Timed on the monotonic clock, as the system clock can jump when the GPS time is picked up
+    moveStart = time.monotonic()
+    switchPin = moveAxes([pan, tilt], [panRotation, tiltRotation], MOVE_SPEED, threadLock)
+    moveTime = time.monotonic() - moveStart
+    saveState(STOPPED)
+    # A move cut short by a limit switch says nothing about how long a full one takes
+    if switchPin is None:
+        slewModel.record(profileTime, moveTime)
+        slewModel.save()
+    slewTime.observe(plannedTime, kind="planned")
+    slewTime.observe(moveTime, kind="actual")
+    slewError.observe(moveTime - plannedTime)
+    # Only the sleep backend times the edges itself
+    lateness = getattr(stepBackend, "lastLateness", None)
+    if lateness is not None:
+        edgeLateness.observe(lateness)
+    eventLog.event("move end", satelliteName, duration="%.3f" % moveTime, planned="%.3f" % plannedTime, profile="%.3f" % profileTime,
+                   panPosition=pan.position, tiltPosition=tilt.position,
+                   panRate="%.0f/%.0f" % (pan.achievedRate, pan.commandedRate),
+                   tiltRate="%.0f/%.0f" % (tilt.achievedRate, tilt.commandedRate))
+    ledPulse.stop()
+
+
+def moveToTarget(satellite, rotationValid, panRotation, tiltRotation):
+    ######## moveToTarget ########
+    # Function: Move to the target and queue its imaging sequence. Run by the scheduler just in
+    #           time for the first image, or MOVE_LEAD seconds before culmination
+    #
+    # Inputs:
+    # - satellite: schedule entry for the target
+    # - rotationValid: False if the target can't be reached
+    # - panRotation: required rotation of the pan motor
+    # - tiltRotation: required rotation of the tilt motor
+    #
+    # Return Values: None
+    ##########################
+    if not rotationValid:
+        print("Position unreachable.")
+        print("Skipping", satellite.name, "\n")
+        eventLog.event("skip", satellite.name, reason="Position unreachable")
+        skippedTargets.inc(reason="Position unreachable")
+        time.sleep(0.5)
+        gpio.output(RED_LED, gpio.LOW)
+        return
+
+    # Packed with the latest measured capture time
+    sequenceName, shots = targetShots(satellite)
+    firstShot, lastShot = sequenceSpan(shots)
+    if not shots:
+        print("No images fit in the", sequenceName, "sequence.")
+        print("Skipping", satellite.name, "\n")
+        eventLog.event("skip", satellite.name, reason="Empty sequence", sequence=sequenceName)
+        skippedTargets.inc(reason="Empty sequence")
+        return
+    for problem in checkShots(sequences[sequenceName], shots, captureModel.margin()):
+        print("Warning:", problem, "(" + sequenceName + " sequence).")
+
+    # Don't image a pass late if the first image is already due
+    if wallTime() > satellite.time + firstShot:
+        print("Pass already started.")
+        print("Skipping", satellite.name, "\n")
+        eventLog.event("skip", satellite.name, reason="Pass already started", late="%.1f" % (wallTime() - (satellite.time + firstShot)))
+        skippedTargets.inc(reason="Pass already started")
+        return
+
+    print("Moving to position for", satellite.name)
+    tracking = False
+    if trackingMode:
+        tracking = startTracking(satellite, firstShot, lastShot)
+    if not tracking:
+        moveMotors(panRotation, tiltRotation, satellite.name)
+    print("Pan Position:", pan.position)
+    print("Tilt position:", tilt.position)
+    time.sleep(0.2)
+
+    # Imaging Sequence
+    print("Waiting to take", sum(shot.frames for shot in shots), "images (" + sequenceName + " sequence)...")
+    gpio.output(YELLOW_LED, gpio.HIGH)
+    # Images are numbered from the first one at or after culmination, so the standard sequence
+    # is -2 to 2 as it always has been
+    numInSequence = -sum(shot.frames for shot in shots if shot.offset < 0)
+    previousTime = None
+    for shot in shots:
+        imageTime = satellite.time + shot.offset
+        # Closely packed images are queued by the time the one before is taken, so no download
+        # is started in the gap between them
+        queueTime = imageTime - CAPTURE_QUEUE_LEAD
+        if previousTime is not None:
+            queueTime = min(queueTime, previousTime)
+        scheduler.at(queueTime, captureInSequence, satellite.name, sequenceName, numInSequence, shot,
+                     imageTime, shotSettings(satellite, shot))
+        previousTime = imageTime
+        numInSequence = numInSequence + shot.frames
+    scheduler.at(satellite.time + shots[-1].offset, finishImaging)
+    if tracking:
+        scheduler.at(satellite.time + lastShot + TRACK_MARGIN, finishTracking, satellite.name)
+
+
+def startTracking(satellite, firstShot, lastShot):
+    ######## startTracking ########
+    # Function: Work out the target's track across the sky, move to the start of it and start
+    #           following it in a separate thread
+    #
+    # Inputs:
+    # - satellite: schedule entry for the target
+    # - firstShot: offset from culmination of the first image, in seconds
+    # - lastShot: offset from culmination of the end of the last image, in seconds
+    #
+    # Return Values:
+    # - tracking: False if the pass can't be tracked. The mount has not been moved
+    ##########################
+    global passTracker, trackerThread
+    tle = tles.get(satellite.catalogNumber.strip().lstrip("0"))
+    if tle is None:
+        print("No TLE for", satellite.name + ". Pointing at culmination.")
+        return False
+
+    trackTimes = numpy.arange(satellite.time + firstShot - TRACK_MARGIN, satellite.time + lastShot + TRACK_MARGIN, 1/TRACK_RATE)
+    azimuth, elevation = propagate(tle, trackTimes, STATION_LATITUDE, STATION_LONGITUDE, STATION_ALTITUDE)
+    if numpy.isnan(elevation).any():
+        print("Could not propagate TLE for", satellite.name + ". Pointing at culmination.")
+        return False
+    panValid, tiltValid, panSteps, tiltSteps, flipped = calcTargetSteps(azimuth, elevation)
+    # The mount can't flip over the top part way through a pass
+    if not (panValid.all() and tiltValid.all()) or flipped.any() != flipped.all():
+        print("Pass can't be tracked within the motor limits. Pointing at culmination.")
+        return False
+
+    moveMotors((panSteps[0] - pan.position)*(1.8/pan.uSteps), (tiltSteps[0] - tilt.position)*(1.8/tilt.uSteps), satellite.name)
+    degPerStep = [(1.8/pan.uSteps) / PAN_BELT_RATIO, (1.8/tilt.uSteps) / TILT_BELT_RATIO]
+    passTracker = PassTracker([pan, tilt], trackTimes, [panSteps, tiltSteps], degPerStep)
+    trackerThread = threading.Thread(target=passTracker.run)
+    saveState(MOVING)
+    trackerThread.start()
+    print("Tracking", satellite.name)
+    return True
+
+
+def finishTracking(satelliteName):
+    ######## finishTracking ########
+    # Function: Wait for the tracking thread to finish and print the tracking error
+    #
+    # Inputs:
+    # - satelliteName: target name to print
+    #
+    # Return Values: None
+    ##########################
+    passTracker.stop = True
+    trackerThread.join()
+    saveState(STOPPED)
+    (panRms, panMax), (tiltRms, tiltMax) = passTracker.report()
+    print("Tracking error for", satelliteName)
+    print("Pan: RMS %.3f deg, max %.3f deg" % (panRms, panMax))
+    print("Tilt: RMS %.3f deg, max %.3f deg" % (tiltRms, tiltMax))
+    eventLog.event("tracking", satelliteName, panRms="%.4f" % panRms, panMax="%.4f" % panMax,
+                   tiltRms="%.4f" % tiltRms, tiltMax="%.4f" % tiltMax, aborted=passTracker.aborted)
+
+
+def finishImaging():
+    ######## finishImaging ########
+    # Function: Wait for the last exposure of the sequence to finish, then turn off the yellow LED
+    #           and save the capture times measured
+    #
+    # Inputs: None
+    #
+    # Return Values: None
+    ##########################
+    if cameraConnected:
+        cameraManager.waitForCaptures()
+    gpio.output(YELLOW_LED, gpio.LOW)
+    captureModel.save()
+
+
+def captureInSequence(satelliteName, sequenceName, numInSequence, shot, imageTime, settings=None):
+    ######## captureInSequence ########
+    # Function: Queue one trigger of the imaging sequence. Run by the scheduler shortly before it is due
+    #
+    # Inputs:
+    # - satelliteName: target name to print in the log file
+    # - sequenceName: name of the sequence
+    # - numInSequence: number of the (first) image. The first image at or after culmination is 0
+    # - shot: imagingSequence.Shot to take
+    # - imageTime: UTC timestamp to take the image at
+    # - settings: optional. Camera settings for the image
+    #
+    # Return Values: None
+    ##########################
+    if shot.offset == 0:
+        print("Culmination")
+    else:
+        print("%+g seconds" % shot.offset)
+    if shot.burst:
+        print("Burst of", shot.frames, "images")
+    takeImage(satelliteName, numInSequence, imageTime, settings, shot.frames, sequenceName, shot.step)
+
+
 
 ####### MAIN #######
+# The quick-look workers are forked before any other thread starts
+quickLook = None
+quickLookErrors = set()
+if QUICKLOOK_WORKERS > 0:
+    from quickLook import QuickLook
+    quickLook = QuickLook(QUICKLOOK_WORKERS, QUICKLOOK_LIMIT, logQuickLook)
+
 gpio.setwarnings(False)
 gpio.setmode(gpio.BOARD)
 cameraConnected = False
 
 # Define motor objects and assign their pins
-pan = motor(PAN_PINS)
-tilt = motor(TILT_PINS)
+stepBackend = createBackend(PULSE_BACKEND)
+pan = motor(PAN_PINS, stepBackend)
+tilt = motor(TILT_PINS, stepBackend)
 
 # Define schedule object
 schedule = Schedule()
@@ -205,6 +771,8 @@ schedule = Schedule()
 # Configure GPIO for each motor
 pan.motorInit()
 tilt.motorInit()
+pan.setLimits(PROFILE_SHAPE, PAN_MAX_SPEED, PAN_MAX_ACCEL, PAN_MAX_JERK)
+tilt.setLimits(PROFILE_SHAPE, TILT_MAX_SPEED, TILT_MAX_ACCEL, TILT_MAX_JERK)
 
 
 # Set up LED pins
@@ -216,12 +784,57 @@ gpio.output(RED_LED, gpio.LOW)
 # Used for multithreading of motors
 threadLock = threading.Lock()
 
+# Queue of timed actions for the imaging sequence
+scheduler = TimerScheduler()
+
+# Learns how long moves and captures really take, so each move can start just in time and the
+# imaging sequences can be packed
+slewModel = DurationModel(SLEW_MODEL_FILE)
+captureModel = DurationModel(CAPTURE_MODEL_FILE)
+
+# Performance metrics. Queues that don't exist yet (no camera, no schedule) are left out of a scrape
+metrics = Metrics()
+slewTime = metrics.histogram("os3_slew_seconds", "Slew duration, predicted by the slew model and actual",
+                             [0.5, 1, 2, 5, 10, 20, 30, 60, 120])
+slewError = metrics.histogram("os3_slew_error_seconds", "Actual minus planned slew duration",
+                              [-1, -0.1, -0.01, 0, 0.01, 0.1, 0.5, 1, 5])
+edgeLateness = metrics.histogram("os3_step_edge_lateness_seconds", "Latest step edge of each slew, after its deadline",
+                                 [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05])
+captureLatency = metrics.histogram("os3_capture_latency_seconds", "Time from trigger to the camera finishing an exposure",
+                                   [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10])
+shotOffset = metrics.histogram("os3_shot_offset_seconds", "Trigger time minus the scheduled time of each image",
+                               [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1])
+capturesTaken = metrics.counter("os3_captures_total", "Exposures taken, by result")
+skippedTargets = metrics.counter("os3_skipped_targets_total", "Targets not imaged, by reason")
+quickLooks = metrics.counter("os3_quicklook_total", "Downloaded images looked at, by result")
+streaksFound = metrics.counter("os3_quicklook_streaks_total", "Images with a satellite streak")
+imageStars = metrics.gauge("os3_quicklook_stars", "Stars in the last image looked at")
+imageBackground = metrics.gauge("os3_quicklook_background", "Background level of the last image looked at")
+metrics.gauge("os3_slew_model_offset_seconds", "Time the slew model adds to every move", lambda: slewModel.coefficients()[0])
+metrics.gauge("os3_slew_model_scale", "Actual slew time per second of motion profile, from the slew model", lambda: slewModel.coefficients()[1])
+metrics.gauge("os3_capture_overhead_seconds", "Capture and readout time the capture model adds to every exposure", lambda: captureModel.coefficients()[0])
+metrics.gauge("os3_load_average", "One minute system load average", loadAverage)
+metrics.gauge("os3_process_cpu_seconds", "CPU time used by this process", processCpuTime)
+metrics.gauge("os3_scheduler_queue_length", "Timed actions waiting to run", lambda: len(scheduler.queue))
+metrics.gauge("os3_capture_queue_length", "Exposures waiting for the capture thread", lambda: cameraManager.captureQueue.qsize())
+metrics.gauge("os3_download_queue_length", "Images waiting to be downloaded", lambda: cameraManager.downloadQueue.qsize())
+metrics.gauge("os3_event_log_queue_length", "Log entries waiting to be written", lambda: eventLog.queue.qsize())
+metrics.gauge("os3_event_log_dropped", "Log entries dropped because the queue was full", lambda: eventLog.dropped)
+metrics.gauge("os3_usb_sync_bytes", "Bytes copied to the USB drive", lambda: usbSync.copiedBytes)
+metrics.gauge("os3_usb_sync_pending_files", "Files still to be copied to the USB drive at the last check", lambda: usbSync.pendingFiles)
+if METRICS_PORT is not None and metrics.serve(METRICS_ADDRESS, METRICS_PORT):
+    print("Serving metrics on port", METRICS_PORT)
+
 ledPulse = gpio.PWM(YELLOW_LED, LED_FREQ)
+startupTimer.mark("GPIO")
 
 # Set up camera object and print summary of camera info
 # Will ask to try again if no camera detected
 # Allows you to continue without camera (won't take any images)
+import gphoto2 as gp
+from cameraSettings import CameraSettings
 camera = gp.Camera()
+cameraSettings = CameraSettings(camera)
 cameraReady = False
 while not cameraReady:
     try:
@@ -249,6 +862,14 @@ while not cameraReady:
             elif tryAgain == "Y" or tryAgain == "y":
                 validInput = True
 
+# Exposures are taken and downloaded in the background
+cameraLock = threading.Lock()
+if cameraConnected:
+    from cameraManager import CameraManager
+    cameraManager = CameraManager(camera, cameraLock, IMAGE_DIRECTORY, logCapture, YELLOW_LED,
+                                  queueQuickLook if quickLook is not None else None, cameraSettings)
+startupTimer.mark("camera")
+
 if skipCalibration:
     # skip calibration should only be used for testing
     print("Calibration Skipped.")
@@ -261,52 +882,97 @@ if skipCalibration:
     print("Pan total steps:", pan.totalSteps)
     print("Tilt total steps:", tilt.totalSteps)
 else:
-    # Look for calibraion file
-    calibrationFileExists = False
-    try:
-        calibrationFile = open("calibration.csv", "x")
-    except FileExistsError:
-        calibrationFileExists = True
-
     ledPulse.ChangeFrequency(LED_FREQ)
     ledPulse.start(50)
-    if calibrationFileExists:
-        # Load pre-existing calibration
-        with open('calibration.csv', 'r') as calibrationFile:
-                fileRow = csv.reader(calibrationFile)
-                for row in fileRow:
-                    if row[0] == "pan":
-                        pan.totalSteps = int(row[1])
-                    elif row[0] == "tilt":
-                        tilt.totalSteps = int(row[1])
-        print("Loaded calibration file.")
+
+    # Use the position saved at the last stop if it can be trusted
+    homingNeeded = True
+    savedState = loadMountState(STATE_FILE)
+    if savedState is None:
+        print("No saved mount state.")
+    elif savedState.state == MOVING:
+        print("Program stopped during a move. Position unknown.")
+    elif "pan" not in savedState.axes or "tilt" not in savedState.axes:
+        print("Error: Mount state file is incomplete.")
+    else:
+        restoreAxis(pan, savedState.axes["pan"])
+        restoreAxis(tilt, savedState.axes["tilt"])
+        print("Loaded mount state saved at", datetime.fromtimestamp(savedState.savedTime).strftime("%Y-%m-%d %H:%M:%S"))
         print("Pan total steps:", pan.totalSteps)
         print("Tilt total steps:", tilt.totalSteps)
-        time.sleep(1)
-        print("Calibrating pan motor.")
-        pan.calibrate(threadLock)
-        pan.run(0, (pan.totalSteps/2) * (1.8/pan.uSteps), 60, threadLock, True)
-        print("Calibrating tilt motor.")
-        tilt.calibrate(threadLock)
-        tilt.position = TILT_0_ANGLE / (1.8/tilt.uSteps)
-        tilt.maxStep = tilt.position
-        tilt.minStep = tilt.position - tilt.totalSteps
-        tilt.run(0, TILT_0_ANGLE, 60, threadLock, True)
-    else:
-        # No calibration file - run full calibration
-        print("Full calibration of pan motor.")
-        pan.fullCalibrate(threadLock)
-        pan.run(0, (pan.totalSteps/2) * (1.8/pan.uSteps), 60, threadLock, True)
-        print("Full calibration of tilt motor.")
-        tilt.fullCalibrate(threadLock)
-        tilt.position = TILT_0_ANGLE / (1.8/tilt.uSteps)
-        tilt.maxStep = tilt.position
-        tilt.maxStep = tilt.position - tilt.totalSteps
-        tilt.run(0, TILT_0_ANGLE, 60, threadLock, True)
-        calibrationFile.write("pan," + str(pan.totalSteps) + "\ntilt," + str(tilt.totalSteps))
-    calibrationFile.close()
+        if savedState.state == PARKED and not VERIFY_PARKED_START:
+            print("Shut down cleanly. Skipping calibration.")
+            homingNeeded = False
+        else:
+            saveState(MOVING)
+            print("Checking pan position.")
+            if pan.verifyPosition():
+                print("Checking tilt position.")
+                homingNeeded = not tilt.verifyPosition()
+            if homingNeeded:
+                print("Position check failed.")
+
+    if homingNeeded:
+        saveState(MOVING)
+        # Look for calibraion file
+        calibrationFileExists = False
+        try:
+            calibrationFile = open("calibration.csv", "x")
+        except FileExistsError:
+            calibrationFileExists = True
+
+        if calibrationFileExists:
+            # Load pre-existing calibration
+            with open('calibration.csv', 'r') as calibrationFile:
+                    fileRow = csv.reader(calibrationFile)
+                    for row in fileRow:
+                        if row[0] == "pan":
+                            pan.totalSteps = int(row[1])
+                        elif row[0] == "tilt":
+                            tilt.totalSteps = int(row[1])
+            print("Loaded calibration file.")
+            print("Pan total steps:", pan.totalSteps)
+            print("Tilt total steps:", tilt.totalSteps)
+            time.sleep(1)
+            print("Calibrating pan motor.")
+            calibrated = pan.calibrate(threadLock)
+            if calibrated:
+                pan.run(0, (pan.totalSteps/2) * (1.8/pan.uSteps), MOVE_SPEED, threadLock, True)
+                print("Calibrating tilt motor.")
+                calibrated = tilt.calibrate(threadLock)
+            if calibrated:
+                tilt.position = TILT_0_ANGLE / (1.8/tilt.uSteps)
+                tilt.maxStep = tilt.position
+                tilt.minStep = tilt.position - tilt.totalSteps
+                tilt.run(0, TILT_0_ANGLE, MOVE_SPEED, threadLock, True)
+        else:
+            # No calibration file - run full calibration
+            print("Full calibration of pan motor.")
+            calibrated = pan.fullCalibrate(threadLock, PAN_MIN_STEPS)
+            if calibrated:
+                pan.run(0, (pan.totalSteps/2) * (1.8/pan.uSteps), MOVE_SPEED, threadLock, True)
+                print("Full calibration of tilt motor.")
+                calibrated = tilt.fullCalibrate(threadLock, TILT_MIN_STEPS)
+            if calibrated:
+                tilt.position = TILT_0_ANGLE / (1.8/tilt.uSteps)
+                tilt.maxStep = tilt.position
+                tilt.minStep = tilt.position - tilt.totalSteps
+                tilt.run(0, TILT_0_ANGLE, MOVE_SPEED, threadLock, True)
+                calibrationFile.write("pan," + str(pan.totalSteps) + "\ntilt," + str(tilt.totalSteps))
+        calibrationFile.close()
+        if not calibrated:
+            # The mount state is left as moving and no calibration file is written, so the next
+            # start homes again rather than trusting limits measured from wherever the motor stopped
+            if not calibrationFileExists:
+                os.remove("calibration.csv")
+            print("Error: Calibration failed. Check the limit switches and motors.")
+            gpio.output(RED_LED, gpio.HIGH)
+            ledPulse.stop()
+            print("Exiting...")
+            exit()
+    saveState(STOPPED)
     ledPulse.stop()
-
+startupTimer.mark("calibration")
 
 
 print("\nPan Position:", pan.position)
@@ -314,46 +980,104 @@ print("Tilt Position:", tilt.position)
 print("\n")
 
 
-# Read schedule file
-if copySchedule:
-    print("\nCopying Schedule...")
-    if schedule.copyFile(FILE_SOURCE):
-        print("Reading coppied schedule...")
-        scheduleLoaded = schedule.open(schedule.filePath)
+# Read schedule file. A station run by a coordinator gets its schedule from it, and falls back to
+# its own schedule if the coordinator can't be reached
+stationAgent = None
+scheduleLoaded = False
+if COORDINATOR_URL is not None:
+    from stationAgent import StationAgent
+    stationAgent = StationAgent(COORDINATOR_URL, STATION_NAME)
+    print("\nGetting schedule from coordinator...")
+    if stationAgent.fetchSchedule("schedule.csv"):
+        scheduleLoaded = schedule.open("schedule.csv")
+if not scheduleLoaded:
+    if copySchedule:
+        print("\nCopying Schedule...")
+        if schedule.copyFile(FILE_SOURCE):
+            print("Reading coppied schedule...")
+            scheduleLoaded = schedule.open(schedule.filePath)
+        else:
+            print("Looking for schedule in current directory.")
+            scheduleLoaded = schedule.open("schedule.csv")
     else:
-        print("Looking for schedule in current directory.")
+        print("\nReading Schedule from current directory...")
         scheduleLoaded = schedule.open("schedule.csv")
-else:
-    print("\nReading Schedule from current directory...")
-    scheduleLoaded = schedule.open("schedule.csv")
+startupTimer.mark("schedule")
+
+# Read TLEs for tracking mode
+tles = {}
+if trackingMode:
+    print("\nReading TLEs...")
+    import numpy
+    from tracker import loadTLEs, propagate, PassTracker, TRACK_RATE
+    tles = loadTLEs(TLE_SOURCE)
+    print("Loaded", len(tles), "TLEs.")
+    startupTimer.mark("TLEs")
 
 
 # Set camera parameters
-setCamera(setShutterSpeed = "8", setAperture = "4.5")
-shutterSpeed = 8 
+setCamera(setShutterSpeed = SHUTTER_SPEED, setAperture = APERTURE)
+# Imaging sequences. The drive mode is only set if one of them has a burst
+sequences = loadSequences()
+burstsUsed = any(step.burst for steps in sequences.values() for step in steps)
+startupTimer.mark("camera settings")
 
 
 if scheduleLoaded:
-    # Set up log file, or open if it already exists
-    # FUTURE CHANGE: PUT LOG FILES IN A SUB FOLDER
+    # Log files are written by a background thread, and are appended to if they already exist
     print("Opening log file...")
-    logFileName = datetime.utcnow().strftime("%Y%m%d") + ".csv"
-    try:
-        captureLog = open(logFileName, "x")
-        captureLog.write("File Name, Target, Time, Number in Sequence")
-    except FileExistsError:
-        captureLog = open(logFileName, "a")
-
-
-    # Loop through all satellites in the schedule
-    for satellite in schedule.list[1:]:
+    eventLog = EventLog(LOG_DIRECTORY)
+
+
+    moveLead = 120 if trackingMode and MOVE_LEAD is None else MOVE_LEAD
+
+    for satellite in schedule.entries:
+        if satellite.sequence is not None and satellite.sequence not in sequences:
+            print("Warning: No imaging sequence called", satellite.sequence, "for", satellite.name + ". Using", DEFAULT_SEQUENCE)
+            satellite.sequence = None
+
+    # Skip straight past any passes that have already started
+    upcomingTargets = schedule.upcoming(wallTime() + 20)
+    if len(upcomingTargets) < len(schedule.entries):
+        print("Skipping", len(schedule.entries) - len(upcomingTargets), "past due targets.")
+        eventLog.event("skip", "", reason="Past due", count=len(schedule.entries) - len(upcomingTargets))
+        skippedTargets.inc(len(schedule.entries) - len(upcomingTargets), reason="Past due")
+
+    # Plan the night around the time taken to slew between targets
+    if optimizeSchedule:
+        print("Planning night...")
+        # The mount can't move on until the last exposure of each sequence has finished
+        spans = [sequenceSpan(targetShots(satellite)[1]) for satellite in upcomingTargets]
+        nightPlan, droppedTargets = planNight(upcomingTargets, wallTime(), (pan.position, tilt.position),
+                                              calcTargetSteps, predictSlew, firstShot=[span[0] for span in spans],
+                                              lastShot=[span[1] for span in spans], moveLead=moveLead)
+        print("Imaging", len(nightPlan), "of", len(upcomingTargets), "targets.")
+        for satellite, reason in droppedTargets:
+            print("Dropped", satellite.name, "at", satellite.timeString[11:19] + ":", reason)
+            eventLog.event("skip", satellite.name, reason=reason)
+            skippedTargets.inc(reason=reason)
+    else:
+        nightPlan = upcomingTargets
+    startupTimer.mark("plan")
+    startupTimer.report()
+    eventLog.event("startup", "", **startupTimer.details())
+
+    # Copy logs and images to the USB drive in the gaps between passes
+    usbSync = None
+    if copyLog or copyImages:
+        from usbSync import UsbSync
+        usbSync = UsbSync(USB_DIRECTORY, syncFiles, syncIdle, SYNC_RATE, SYNC_INTERVAL, USB_MOUNT_CHECK)
+        usbSync.start()
+
+    # Loop through all satellites in the plan
+    for satellite in nightPlan:
         # Print info about the next target
         print("\n========== Next Satellite ==========")
-        print(print("Name:", satellite[0]))
-        print("Culmination Time:", satellite[4][11:19])
-        print("Azimuth:", satellite[2])
-        print("Elevation:", satellite[3])
-        rotationValid, panRotation, tiltRotation = calcRotation(float(satellite[2]), float(satellite[3]))
+        print("Name:", satellite.name)
+        print("Culmination Time:", satellite.timeString[11:19])
+        print("Azimuth:", satellite.azimuth)
+        print("Elevation:", satellite.elevation)
+        rotationValid, panRotation, tiltRotation = calcRotation(satellite.azimuth, satellite.elevation)
         print("\nPan Rotation: ", panRotation)
         print("Tilt Rotation: ", tiltRotation)
         if not rotationValid:
@@ -362,107 +1086,47 @@ if scheduleLoaded:
         print("====================================")
         print("Waiting...")
 
-        # Convert time string to timestamp
-        satelliteTime = datetime.strptime(str(satellite[4]), "%Y-%m-%d %H:%M:%S").timestamp()
-
-        prevTime = datetime.utcnow()
-        # Waiting for movement time
-        while(datetime.utcnow().timestamp() < (satelliteTime - 120)):
-            if datetime.utcnow() != prevTime:
-                print("Current Time:", datetime.utcnow().strftime("%H:%M:%S"), "\r", end="")
-                prevTime = datetime.utcnow()
-        
-        if rotationValid:
-            print("Moving to position for", satellite[0])
-            ledPulse.ChangeFrequency(LED_FREQ)
-            ledPulse.start(50)
-            if panRotation < 0:
-                m1 = threading.Thread(target=pan.run, args=(0, abs(panRotation), 60, threadLock))
-            else:
-                m1 = threading.Thread(target=pan.run, args=(1, panRotation, 60, threadLock))
-            m1.start()
-
-            time.sleep(0.2)
-            if tiltRotation < 0:
-                m2 = threading.Thread(target=tilt.run, args=(0, abs(tiltRotation), 60, threadLock))
-            else:
-                m2 = threading.Thread(target=tilt.run, args=(1, tiltRotation, 60, threadLock))
-            m2.start()
-
-            m1.join()
-            m2.join()
-            ledPulse.stop()
-            print("Pan Position:", pan.position)
-            print("Tilt position:", tilt.position)
-            time.sleep(0.2)
-
-            # Imaging Sequence
-            # Wait until 20s before culmination
-            print("Waiting to take images...")
-            gpio.output(YELLOW_LED, gpio.HIGH)    
-            while(datetime.utcnow().timestamp() < (satelliteTime - 20)):
-                continue
-            print("-20 seconds")
-            takeImage(satellite[0], -2, captureLog)
-
-            while(datetime.utcnow().timestamp() < (satelliteTime - 10)):
-                continue
-            print("-10 seconds")
-            takeImage(satellite[0], -1, captureLog)
-
-            while(datetime.utcnow().timestamp() < satelliteTime):
-                continue
-            print("Culmination")
-            takeImage(satellite[0], 0, captureLog)
-
-            while(datetime.utcnow().timestamp() < (satelliteTime + 10)):
-                continue
-            print("+10 seconds")
-            takeImage(satellite[0], 1, captureLog)
-
-            while(datetime.utcnow().timestamp() < (satelliteTime + 20)):
-                continue
-            print("+20 seconds")
-            takeImage(satellite[0], 2, captureLog)
-
-            gpio.output(YELLOW_LED, gpio.LOW)
-
+        # Start the move at the last moment it can finish before the first image, leaving the
+        # settle time. The move queues the imaging sequence once it is in position
+        if moveLead is None:
+            slewAllowance = float(predictSlew(*slewSteps(panRotation, tiltRotation)))
+            moveTime = satellite.time + sequenceSpan(targetShots(satellite)[1])[0] - SETTLE_TIME - slewAllowance
+            print("Slew: %.1f s allowed. Moving at" % slewAllowance, datetime.fromtimestamp(moveTime).strftime("%H:%M:%S"))
         else:
-            print("Position unreachable.")
-            print("Skipping", satellite[0], "\n")
-            time.sleep(0.5)
-            gpio.output(RED_LED, gpio.LOW)
+            moveTime = satellite.time - moveLead
+        scheduler.at(moveTime, moveToTarget, satellite, rotationValid, panRotation, tiltRotation)
+        scheduler.run()
 
-    captureLog.close()
+    # Wait for the last images to be taken and downloaded
+    if cameraConnected:
+        cameraManager.close()
+    if quickLook is not None:
+        quickLook.close()
 
     # After test, return to default position
     print("Returning to home position.")
     rotationValid, panRotation, tiltRotation = calcRotation(0, -40)
-    ledPulse.ChangeFrequency(LED_FREQ)
-    ledPulse.start(50)
-    if panRotation < 0:
-        m1 = threading.Thread(target=pan.run, args=(0, abs(panRotation), 60, threadLock))
-    else:
-        m1 = threading.Thread(target=pan.run, args=(1, panRotation, 60, threadLock))
-    m1.start()
-
-    time.sleep(0.2)
-    if tiltRotation < 0:
-        m2 = threading.Thread(target=tilt.run, args=(0, abs(tiltRotation), 60, threadLock))
-    else:
-        m2 = threading.Thread(target=tilt.run, args=(1, tiltRotation, 60, threadLock))
-    m2.start()
-
-    m1.join()
-    m2.join()
-    ledPulse.stop()
-
-    if copyLog:
-        try:
-            logFilePath = shutil.copy(logFileName, "/mnt/usb")
-            print("Log file saved to", logFilePath)
-        except:
-            print("Could not copy log file. ")
+    moveMotors(panRotation, tiltRotation)
+    saveState(PARKED)
+
+    # Write out everything still queued before the files are copied
+    eventLog.close()
+    if eventLog.dropped > 0:
+        print("Warning:", eventLog.dropped, "log entries were dropped.")
+
+    if usbSync is not None:
+        print("Copying files to USB drive...")
+        if usbSync.close():
+            print("Copied", usbSync.copiedFiles, "files (%.1f MB) to" % (usbSync.copiedBytes/1e6), USB_DIRECTORY)
+        else:
+            print("Warning:", usbSync.pendingFiles, "files could not be copied to the USB drive. They will be copied next time.")
 else:
+    startupTimer.report()
     print("No schedule open.")
-    gpio.output(RED_LED, gpio.HIGH)
\ No newline at end of file
+    gpio.output(RED_LED, gpio.HIGH)
+    saveState(PARKED)
+if stationAgent is not None:
+    stationAgent.close()
+if quickLook is not None:
+    quickLook.close()
+metrics.close()
@@ -0,0 +1,392 @@
+# Benchmarks for the parts of OS3 that limit its timing. Runs on any Linux machine using the fake
+# GPIO and camera from simulator.py, in real time. Results are saved as JSON so a change to the
+# motion or timing code can be compared against the numbers from before it
+#
+# Usage: python3 benchmark.py [--save] [--baseline FILE] [--only NAME ...]
+# Run python3 benchmark.py --help for the other options
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+import numpy
+import simulator
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+# A result this much worse than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 0.25
+
+# Rows in the schedule used for the parse benchmark
+SCHEDULE_ROWS = 100000
+
+# Number of captures in the capture to log benchmark, and the time between them
+CAPTURE_COUNT = 40
+CAPTURE_SPACING = 0.05
+
+# Size of the camera's images (24 MP), and the number of them put through the quick-look pool
+QUICKLOOK_SIZE = (6000, 4000)
+QUICKLOOK_IMAGES = 12
+QUICKLOOK_WORKERS = 3
+
+
+class EdgeRecorder:
+    # Stand-in for RPi.GPIO that records the time of every output call, for measuring edge timing
+    LOW = 0
+    HIGH = 1
+    RISING = 1
+    FALLING = 2
+
+    def __init__(self):
+        self.edges = []
+
+    def output(self, pins, value):
+        self.edges.append(time.perf_counter())
+
+    def input(self, pin):
+        return self.HIGH
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        pass
+
+
+def installFakeModules():
+    ######## installFakeModules ########
+    # Function: Put the simulator's fake RPi.GPIO and gphoto2 modules in place so the OS3 modules
+    #           can be imported. The virtual clock is not installed, so everything runs in real time
+    #
+    # Inputs: None
+    #
+    # Return Values: None
+    ##########################
+    hardware = simulator.SimHardware(simulator.VirtualClock(time.time()))
+    rpiModule = types.ModuleType("RPi")
+    rpiModule.GPIO = hardware.module()
+    sys.modules["RPi"] = rpiModule
+    sys.modules["RPi.GPIO"] = rpiModule.GPIO
+    sys.modules["gphoto2"] = simulator.gphoto2Module(simulator.SimCamera(hardware))
+
+
+def timeCall(function, repeats):
+    # Median time of a call in seconds
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def benchProfile():
+    ######## benchProfile ########
+    # Function: Time building delay profiles, from the ramp and generated, with and without the profile cache
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    import motor
+    results = []
+    for steps in (1000, 30000, 60000):
+        duration = timeCall(lambda: motor.buildProfile.__wrapped__(steps, motor.MAX_FREQ), 50)
+        results.append(("profile build %d steps" % steps, duration*1e6, "us"))
+    duration = timeCall(lambda: motor.buildCurve.__wrapped__(60000, 6400.0, 6400.0, 32000.0), 50)
+    results.append(("S-curve build 60000 steps", duration*1e6, "us"))
+    motor.buildProfile(60000, motor.MAX_FREQ)
+    duration = timeCall(lambda: motor.buildProfile(60000, motor.MAX_FREQ), 1000)
+    results.append(("profile cached 60000 steps", duration*1e6, "us"))
+    return results
+
+
+def benchStepLoop():
+    ######## benchStepLoop ########
+    # Function: Measure the overhead of the Python step loop and the timing of its edges
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    import pulseBackend
+    recorder = EdgeRecorder()
+    savedGpio = pulseBackend.gpio
+    savedWatched = set(pulseBackend.switchMonitor.watched)
+    pulseBackend.gpio = recorder
+    try:
+        backend = pulseBackend.SleepBackend()
+
+        # With no delay every tick is pure loop overhead. Measured with the switches read on
+        # every tick, then with them watched by edge detection
+        ticks = 20000
+        tickTimes = []
+        for watched in (False, True):
+            if watched:
+                pulseBackend.switchMonitor.watch([3, 5])
+            else:
+                pulseBackend.switchMonitor.watched.difference_update([3, 5])
+            recorder.edges = []
+            backend.play([31], numpy.zeros(ticks), None, [3, 5], True)
+            edges = numpy.array(recorder.edges)
+            tickTimes.append((edges[-1] - edges[0])/(ticks - 1/2))
+        pollTime, tickTime = tickTimes
+
+        # At 2 kHz, compare the time between edges with the half period it should be
+        recorder.edges = []
+        delay = numpy.full(4000, 1/(2*2000))
+        startTime = time.perf_counter()
+        ticksSent, switchPin, elapsed = backend.play([31], delay, None, [3, 5], True)
+        edges = numpy.array(recorder.edges)
+        jitter = numpy.abs(numpy.diff(edges) - numpy.repeat(delay, 2)[:-1])*1e6
+        firstEdge = edges[0] - startTime
+        stretch = elapsed/(2*float(delay.sum())) - 1
+    finally:
+        pulseBackend.gpio = savedGpio
+        pulseBackend.switchMonitor.watched = savedWatched
+    return [("step loop overhead per tick", tickTime*1e6, "us"),
+            ("step loop overhead per tick, switches polled", pollTime*1e6, "us"),
+            ("first edge delay", firstEdge*1e6, "us"),
+            ("edge jitter median at 2 kHz", float(numpy.median(jitter)), "us"),
+            ("edge jitter p99 at 2 kHz", float(numpy.percentile(jitter, 99)), "us"),
+            ("edge jitter max at 2 kHz", float(numpy.max(jitter)), "us"),
+            ("pulse train stretch at 2 kHz", stretch*100, "%")]
+
+
+def benchPointing():
+    ######## benchPointing ########
+    # Function: Measure how fast pointing solutions are found, one at a time as calcRotation
+    #           does and for a whole schedule at once
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    from pointing import solvePointing
+    panLimits = (-180.0, 180.0)
+    tiltLimits = (-115.0, 10.0)
+    random = numpy.random.default_rng(0)
+    azimuth = random.uniform(0, 360, 10000)
+    elevation = random.uniform(0, 90, 10000)
+    single = timeCall(lambda: [solvePointing(az, el, panLimits, tiltLimits) for az, el in zip(azimuth[:1000], elevation[:1000])], 5)/1000
+    batch = timeCall(lambda: solvePointing(azimuth, elevation, panLimits, tiltLimits), 20)/len(azimuth)
+    return [("calcRotation single target", single*1e6, "us"),
+            ("calcRotation per target in batch", batch*1e6, "us")]
+
+
+def benchSchedule():
+    ######## benchSchedule ########
+    # Function: Time parsing a large schedule
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    from scheduleManager import Schedule
+    from datetime import datetime
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "schedule.csv")
+        simulator.writeSchedule(filename, datetime(2030, 1, 1), SCHEDULE_ROWS, 1)
+
+        def openSchedule():
+            with contextlib.redirect_stdout(io.StringIO()):
+                Schedule().open(filename)
+        duration = timeCall(openSchedule, 3)
+    return [("schedule open %d rows" % SCHEDULE_ROWS, duration*1e3, "ms")]
+
+
+def benchImport():
+    ######## benchImport ########
+    # Function: Time importing the motor module, which loads the acceleration ramp
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    import motor
+    duration = timeCall(lambda: importlib.reload(motor), 10)
+    return [("motor import (ramp load)", duration*1e3, "ms")]
+
+
+class InstantCamera:
+    # Camera that captures and downloads immediately, so only OS3's own overhead is measured
+    def capture(self, captureType):
+        return simulator.SimFilePath("/store", "IMG.JPG")
+
+    def file_get(self, folder, name, fileType):
+        return simulator.SimCameraFile(name)
+
+
+def benchCapture():
+    ######## benchCapture ########
+    # Function: Measure how late captures start and how long it takes a finished capture to
+    #           reach the log, through the capture thread and the event log
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    from cameraManager import CameraManager
+    from eventLog import EventLog
+    from timerScheduler import wallTime
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        eventLog = EventLog(directory)
+        logDelays = []
+        lateness = []
+
+        def onCapture(result):
+            eventLog.capture(result)
+            logDelays.append(wallTime() - result.completeTime)
+            lateness.append(result.triggerTime - result.scheduledTime)
+
+        manager = CameraManager(InstantCamera(), threading.Lock(), directory, onCapture)
+        start = wallTime() + 0.2
+        for i in range(CAPTURE_COUNT):
+            manager.queueCapture(start + i*CAPTURE_SPACING, "BENCH", i)
+        manager.close()
+        eventLog.close()
+    lateness = numpy.array(lateness)*1e6
+    logDelays = numpy.array(logDelays)*1e6
+    return [("capture trigger lateness median", float(numpy.median(lateness)), "us"),
+            ("capture trigger lateness max", float(numpy.max(lateness)), "us"),
+            ("capture to log median", float(numpy.median(logDelays)), "us"),
+            ("capture to log max", float(numpy.max(logDelays)), "us")]
+
+
+def benchQuickLook():
+    ######## benchQuickLook ########
+    # Function: Time the quick look of one full size image, and the time per image when a batch
+    #           goes through the worker pool
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - results: list of (name, value, unit)
+    ##########################
+    from quickLook import QuickLook, analyseFile
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(4):
+            paths.append(os.path.join(directory, "IMG_%04d.pgm" % i))
+            simulator.writeStarField(paths[-1], i, QUICKLOOK_SIZE)
+        single = timeCall(lambda: analyseFile(paths[0]), 3)
+
+        finished = threading.Semaphore(0)
+        quickLook = QuickLook(QUICKLOOK_WORKERS, QUICKLOOK_IMAGES, lambda result, stats, error: finished.release())
+        start = time.perf_counter()
+        for i in range(QUICKLOOK_IMAGES):
+            quickLook.submit(None, paths[i % len(paths)])
+        for i in range(QUICKLOOK_IMAGES):
+            finished.acquire()
+        duration = time.perf_counter() - start
+        quickLook.close()
+    return [("quick look 24 MP image", single*1e3, "ms"),
+            ("quick look pool per image (%d workers)" % QUICKLOOK_WORKERS, duration/QUICKLOOK_IMAGES*1e3, "ms")]
+
+
+BENCHMARKS = {
+    "profile": benchProfile,
+    "steploop": benchStepLoop,
+    "pointing": benchPointing,
+    "schedule": benchSchedule,
+    "import": benchImport,
+    "capture": benchCapture,
+    "quicklook": benchQuickLook,
+}
+
+
+def runBenchmarks(names):
+    ######## runBenchmarks ########
+    # Function: Run benchmarks by name
+    #
+    # Inputs:
+    # - names: list of keys of BENCHMARKS
+    #
+    # Return Values:
+    # - results: dictionary of result name to {"value", "unit"}
+    ##########################
+    results = {}
+    for name in names:
+        print("Running", name + "...")
+        for resultName, value, unit in BENCHMARKS[name]():
+            results[resultName] = {"value": value, "unit": unit}
+    return results
+
+
+def compare(results, baseline, threshold):
+    ######## compare ########
+    # Function: Print the results next to the baseline. Lower is better for every result
+    #
+    # Inputs:
+    # - results: dictionary from runBenchmarks
+    # - baseline: dictionary from runBenchmarks, or None
+    # - threshold: fractional slow down counted as a regression
+    #
+    # Return Values:
+    # - regressions: list of result names that got worse than the threshold
+    ##########################
+    regressions = []
+    print("%-40s %12s %12s %9s" % ("Benchmark", "Result", "Baseline", "Change"))
+    for name, result in results.items():
+        line = "%-40s %9.2f %-2s" % (name, result["value"], result["unit"])
+        if baseline is not None and name in baseline:
+            before = baseline[name]["value"]
+            line = line + " %9.2f %-2s" % (before, baseline[name]["unit"])
+            if before > 0:
+                change = (result["value"] - before)/before
+                line = line + " %+8.1f%%" % (100*change)
+                if change > threshold:
+                    regressions.append(name)
+                    line = line + "  REGRESSION"
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OS3 hot paths")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run (default all)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON file to compare against")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--output", help="also save the results to this JSON file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="fractional slow down counted as a regression")
+    arguments = parser.parse_args()
+
+    # The OS3 modules read ramp.csv from the current directory
+    os.chdir(simulator.PACKAGE_DIRECTORY)
+    installFakeModules()
+    results = runBenchmarks(arguments.only or list(BENCHMARKS))
+
+    baseline = None
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline, "r") as baselineFile:
+            baseline = json.load(baselineFile)["results"]
+    regressions = compare(results, baseline, arguments.threshold)
+
+    report = {"machine": platform.node(), "python": platform.python_version(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    if arguments.output:
+        with open(arguments.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    if arguments.save:
+        # Keep the baseline results of any benchmarks that weren't run this time
+        if baseline is not None:
+            report["results"] = dict(baseline, **results)
+        with open(arguments.baseline, "w") as baselineFile:
+            json.dump(report, baselineFile, indent=2)
+        print("Baseline saved to", arguments.baseline)
+
+    if regressions:
+        print(len(regressions), "regression(s) against", arguments.baseline)
+        sys.exit(1)
@@ -0,0 +1,237 @@
+import RPi.GPIO as gpio
+import gphoto2 as gp
+import os
+import queue
+import threading
+import time
+from imagingSequence import exposureSeconds
+from eventLog import nightName
+from timerScheduler import waitForTime, wallTime
+
+# Downloads don't start if a capture is due within this many seconds
+DOWNLOAD_GUARD = 2.0
+
+# Seconds to wait for each image of a burst beyond its exposure, before the rest are given up on
+BURST_FRAME_WAIT = 5.0
+
+
+class CaptureResult:
+    # Timing and file details of one exposure
+    __slots__ = ("satelliteName", "numInSequence", "scheduledTime", "settings", "frames", "sequence", "step",
+                 "triggerTime", "completeTime", "captureTime", "fileName", "folder", "error")
+
+    def __init__(self, satelliteName, numInSequence, scheduledTime, settings=None, frames=1, sequence="", step=0):
+        self.satelliteName = satelliteName
+        self.numInSequence = numInSequence
+        self.scheduledTime = scheduledTime
+        self.settings = settings        # Camera settings for this exposure, or None to leave them as they are
+        self.frames = frames            # Images taken by one trigger. More than 1 is a burst in the continuous drive mode
+        self.sequence = sequence        # Name of the imaging sequence, and the step of it this exposure is for
+        self.step = step
+        self.triggerTime = None
+        self.completeTime = None
+        self.captureTime = None         # Seconds from trigger to complete on the monotonic clock, as the system clock can jump
+        self.fileName = None
+        self.folder = None
+        self.error = None
+
+
+class CameraManager:
+    # Takes exposures at their scheduled times from a capture thread, and downloads finished
+    # images from the camera to local storage from a separate I/O thread. The I/O thread only
+    # uses the camera when no capture is due, so downloads never hold up a capture
+
+    def __init__(self, camera, cameraLock, imageDirectory, onCapture, indicatorPin=None, onDownload=None, cameraSettings=None):
+        ######## CameraManager ########
+        # Inputs:
+        # - camera: initialised gphoto2 camera object
+        # - cameraLock: lock shared by everything that uses the camera
+        # - imageDirectory: folder to download images to. Images are put in a sub folder per night
+        # - onCapture: function called with the CaptureResult after each exposure
+        # - indicatorPin: LED turned off during each exposure, or None
+        # - onDownload: function called with the CaptureResult and the saved path after each download, or None
+        # - cameraSettings: CameraSettings used to change settings between exposures, or None
+        ##########################
+        self.camera = camera
+        self.cameraLock = cameraLock
+        self.imageDirectory = imageDirectory
+        self.onCapture = onCapture
+        self.indicatorPin = indicatorPin
+        self.onDownload = onDownload
+        self.cameraSettings = cameraSettings
+        self.captureQueue = queue.Queue()
+        self.downloadQueue = queue.Queue()
+        # Scheduled times of the captures still to be taken
+        self.pendingTimes = []
+        self.pendingLock = threading.Lock()
+        self.captureThread = threading.Thread(target=self.captureWorker, daemon=True)
+        self.downloadThread = threading.Thread(target=self.downloadWorker, daemon=True)
+        self.captureThread.start()
+        self.downloadThread.start()
+
+
+    def queueCapture(self, imageTime, satelliteName, numInSequence, settings=None, frames=1, sequence="", step=0):
+        ######## queueCapture ########
+        # Function: Queue an exposure. Exposures must be queued in time order
+        #
+        # Inputs:
+        # - imageTime: UTC timestamp to start the exposure at
+        # - satelliteName: target name for the log file
+        # - numInSequence: sequence number for the log file. The images of a burst are numbered on from it
+        # - settings: optional. Camera settings (name to value) for the exposure. Only the ones that
+        #             differ from the last exposure are sent, before waiting for imageTime
+        # - frames: optional. Images to take with one trigger. The settings must put the camera in
+        #           its continuous drive mode for more than 1
+        # - sequence: optional. Name of the imaging sequence, for the log file
+        # - step: optional. Step of the sequence, for the log file
+        #
+        # Return Values: None
+        ##########################
+        with self.pendingLock:
+            self.pendingTimes.append(imageTime)
+        self.captureQueue.put(CaptureResult(satelliteName, numInSequence, imageTime, settings, frames, sequence, step))
+
+
+    def waitForCaptures(self):
+        ######## waitForCaptures ########
+        # Function: Wait until every queued exposure has been taken
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        self.captureQueue.join()
+
+
+    def close(self):
+        ######## close ########
+        # Function: Wait for queued captures and downloads to finish, then stop the threads
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        self.captureQueue.put(None)
+        self.captureThread.join()
+        self.downloadQueue.put(None)
+        self.downloadThread.join()
+
+
+    def captureWorker(self):
+        while True:
+            result = self.captureQueue.get()
+            if result is None:
+                self.captureQueue.task_done()
+                return
+            if result.settings and self.cameraSettings is not None:
+                with self.cameraLock:
+                    try:
+                        self.cameraSettings.apply(result.settings)
+                    except Exception as error:
+                        print("Error: Could not change camera settings (" + str(error) + ")")
+            waitForTime(result.scheduledTime)
+
+            ledOn = False
+            if self.indicatorPin is not None:
+                ledOn = gpio.input(self.indicatorPin)
+                gpio.output(self.indicatorPin, gpio.LOW)
+            results = [result]
+            with self.cameraLock:
+                result.triggerTime = wallTime()
+                captureStart = time.monotonic()
+                try:
+                    if result.frames > 1:
+                        results = self.captureBurst(result)
+                    else:
+                        filePath = self.camera.capture(gp.GP_CAPTURE_IMAGE)
+                        result.fileName = filePath.name
+                        result.folder = filePath.folder
+                except Exception as error:
+                    result.error = str(error)
+                result.completeTime = result.completeTime or wallTime()
+                if result.frames == 1:
+                    result.captureTime = time.monotonic() - captureStart
+            if ledOn:
+                gpio.output(self.indicatorPin, gpio.HIGH)
+
+            with self.pendingLock:
+                self.pendingTimes.remove(result.scheduledTime)
+            for frameResult in results:
+                if frameResult.error is None:
+                    self.downloadQueue.put(frameResult)
+                self.onCapture(frameResult)
+            self.captureQueue.task_done()
+
+
+    def captureBurst(self, result):
+        ######## captureBurst ########
+        # Function: Trigger the camera once in its continuous drive mode and collect the images as
+        #           they are written to its card. The caller must hold the camera lock
+        #
+        # Inputs:
+        # - result: CaptureResult of the burst, with triggerTime set. It becomes the first image
+        #
+        # Return Values:
+        # - results: CaptureResult of each image, numbered on from the first. They share the
+        #            trigger time, and each is complete when the camera reports its file
+        # Raises the gphoto2 error if the camera can't be reached
+        ##########################
+        exposure = exposureSeconds((result.settings or {}).get("shutterspeed", "")) or 0
+        self.camera.trigger_capture()
+        results = []
+        while len(results) < result.frames:
+            eventType, eventData = self.camera.wait_for_event(int(1000*(exposure + BURST_FRAME_WAIT)))
+            if eventType == gp.GP_EVENT_TIMEOUT:
+                break
+            if eventType != gp.GP_EVENT_FILE_ADDED:
+                continue
+            if results:
+                frameResult = CaptureResult(result.satelliteName, result.numInSequence + len(results), result.scheduledTime,
+                                            result.settings, result.frames, result.sequence, result.step)
+                frameResult.triggerTime = result.triggerTime
+            else:
+                frameResult = result
+            frameResult.fileName = eventData.name
+            frameResult.folder = eventData.folder
+            frameResult.completeTime = wallTime()
+            results.append(frameResult)
+        if len(results) < result.frames:
+            print("Warning: Burst gave", len(results), "of", result.frames, "images.")
+        if not results:
+            result.error = "No images from burst"
+            return [result]
+        return results
+
+
+    def nextCaptureTime(self):
+        with self.pendingLock:
+            if self.pendingTimes:
+                return min(self.pendingTimes)
+        return None
+
+
+    def downloadWorker(self):
+        while True:
+            result = self.downloadQueue.get()
+            if result is None:
+                return
+
+            # Leave the camera free for any capture that is about to start
+            nextCapture = self.nextCaptureTime()
+            while nextCapture is not None and nextCapture - wallTime() < DOWNLOAD_GUARD:
+                time.sleep(0.1)
+                nextCapture = self.nextCaptureTime()
+
+            night = nightName(result.triggerTime)
+            directory = os.path.join(self.imageDirectory, night)
+            path = os.path.join(directory, result.fileName)
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with self.cameraLock:
+                    cameraFile = self.camera.file_get(result.folder, result.fileName, gp.GP_FILE_TYPE_NORMAL)
+                cameraFile.save(path)
+            except Exception as error:
+                print("Error: Could not download", result.fileName, "(" + str(error) + ")")
+                continue
+            if self.onDownload is not None:
+                self.onDownload(result, path)
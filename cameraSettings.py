@@ -0,0 +1,89 @@
+import gphoto2 as gp
+
+
+class CameraSettings:
+    # Cached copy of the camera's configuration tree. The tree, and each setting's widget in it,
+    # are read from the camera once. After that only the settings that differ from the cached
+    # values are written, one at a time, instead of reading and writing the whole tree over USB.
+    # If a setting is changed on the camera itself, call reload()
+
+    def __init__(self, camera):
+        ######## CameraSettings ########
+        # Inputs:
+        # - camera: initialised gphoto2 camera object
+        ##########################
+        self.camera = camera
+        self.config = None
+        self.widgets = {}
+        # Older libgphoto2 versions and some camera drivers can only write the whole tree
+        self.singleConfig = hasattr(camera, "set_single_config")
+
+
+    def reload(self):
+        # Read the whole tree from the camera again. The caller must hold the camera lock
+        self.config = self.camera.get_config()
+        self.widgets = {}
+
+
+    def widget(self, name):
+        # Widget of a setting, from the cached tree. None if the camera doesn't have the setting
+        if self.config is None:
+            self.reload()
+        if name not in self.widgets:
+            OK, child = gp.gp_widget_get_child_by_name(self.config, name)
+            if OK < gp.GP_OK:
+                return None
+            self.widgets[name] = child
+        return self.widgets[name]
+
+
+    def value(self, name):
+        # Cached value of a setting, or None if the camera doesn't have it
+        widget = self.widget(name)
+        if widget is None:
+            return None
+        return widget.get_value()
+
+
+    def apply(self, settings):
+        ######## apply ########
+        # Function: Write settings to the camera, skipping any it already has. The caller must hold
+        #           the camera lock
+        #
+        # Inputs:
+        # - settings: dictionary of setting name (e.g. "shutterspeed", "aperture") to value (str)
+        #
+        # Return Values:
+        # - changed: names of the settings written
+        # Raises the gphoto2 error if the camera can't be reached
+        ##########################
+        changed = []
+        writeTree = False
+        try:
+            for name, value in settings.items():
+                widget = self.widget(name)
+                if widget is None:
+                    print("Warning: Camera has no", name, "setting.")
+                    continue
+                if widget.get_value() == value:
+                    continue
+                widget.set_value(value)
+                changed.append(name)
+                if not self.singleConfig:
+                    writeTree = True
+                    continue
+                try:
+                    self.camera.set_single_config(name, widget)
+                except gp.GPhoto2Error as error:
+                    if error.code != gp.GP_ERROR_NOT_SUPPORTED:
+                        raise
+                    self.singleConfig = False
+                    writeTree = True
+            if writeTree:
+                self.camera.set_config(self.config)
+        except Exception:
+            # The cached values may no longer match the camera, so read them again next time
+            self.config = None
+            self.widgets = {}
+            raise
+        return changed
@@ -0,0 +1,533 @@
+# Shares the passes of a night between several OS3 stations, so each pass is imaged by one
+# station that can reach it and the stations together image as many passes as possible.
+# Each station's agent (stationAgent.py) pulls its schedule over the local network at start up
+# and sends its capture results back while it runs. No internet connection is needed
+#
+# Usage: python3 coordinator.py stations.csv [--port 8700] [--results results]
+#        python3 coordinator.py stations.csv --simulate   (runs every station in the simulator)
+# Run python3 coordinator.py --help for the other options
+
+import argparse
+import ast
+import csv
+import http.server
+import io
+import itertools
+import json
+import os
+import threading
+import urllib.parse
+from datetime import datetime
+import numpy
+from durationModel import INITIAL_ERROR, MARGIN_SIGMAS
+from imagingSequence import parseSequence, planShots, sequenceSpan, exposureSeconds
+from pointing import solvePointing
+from scheduleManager import Schedule
+from schedulePlanner import planNight
+from timerScheduler import wallTime
+
+# Port the coordinator listens on
+COORDINATOR_PORT = 8700
+
+# Entries in different stations' schedules with the same catalog number and culmination times
+# this close together (in seconds) are the same pass
+PASS_WINDOW = 600
+
+# Every order of the stations is tried up to this many stations. Above it, the order in the file is used
+MAX_ORDERED_STATIONS = 6
+
+# Defaults for the optional columns of the stations file, from the OS3_1.0.py defaults.
+# Limits are mount angles in degrees. Speeds in degrees per second, accelerations in degrees per second squared
+DEFAULT_PAN_LIMITS = (-96.0, 96.0)
+DEFAULT_TILT_LIMITS = (-278.5, 26.8)
+DEFAULT_PAN_SPEED = 20.4
+DEFAULT_PAN_ACCEL = 20.4
+DEFAULT_TILT_SPEED = 30.9
+DEFAULT_TILT_ACCEL = 30.9
+DEFAULT_MIN_ELEVATION = 0.0
+DEFAULT_EXPOSURE = 8    # Shutter speed in seconds. The mount can't move on until the last exposure has finished
+
+# The stations' settings, which the imaging sequences ("SEQUENCES" and "DEFAULT_SEQUENCE") are read
+# from. Every station should have the same sequences
+STATION_SETTINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "OS3_1.0.py")
+
+# Time allowed on top of each image for the camera's capture time, as a station that hasn't
+# measured any images yet allows (in seconds)
+CAPTURE_MARGIN = MARGIN_SIGMAS*INITIAL_ERROR
+
+# Stations start each move just in time for the first image, allowing the predicted slew time plus
+# a margin. This is about the margin of a station that hasn't measured any moves yet (in seconds)
+SLEW_MARGIN = 8.0
+
+# Where the mount is parked at the start of the night (azimuth, elevation)
+PARK_POSITION = (0, -40)
+
+SCHEDULE_COLUMNS = 18
+RESULT_HEADER = ["Target", "Number in Sequence", "Scheduled Time", "Trigger Time", "Completion Time", "File Name", "Error"]
+
+
+class Station:
+    # One OS3 unit: the sky it can reach, how fast it slews, the passes it could image and the ones it was given
+
+    def __init__(self, name, scheduleFile, panLimits, tiltLimits, minElevation, exposure, panSpeed, panAccel, tiltSpeed, tiltAccel):
+        self.name = name
+        self.scheduleFile = scheduleFile
+        self.panLimits = panLimits
+        self.tiltLimits = tiltLimits
+        self.minElevation = minElevation
+        self.exposure = exposure
+        self.panSpeed = panSpeed
+        self.panAccel = panAccel
+        self.tiltSpeed = tiltSpeed
+        self.tiltAccel = tiltAccel
+        self.candidates = []    # ScheduleEntry objects from the station's own schedule
+        self.plan = []          # Entries assigned to the station, in time order
+        self.results = []       # Capture results sent back by the station's agent
+        self.lastReport = None  # When the agent last reported
+
+
+    def pointTargets(self, azimuth, elevation):
+        # planNight pointing function. Positions are mount angles in degrees
+        panValid, tiltValid, mountAzimuth, mountElevation, flipped = solvePointing(azimuth, elevation, self.panLimits, self.tiltLimits)
+        return panValid, tiltValid & (numpy.asarray(elevation) >= self.minElevation), mountAzimuth, mountElevation, flipped
+
+
+    def slewTime(self, panAngle, tiltAngle):
+        ######## slewTime ########
+        # Function: Estimate the time to slew through mount angles. Each axis accelerates at its
+        #           limit to its top speed, or as far as it can before it has to slow down again
+        #
+        # Inputs:
+        # - panAngle: array of pan angles to move through, in degrees
+        # - tiltAngle: array of tilt angles to move through, in degrees
+        #
+        # Return Values:
+        # - duration: time (in seconds) of each slew
+        ##########################
+        return numpy.maximum(axisTime(panAngle, self.panSpeed, self.panAccel),
+                             axisTime(tiltAngle, self.tiltSpeed, self.tiltAccel))
+
+
+    def passSpan(self, entry, sequences, defaultSequence):
+        ######## passSpan ########
+        # Function: Find when a pass keeps the mount busy, from the images of its imaging sequence.
+        #           The camera is taken to need its exposure time plus CAPTURE_MARGIN for each image
+        #
+        # Inputs:
+        # - entry: ScheduleEntry of the pass
+        # - sequences: dictionary of sequence name to list of SequenceStep, from loadSequences
+        # - defaultSequence: name of the sequence used if the entry doesn't name one
+        #
+        # Return Values:
+        # - firstShot: offset from culmination of the first image, in seconds
+        # - lastShot: offset from culmination of the end of the last image, in seconds
+        ##########################
+        steps = sequences.get(entry.sequence or defaultSequence, sequences[defaultSequence])
+
+        def exposure(step):
+            return exposureSeconds(step.shutterSpeed or entry.shutterSpeed or "") or self.exposure
+
+        return sequenceSpan(planShots(steps, exposure, lambda seconds: seconds, CAPTURE_MARGIN))
+
+
+def axisTime(angle, speed, accel):
+    # Trapezoidal (or triangular, for short moves) speed profile
+    angle = numpy.abs(numpy.asarray(angle, dtype=numpy.float64))
+    return numpy.where(angle < speed*speed/accel, 2*numpy.sqrt(angle/accel), angle/speed + speed/accel)
+
+
+def loadStations(filename):
+    ######## loadStations ########
+    # Function: Read the stations file and each station's schedule of candidate passes
+    #
+    # Inputs:
+    # - filename: CSV file with a header row. "Name" and "Schedule" are required. "Pan Min",
+    #             "Pan Max", "Tilt Min", "Tilt Max", "Min Elevation", "Exposure", "Pan Speed",
+    #             "Pan Accel", "Tilt Speed" and "Tilt Accel" are optional. Schedule paths are relative to the file
+    #
+    # Return Values:
+    # - stations: list of Station objects, or None if the file couldn't be read
+    ##########################
+    stations = []
+    directory = os.path.dirname(os.path.abspath(filename))
+    try:
+        with open(filename, "r", newline="") as stationsFile:
+            for row in csv.DictReader(stationsFile):
+                def value(column, default):
+                    if row.get(column, "") in ("", None):
+                        return default
+                    return float(row[column])
+                station = Station(row["Name"].strip(), os.path.join(directory, row["Schedule"].strip()),
+                                  (value("Pan Min", DEFAULT_PAN_LIMITS[0]), value("Pan Max", DEFAULT_PAN_LIMITS[1])),
+                                  (value("Tilt Min", DEFAULT_TILT_LIMITS[0]), value("Tilt Max", DEFAULT_TILT_LIMITS[1])),
+                                  value("Min Elevation", DEFAULT_MIN_ELEVATION), value("Exposure", DEFAULT_EXPOSURE),
+                                  value("Pan Speed", DEFAULT_PAN_SPEED), value("Pan Accel", DEFAULT_PAN_ACCEL),
+                                  value("Tilt Speed", DEFAULT_TILT_SPEED), value("Tilt Accel", DEFAULT_TILT_ACCEL))
+                schedule = Schedule()
+                if not schedule.open(station.scheduleFile):
+                    print("Error: No schedule for station", station.name)
+                station.candidates = schedule.entries
+                stations.append(station)
+    except (OSError, KeyError, ValueError) as error:
+        print("Error: Could not read stations file (" + str(error) + ")")
+        return None
+    return stations
+
+
+def loadSequences(filename):
+    ######## loadSequences ########
+    # Function: Read the imaging sequences from the stations' settings file, without running it
+    #
+    # Inputs:
+    # - filename: path of OS3_1.0.py
+    #
+    # Return Values:
+    # - sequences: dictionary of name to list of SequenceStep. Invalid sequences are left out, and
+    #              if the default is one of them, five images 10 seconds apart are used instead
+    # - defaultSequence: name of the sequence used when a schedule doesn't give one
+    ##########################
+    values = {}
+    try:
+        with open(filename, "r") as settingsFile:
+            tree = ast.parse(settingsFile.read(), filename)
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                if node.targets[0].id in ("SEQUENCES", "DEFAULT_SEQUENCE"):
+                    values[node.targets[0].id] = ast.literal_eval(node.value)
+    except (OSError, SyntaxError, ValueError) as error:
+        print("Error: Could not read the imaging sequences from", filename, "(" + str(error) + ")")
+    sequences = {}
+    for name, definition in values.get("SEQUENCES", {}).items():
+        try:
+            sequences[name] = parseSequence(definition)
+        except ValueError as error:
+            print("Error: Imaging sequence", name, "is invalid (" + str(error) + ")")
+    defaultSequence = values.get("DEFAULT_SEQUENCE", "standard")
+    if defaultSequence not in sequences:
+        print("Error: No default imaging sequence. Taking five images 10 seconds apart.")
+        sequences[defaultSequence] = parseSequence([{"offset": offset} for offset in (-20, -10, 0, 10, 20)])
+    return sequences, defaultSequence
+
+
+def matchPasses(stations):
+    ######## matchPasses ########
+    # Function: Find the entries in different stations' schedules that are the same pass
+    #
+    # Inputs:
+    # - stations: list of Station objects with their candidates loaded
+    #
+    # Return Values:
+    # - passes: list of dictionaries of station name to ScheduleEntry, one per pass, in time order
+    ##########################
+    passes = []
+    byCatalog = {}
+    entries = [(entry.time, station.name, entry) for station in stations for entry in station.candidates]
+    entries.sort(key=lambda item: item[0])
+    for entryTime, stationName, entry in entries:
+        match = None
+        for candidate in byCatalog.get(entry.catalogNumber, []):
+            if stationName not in candidate and abs(candidate["time"] - entryTime) <= PASS_WINDOW:
+                match = candidate
+                break
+        if match is None:
+            match = {"time": entryTime}
+            byCatalog.setdefault(entry.catalogNumber, []).append(match)
+            passes.append(match)
+        match[stationName] = entry
+    for satellitePass in passes:
+        del satellitePass["time"]
+    return passes
+
+
+def assignPasses(stations, passes, startTime, sequences, defaultSequence):
+    ######## assignPasses ########
+    # Function: Give each pass to at most one station so the most passes are imaged (weighted by
+    #           priority). Each station in turn plans its night with planNight from the passes no
+    #           earlier station took. Every order of the stations is tried and the best kept, so a
+    #           station that can reach passes no other can isn't crowded out by one that goes first
+    #
+    # Inputs:
+    # - stations: list of Station objects with their candidates loaded
+    # - passes: list of passes from matchPasses
+    # - startTime: timestamp from which the mounts are free to move
+    # - sequences, defaultSequence: imaging sequences from loadSequences, which set how long each
+    #                               pass keeps the mount
+    #
+    # Return Values:
+    # - covered: total priority of the passes assigned
+    # Each station's plan is set to the entries assigned to it
+    ##########################
+    passOf = {}
+    for index, satellitePass in enumerate(passes):
+        for entry in satellitePass.values():
+            passOf[id(entry)] = index
+
+    spanOf = {}
+    for station in stations:
+        for entry in station.candidates:
+            if entry.sequence is not None and entry.sequence not in sequences:
+                print("Warning: No imaging sequence called", entry.sequence, "for", entry.name, "at", station.name + ". Using", defaultSequence)
+            spanOf[id(entry)] = station.passSpan(entry, sequences, defaultSequence)
+
+    if len(stations) <= MAX_ORDERED_STATIONS:
+        orders = itertools.permutations(stations)
+    else:
+        orders = [stations]
+
+    bestCovered = -1.0
+    bestPlans = None
+    for order in orders:
+        taken = set()
+        plans = {}
+        covered = 0.0
+        for station in order:
+            candidates = [entry for entry in station.candidates if passOf[id(entry)] not in taken]
+            spans = [spanOf[id(entry)] for entry in candidates]
+            parked = station.pointTargets(*PARK_POSITION)
+            plan, dropped = planNight(candidates, startTime, (float(parked[2]), float(parked[3])),
+                                      station.pointTargets, lambda panAngle, tiltAngle, station=station: station.slewTime(panAngle, tiltAngle) + SLEW_MARGIN,
+                                      firstShot=[span[0] for span in spans], lastShot=[span[1] for span in spans], moveLead=None)
+            for entry in plan:
+                taken.add(passOf[id(entry)])
+                covered = covered + entry.priority
+            plans[station.name] = plan
+        if covered > bestCovered:
+            bestCovered = covered
+            bestPlans = plans
+
+    for station in stations:
+        station.plan = bestPlans[station.name]
+    return bestCovered
+
+
+def scheduleText(entries):
+    # Write entries as a schedule file in the format OS3_1.0.py reads, with the optional columns
+    header = [""] * SCHEDULE_COLUMNS
+    header[0] = "Sat Name"
+    header[1] = "Catalog No"
+    header[10] = "Culmination AZ (deg)"
+    header[11] = "Culmination EL (deg)"
+    header[13] = "Culmination Date"
+    header[14] = "Priority"
+    header[15] = "Shutter Speed"
+    header[16] = "Aperture"
+    header[17] = "Sequence"
+    lines = [header]
+    for entry in entries:
+        row = [""] * SCHEDULE_COLUMNS
+        row[0] = entry.name
+        row[1] = entry.catalogNumber
+        row[10] = "%.4f" % entry.azimuth
+        row[11] = "%.4f" % entry.elevation
+        row[13] = entry.timeString
+        row[14] = "%g" % entry.priority
+        row[15] = entry.shutterSpeed or ""
+        row[16] = entry.aperture or ""
+        row[17] = entry.sequence or ""
+        lines.append(row)
+    text = io.StringIO()
+    csv.writer(text, lineterminator="\r\n").writerows(lines)
+    return text.getvalue()
+
+
+class Coordinator:
+    # Serves each station its schedule and collects the capture results the stations send back
+
+    def __init__(self, stations, resultsDirectory):
+        self.stations = {station.name: station for station in stations}
+        # The simulator changes directory for each station, so the path is fixed here
+        self.resultsDirectory = os.path.abspath(resultsDirectory)
+        self.lock = threading.Lock()
+        self.server = None
+        os.makedirs(resultsDirectory, exist_ok=True)
+
+
+    def addResults(self, station, results):
+        ######## addResults ########
+        # Function: Store capture results sent by a station, in memory and in <station>.csv
+        #
+        # Inputs:
+        # - station: Station the results are from
+        # - results: list of result dictionaries from the station's agent
+        #
+        # Return Values: None
+        ##########################
+        path = os.path.join(self.resultsDirectory, station.name + ".csv")
+        with self.lock:
+            station.results.extend(results)
+            station.lastReport = wallTime()
+            try:
+                with open(path, "a", newline="") as resultsFile:
+                    writer = csv.writer(resultsFile)
+                    if resultsFile.tell() == 0:
+                        writer.writerow(RESULT_HEADER)
+                    for result in results:
+                        writer.writerow([result.get("target"), result.get("image"), result.get("scheduled"),
+                                         result.get("trigger"), result.get("complete"), result.get("file"), result.get("error") or ""])
+            except OSError as error:
+                print("Error: Could not write results for", station.name, "(" + str(error) + ")")
+
+
+    def status(self):
+        # Summary of every station, for /status and the end of a simulation
+        with self.lock:
+            stations = {}
+            for name, station in self.stations.items():
+                images = [result for result in station.results if not result.get("error")]
+                stations[name] = {"assigned": len(station.plan),
+                                  "targets": len({result.get("target") for result in images}),
+                                  "images": len(images),
+                                  "errors": len(station.results) - len(images),
+                                  "lastReport": station.lastReport}
+            return {"stations": stations}
+
+
+    def serve(self, address, port):
+        ######## serve ########
+        # Function: Answer the station agents from a background thread.
+        #           GET /schedule/<station>: the station's schedule file.
+        #           POST /results/<station>: JSON list of capture results.
+        #           GET /status: JSON summary of every station
+        #
+        # Inputs:
+        # - address: address to listen on. "" listens on every interface
+        # - port: TCP port to listen on
+        #
+        # Return Values:
+        # - success: False if the port couldn't be opened
+        ##########################
+        coordinator = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def reply(self, code, contentType, body):
+                body = body.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def station(self, prefix):
+                # Station agents quote the name, as it can have spaces in it
+                station = coordinator.stations.get(urllib.parse.unquote(self.path[len(prefix):]))
+                if station is None:
+                    self.send_error(404, "Unknown station")
+                return station
+
+            def do_GET(self):
+                if self.path.startswith("/schedule/"):
+                    station = self.station("/schedule/")
+                    if station is not None:
+                        print("Sending", len(station.plan), "targets to", station.name)
+                        self.reply(200, "text/csv", scheduleText(station.plan))
+                elif self.path == "/status":
+                    self.reply(200, "application/json", json.dumps(coordinator.status()))
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                if not self.path.startswith("/results/"):
+                    self.send_error(404)
+                    return
+                station = self.station("/results/")
+                if station is None:
+                    return
+                try:
+                    results = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                except ValueError:
+                    self.send_error(400, "Invalid results")
+                    return
+                coordinator.addResults(station, results)
+                self.reply(200, "application/json", json.dumps({"received": len(results)}))
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        except OSError as error:
+            print("Error: Could not start coordinator on port", port, "(" + str(error) + ")")
+            return False
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return True
+
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def printAssignment(stations, passes, covered):
+    print("========== Assignment ==========")
+    for station in stations:
+        reachable = int(numpy.count_nonzero(numpy.logical_and(*station.pointTargets(
+            numpy.array([entry.azimuth for entry in station.candidates]),
+            numpy.array([entry.elevation for entry in station.candidates]))[:2]))) if station.candidates else 0
+        print("%-16s %4d of %4d candidates (%d reachable)" % (station.name, len(station.plan), len(station.candidates), reachable))
+    assigned = sum(len(station.plan) for station in stations)
+    print("Passes imaged: %d of %d (priority %g)" % (assigned, len(passes), covered))
+    print("================================")
+
+
+def simulateStations(stations, coordinatorUrl, outputDirectory, verbose):
+    ######## simulateStations ########
+    # Function: Run a night of every station in the simulator, one after the other, each pulling
+    #           its schedule from the coordinator and sending back its results
+    #
+    # Inputs:
+    # - stations: list of Station objects
+    # - coordinatorUrl: address of the running coordinator
+    # - outputDirectory: each station runs in a sub folder of this (logs, images and timeline)
+    # - verbose: show the OS3 output
+    #
+    # Return Values: None
+    ##########################
+    import simulator
+    for station in stations:
+        print("Simulating", station.name + "...")
+        settings = {"COORDINATOR_URL": repr(coordinatorUrl), "STATION_NAME": repr(station.name)}
+        simulator.simulate(os.path.join(outputDirectory, station.name), station.scheduleFile,
+                           settings=settings, calibrated=True, verbose=verbose)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share the passes of a night between several OS3 stations")
+    parser.add_argument("stations", help="stations CSV file")
+    parser.add_argument("--address", default="", help="address to listen on. Every interface by default")
+    parser.add_argument("--port", type=int, default=COORDINATOR_PORT, help="port to listen on")
+    parser.add_argument("--results", default="results", help="folder the capture results of each station are saved in")
+    parser.add_argument("--start", help="UTC time the mounts are free to move, YYYY-MM-DD HH:MM:SS. Defaults to now")
+    parser.add_argument("--simulate", action="store_true", help="run every station in the simulator instead of waiting for real stations")
+    parser.add_argument("--verbose", action="store_true", help="show the OS3 output of simulated stations")
+    arguments = parser.parse_args()
+
+    stations = loadStations(arguments.stations)
+    if not stations:
+        exit(1)
+    if arguments.start:
+        startTime = datetime.fromisoformat(arguments.start).timestamp()
+    else:
+        startTime = wallTime()
+    sequences, defaultSequence = loadSequences(STATION_SETTINGS)
+    passes = matchPasses(stations)
+    covered = assignPasses(stations, passes, startTime, sequences, defaultSequence)
+    printAssignment(stations, passes, covered)
+
+    coordinator = Coordinator(stations, arguments.results)
+    if not coordinator.serve(arguments.address, arguments.port):
+        exit(1)
+    if arguments.simulate:
+        simulateStations(stations, "http://127.0.0.1:" + str(arguments.port), os.path.join(arguments.results, "simulated"), arguments.verbose)
+        print("========== Results ==========")
+        for name, summary in coordinator.status()["stations"].items():
+            print("%-16s %4d assigned, %4d imaged, %5d images, %d errors" % (name, summary["assigned"], summary["targets"], summary["images"], summary["errors"]))
+        coordinator.close()
+    else:
+        print("Coordinator listening on port", arguments.port, "(ctrl + c to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            coordinator.close()
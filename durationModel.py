@@ -0,0 +1,143 @@
+import csv
+import math
+import os
+
+# Weight kept by the older measurements each time one is recorded, so the model follows slow changes
+# (another pulse backend, a heavier camera) without being thrown by one odd move or capture
+MODEL_MEMORY = 0.95
+
+# A scale is only fitted once this many measurements have been made, and their nominal times spread
+# by at least MIN_FIT_SPREAD seconds (standard deviation). Until then only an offset is learnt
+MIN_FIT_COUNT = 5
+MIN_FIT_SPREAD = 1.0
+
+# Limits on the fitted scale, in case of a run of bad measurements
+SCALE_LIMITS = (0.8, 2.0)
+
+# Prediction error (standard deviation, seconds) assumed before anything is measured
+INITIAL_ERROR = 1.0
+
+# The margin allowed for the model's own error, in standard deviations
+MARGIN_SIGMAS = 3.0
+
+FIELDS = ("count", "weight", "meanNominal", "meanActual", "varianceNominal", "covariance", "errorVariance")
+
+
+class DurationModel:
+    # Predicts how long something really takes from its nominal time: a move from the time of its
+    # motion profile, or a capture from its exposure. Real moves take longer than their profile
+    # (thread start up, lock waits, the step loop and the pulse backend), and captures longer than
+    # their exposure (shutter and readout), by amounts that depend on the hardware. So
+    # actual = offset + scale*nominal is fitted to every measurement, weighted towards the latest,
+    # and saved so it carries on between runs
+
+    def __init__(self, filename):
+        ######## DurationModel ########
+        # Inputs:
+        # - filename: file the model is saved to. Loaded if it exists
+        ##########################
+        self.filename = filename
+        self.count = 0
+        self.weight = 0.0
+        self.meanNominal = 0.0
+        self.meanActual = 0.0
+        self.varianceNominal = 0.0
+        self.covariance = 0.0
+        self.errorVariance = INITIAL_ERROR**2
+        self.load()
+
+
+    def coefficients(self):
+        ######## coefficients ########
+        # Function: Find the offset and scale of the fitted model
+        #
+        # Inputs: None
+        #
+        # Return Values:
+        # - offset: seconds added to every nominal time
+        # - scale: actual time per nominal second
+        ##########################
+        scale = 1.0
+        if self.count >= MIN_FIT_COUNT and self.varianceNominal >= MIN_FIT_SPREAD**2:
+            scale = min(max(self.covariance/self.varianceNominal, SCALE_LIMITS[0]), SCALE_LIMITS[1])
+        offset = self.meanActual - scale*self.meanNominal if self.count > 0 else 0.0
+        return offset, scale
+
+
+    def predict(self, nominalTime):
+        ######## predict ########
+        # Function: Predict how long things take. Accepts single values or numpy arrays
+        #
+        # Inputs:
+        # - nominalTime: nominal time of each, e.g. the motion profile time from slewDuration
+        #
+        # Return Values:
+        # - duration: predicted time (in seconds) of each
+        ##########################
+        offset, scale = self.coefficients()
+        return offset + scale*nominalTime
+
+
+    def margin(self):
+        # Time to allow for the model's error, from how far off its recent predictions were
+        return MARGIN_SIGMAS*math.sqrt(self.errorVariance)
+
+
+    def record(self, nominalTime, actualTime):
+        ######## record ########
+        # Function: Add a measurement to the model. It is kept in memory until save() is called, so
+        #           the capture thread can record without waiting for the SD card
+        #
+        # Inputs:
+        # - nominalTime: nominal time, e.g. of the move's motion profile
+        # - actualTime: time it took
+        #
+        # Return Values: None
+        ##########################
+        error = actualTime - self.predict(nominalTime)
+        self.weight = MODEL_MEMORY*self.weight + 1.0
+        share = 1.0/self.weight
+        # Exponentially weighted means, variance and covariance, updated in one pass
+        nominalStep = nominalTime - self.meanNominal
+        actualStep = actualTime - self.meanActual
+        self.meanNominal = self.meanNominal + share*nominalStep
+        self.meanActual = self.meanActual + share*actualStep
+        self.varianceNominal = (1 - share)*(self.varianceNominal + share*nominalStep*nominalStep)
+        self.covariance = (1 - share)*(self.covariance + share*nominalStep*actualStep)
+        if self.count == 0:
+            self.errorVariance = max(self.errorVariance, error*error)
+        else:
+            self.errorVariance = self.errorVariance + share*(error*error - self.errorVariance)
+        self.count = self.count + 1
+
+
+    def load(self):
+        try:
+            with open(self.filename, "r", newline="") as modelFile:
+                values = {row[0]: float(row[1]) for row in csv.reader(modelFile) if len(row) == 2}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            print("Error: Could not read", self.filename, "(" + str(error) + ")")
+            return
+        if any(field not in values for field in FIELDS):
+            print("Error:", self.filename, "is incomplete.")
+            return
+        for field in FIELDS:
+            setattr(self, field, values[field])
+        self.count = int(self.count)
+
+
+    def save(self):
+        # Replaced in one step, like the mount state, so a power cut leaves the old or the new model
+        tempName = self.filename + ".tmp"
+        try:
+            with open(tempName, "w", newline="") as modelFile:
+                writer = csv.writer(modelFile)
+                for field in FIELDS:
+                    writer.writerow([field, getattr(self, field)])
+                modelFile.flush()
+                os.fsync(modelFile.fileno())
+            os.replace(tempName, self.filename)
+        except OSError as error:
+            print("Error: Could not save", self.filename, "(" + str(error) + ")")
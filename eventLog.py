@@ -0,0 +1,167 @@
+import csv
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from timerScheduler import wallTime
+
+# Log files change over at this UTC hour, so a whole night goes in one file
+NIGHT_ROLLOVER_HOUR = 12
+
+# Flush and sync the files to disk once this many lines are waiting, or this many seconds have passed
+FLUSH_LINES = 50
+FLUSH_INTERVAL = 5.0
+
+# Largest number of entries waiting to be written. Entries are dropped rather than blocking the caller
+QUEUE_SIZE = 1000
+
+CAPTURE_HEADER = "File Name, Target, Time, Number in Sequence, Trigger Time, Completion Time, Sequence, Step"
+EVENT_HEADER = "Time, Event, Target, Details"
+
+# Names of the capture and event logs of a night
+LOG_FILE_PATTERN = re.compile(r"\d{8}(_events)?\.csv$")
+
+
+def nightName(timestamp):
+    ######## nightName ########
+    # Function: Name of the night a time falls in, used for the log files and the image folders
+    #
+    # Inputs:
+    # - timestamp: wall clock time in seconds
+    #
+    # Return Values:
+    # - the date the night started on, as YYYYMMDD
+    ##########################
+    night = datetime.fromtimestamp(timestamp) - timedelta(hours=NIGHT_ROLLOVER_HOUR)
+    return night.strftime("%Y%m%d")
+
+
+class EventLog:
+    # Capture log and structured event log, written by a background thread. Logging only puts an
+    # entry on a queue, so the capture and motion code never waits for the SD card
+
+    def __init__(self, directory="."):
+        ######## EventLog ########
+        # Inputs:
+        # - directory: folder the log files are written to
+        ##########################
+        self.directory = directory
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
+        # Every file written to, so they can be copied off at the end of the night
+        self.files = set()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+
+    def capture(self, result):
+        ######## capture ########
+        # Function: Log a finished exposure
+        #
+        # Inputs:
+        # - result: CaptureResult of the exposure
+        #
+        # Return Values: None
+        ##########################
+        self.put(("capture", result.triggerTime, result))
+
+
+    def event(self, kind, target="", **details):
+        ######## event ########
+        # Function: Log an event (move start/end, skip, error, timing, ...)
+        #
+        # Inputs:
+        # - kind: short name of the event
+        # - target: name of the target the event is for, if any
+        # - details: any other values to record
+        #
+        # Return Values: None
+        ##########################
+        self.put(("event", wallTime(), (kind, target, details)))
+
+
+    def put(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+
+    def close(self):
+        ######## close ########
+        # Function: Write everything still queued, sync the files and stop the thread
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def openFile(self, openFiles, name, header):
+        # Open a log file for appending, writing the header if it is new
+        if name in openFiles:
+            return openFiles[name]
+        path = os.path.join(self.directory, name)
+        logFile = open(path, "a", newline="")
+        if logFile.tell() == 0:
+            logFile.write(header)
+        openFiles[name] = logFile
+        self.files.add(path)
+        return logFile
+
+
+    def writer(self):
+        openFiles = {}
+        waiting = 0
+        lastSync = time.monotonic()
+        running = True
+        while running:
+            try:
+                entry = self.queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                entry = False
+            if entry is None:
+                running = False
+            elif entry:
+                kind, timestamp, data = entry
+                night = nightName(timestamp)
+                entryTime = datetime.fromtimestamp(timestamp)
+                try:
+                    if kind == "capture":
+                        logFile = self.openFile(openFiles, night + ".csv", CAPTURE_HEADER)
+                        logFile.write("\n" + data.fileName + "," + data.satelliteName + "," + entryTime.strftime("%H:%M:%S") + "," + str(data.numInSequence)
+                                      + "," + entryTime.strftime("%H:%M:%S.%f") + "," + datetime.fromtimestamp(data.completeTime).strftime("%H:%M:%S.%f")
+                                      + "," + data.sequence + "," + str(data.step))
+                    else:
+                        eventKind, target, details = data
+                        logFile = self.openFile(openFiles, night + "_events.csv", EVENT_HEADER)
+                        detailText = ";".join(key + "=" + str(value) for key, value in details.items())
+                        logFile.write("\n")
+                        csv.writer(logFile, lineterminator="").writerow([entryTime.strftime("%Y-%m-%d %H:%M:%S.%f"), eventKind, target, detailText])
+                    waiting = waiting + 1
+                except OSError as error:
+                    print("Error: Could not write log file (" + str(error) + ")")
+
+            # Flush in batches so the files survive a power cut without syncing every line
+            if waiting and (waiting >= FLUSH_LINES or time.monotonic() - lastSync >= FLUSH_INTERVAL or not running):
+                for logFile in openFiles.values():
+                    try:
+                        logFile.flush()
+                        os.fsync(logFile.fileno())
+                    except OSError as error:
+                        print("Error: Could not sync log file (" + str(error) + ")")
+                waiting = 0
+                lastSync = time.monotonic()
+
+            # Close the files from previous nights
+            if entry:
+                for name in list(openFiles):
+                    if not name.startswith(night):
+                        openFiles.pop(name).close()
+
+        for logFile in openFiles.values():
+            logFile.close()
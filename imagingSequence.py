@@ -0,0 +1,188 @@
+import math
+
+# Seconds left between one image finishing and the next starting, for the capture thread to change
+# settings and get ready for the next image
+FRAME_GAP = 0.2
+
+# Keys a step of a sequence can have
+STEP_KEYS = ("offset", "count", "until", "interval", "shutterSpeed", "aperture", "burst")
+
+
+class SequenceStep:
+    # One step of an imaging sequence: one or more images from a time relative to culmination
+    __slots__ = STEP_KEYS
+
+    def __init__(self, offset, count=None, until=None, interval=None, shutterSpeed=None, aperture=None, burst=False):
+        self.offset = offset            # Seconds from culmination of the first image
+        self.count = count              # Images to take, or None for as many as fit before until
+        self.until = until              # Seconds from culmination by which the images must be finished, or None
+        self.interval = interval        # Seconds between the starts of the images, or None for as close as the camera allows
+        self.shutterSpeed = shutterSpeed    # Camera settings for the step, or None for the target's
+        self.aperture = aperture
+        self.burst = burst              # Take the images with one trigger in the camera's continuous drive mode
+
+
+class Shot:
+    # One trigger of the camera: a single image, or a burst of images in the continuous drive mode
+    __slots__ = ("offset", "step", "frames", "shutterSpeed", "aperture", "burst", "duration")
+
+    def __init__(self, offset, step, frames, shutterSpeed, aperture, burst, duration):
+        self.offset = offset        # Seconds from culmination
+        self.step = step            # Index of the sequence step it belongs to
+        self.frames = frames        # Images taken by the trigger
+        self.shutterSpeed = shutterSpeed
+        self.aperture = aperture
+        self.burst = burst
+        self.duration = duration    # Predicted time until the last image is finished, with the margin
+
+
+def exposureSeconds(shutterSpeed):
+    ######## exposureSeconds ########
+    # Function: Find the length of an exposure from a gphoto2 shutter speed
+    #
+    # Inputs:
+    # - shutterSpeed: shutter speed as the camera writes it, e.g. "1/250", "8" or "2.5"
+    #
+    # Return Values:
+    # - seconds: exposure time, or None if it isn't a time (e.g. "bulb")
+    ##########################
+    try:
+        if "/" in shutterSpeed:
+            numerator, denominator = shutterSpeed.split("/")
+            return float(numerator)/float(denominator)
+        return float(shutterSpeed.rstrip("s"))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def parseSequence(definition):
+    ######## parseSequence ########
+    # Function: Check a sequence definition and convert it to steps
+    #
+    # Inputs:
+    # - definition: list of dictionaries, one per step, with the keys in STEP_KEYS. Only "offset"
+    #               is needed, e.g. [{"offset": -20}, {"offset": 0, "count": 5, "burst": True}]
+    #
+    # Return Values:
+    # - steps: list of SequenceStep, in time order
+    # Raises ValueError saying what is wrong with the definition
+    ##########################
+    if not isinstance(definition, (list, tuple)) or len(definition) == 0:
+        raise ValueError("a sequence must be a list of at least one step")
+    steps = []
+    for number, values in enumerate(definition, 1):
+        if not isinstance(values, dict):
+            raise ValueError("step %d is not a dictionary" % number)
+        unknown = set(values) - set(STEP_KEYS)
+        if unknown:
+            raise ValueError("step %d has unknown keys: %s" % (number, ", ".join(sorted(unknown))))
+        if "offset" not in values:
+            raise ValueError("step %d has no offset" % number)
+        try:
+            step = SequenceStep(**values)
+        except TypeError as error:
+            raise ValueError("step %d: %s" % (number, error))
+        for name in ("offset", "until", "interval"):
+            value = getattr(step, name)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError("step %d: %s must be a number of seconds" % (number, name))
+        if step.count is not None and (isinstance(step.count, bool) or not isinstance(step.count, int) or step.count < 1):
+            raise ValueError("step %d: count must be a whole number of at least 1" % number)
+        if step.until is not None and step.until <= step.offset:
+            raise ValueError("step %d: until must be after the offset" % number)
+        if step.interval is not None and step.interval <= 0:
+            raise ValueError("step %d: interval must be more than 0" % number)
+        if step.burst and step.interval is not None:
+            raise ValueError("step %d: the camera sets the interval of a burst" % number)
+        for name in ("shutterSpeed", "aperture"):
+            if getattr(step, name) is not None and not isinstance(getattr(step, name), str):
+                raise ValueError("step %d: %s must be a string, as the camera writes it" % (number, name))
+        if steps and step.offset < steps[-1].offset:
+            raise ValueError("step %d starts before step %d" % (number, number - 1))
+        steps.append(step)
+    return steps
+
+
+def planShots(steps, exposure, captureTime, margin=0.0):
+    ######## planShots ########
+    # Function: Work out the camera triggers of a sequence. Steps with an until and no count are
+    #           packed with as many images as fit, from how long the camera takes for each image.
+    #           A step is clipped so its images after the first finish before the next step starts.
+    #           The first image of each step is always kept, even if the one before runs into it
+    #           (checkShots finds these)
+    #
+    # Inputs:
+    # - steps: list of SequenceStep
+    # - exposure: function taking a step and returning its exposure in seconds
+    # - captureTime: function taking an exposure in seconds and returning the time the camera takes
+    #                to capture and read out one image
+    # - margin: optional. Seconds added to each trigger (once for a whole burst) for the error
+    #           of captureTime
+    #
+    # Return Values:
+    # - shots: list of Shot, in time order
+    ##########################
+    shots = []
+    for index, step in enumerate(steps):
+        frameTime = captureTime(exposure(step))
+        spacing = frameTime + margin + FRAME_GAP
+        if step.interval is not None:
+            spacing = max(spacing, step.interval)
+        count = 1 if step.count is None and step.until is None else step.count
+        # The last image must be finished by until, and by the start of the next step
+        end = step.until
+        if index + 1 < len(steps):
+            nextStart = steps[index + 1].offset - FRAME_GAP
+            end = nextStart if end is None else min(end, nextStart)
+        if end is not None:
+            if step.burst:
+                fits = int(math.floor((end - step.offset - margin)/frameTime + 1e-9))
+            else:
+                fits = int(math.floor((end - step.offset - frameTime - margin)/spacing + 1e-9)) + 1
+            fits = max(fits, 1 if step.until is None else 0)
+            count = fits if count is None else min(count, fits)
+        if count == 0:
+            continue
+        if step.burst:
+            shots.append(Shot(step.offset, index, count, step.shutterSpeed, step.aperture, True, count*frameTime + margin))
+        else:
+            for frame in range(count):
+                shots.append(Shot(step.offset + frame*spacing, index, 1, step.shutterSpeed, step.aperture, False, frameTime + margin))
+    # The camera takes them in the order they are queued
+    shots.sort(key=lambda shot: shot.offset)
+    return shots
+
+
+def checkShots(steps, shots, margin=0.0):
+    ######## checkShots ########
+    # Function: Find the problems with a planned sequence: images that will still be being taken
+    #           when the next one is due, so it starts late, and steps that have room for fewer
+    #           images than their count
+    #
+    # Inputs:
+    # - steps: list of SequenceStep the shots were planned from
+    # - shots: list of Shot from planShots
+    # - margin: optional. The margin given to planShots. Only the predicted time itself counts as
+    #           running into the next image
+    #
+    # Return Values:
+    # - problems: list of strings describing each problem. Empty if there are none
+    ##########################
+    problems = []
+    for shot, nextShot in zip(shots, shots[1:]):
+        overrun = shot.offset + shot.duration - margin + FRAME_GAP - nextShot.offset
+        if overrun > 1e-6:
+            problems.append("The image at %+g seconds runs %.1f seconds into the one at %+g seconds"
+                            % (shot.offset, overrun, nextShot.offset))
+    for index, step in enumerate(steps):
+        frames = sum(shot.frames for shot in shots if shot.step == index)
+        if step.count is not None and frames < step.count:
+            problems.append("Step %d has room for %d of its %d images" % (index + 1, frames, step.count))
+    return problems
+
+
+def sequenceSpan(shots):
+    # Offsets from culmination of the first image and of the end of the last one
+    if not shots:
+        return 0.0, 0.0
+    return shots[0].offset, max(shot.offset + shot.duration for shot in shots)
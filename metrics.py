@@ -0,0 +1,201 @@
+import http.server
+import os
+import threading
+import time
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def labelText(labels):
+    # Prometheus label set, e.g. {reason="Pass already started"}
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(name + "=\"" + value + "\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+def numberText(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    # Count that only goes up, e.g. captures taken. One value per set of labels
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.kind = "counter"
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge:
+    # Value that goes up and down. Either set directly, or read from a function when scraped
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.kind = "gauge"
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                return []
+            if value is None:
+                return []
+            return [(self.name, (), value)]
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram:
+    # Distribution of observed values, counted into buckets with upper bounds
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.kind = "histogram"
+        self.buckets = sorted(buckets) + [float("inf")]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] = counts[i] + 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + "_bucket", key + (("le", numberText(bound)),), count))
+                samples.append((self.name + "_sum", key, total))
+                samples.append((self.name + "_count", key, counts[-1]))
+        return samples
+
+
+class Metrics:
+    # Collection of metrics, rendered in the Prometheus text format and optionally served over HTTP
+
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        ######## render ########
+        # Function: Write out every metric in the Prometheus text exposition format
+        #
+        # Inputs: None
+        #
+        # Return Values:
+        # - text: the metrics, one sample per line
+        ##########################
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            for name, labels, value in metric.samples():
+                lines.append(name + labelText(labels) + " " + numberText(value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address, port):
+        ######## serve ########
+        # Function: Serve the metrics at http://address:port/metrics from a background thread
+        #
+        # Inputs:
+        # - address: address to listen on. "" listens on every interface
+        # - port: TCP port to listen on
+        #
+        # Return Values:
+        # - success: False if the port couldn't be opened
+        ##########################
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would fill the console otherwise
+                pass
+
+        try:
+            self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        except OSError as error:
+            print("Error: Could not start metrics server on port", port, "(" + str(error) + ")")
+            return False
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return True
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def loadAverage():
+    # One minute load average of the whole system, or None where it isn't available
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return None
+
+
+def processCpuTime():
+    # CPU time used by this process (all threads), in seconds
+    return time.process_time()
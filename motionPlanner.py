@@ -0,0 +1,167 @@
+import RPi.GPIO as gpio
+import time
+import numpy
+from motor import buildCurve, profileDuration, curveDuration
+
+
+def bresenhamMask(steps, ticks):
+    ######## bresenhamMask ########
+    # Function: Spread an axis' steps evenly over the ticks of the move, Bresenham style
+    #
+    # Inputs:
+    # - steps: number of steps the axis needs to make
+    # - ticks: number of ticks in the move (steps of the axis with the furthest to go)
+    #
+    # Return Values:
+    # - mask: boolean array, True on the ticks where this axis steps
+    ##########################
+    if ticks == 0:
+        return numpy.zeros(0, dtype=bool)
+    tick = numpy.arange(1, ticks + 1, dtype=numpy.int64)
+    # The axis steps whenever the accumulated fraction of its distance passes a whole step
+    return (tick*steps)//ticks > ((tick - 1)*steps)//ticks
+
+
+def timelineLimits(axes, steps, targetSpeed):
+    ######## timelineLimits ########
+    # Function: Find the pulse frequency limits of a move shared by several axes. An axis that
+    #           steps on a fraction of the ticks runs at that fraction of the tick rate, so its
+    #           limits are divided by the fraction. The tightest limit of all the axes is used.
+    #           Works on numpy arrays of step counts
+    #
+    # Inputs:
+    # - axes: list of motor objects
+    # - steps: steps each axis makes in the move
+    # - targetSpeed: speed (in RPM) for the axis with the furthest to go, or None for its maxSpeed
+    #
+    # Return Values:
+    # - ticks: ticks in the move (steps of the axis with the furthest to go)
+    # - maxFreq: cruising tick frequency (Hz)
+    # - accel: tick acceleration limit (Hz per second), or None for "ramp"
+    # - jerk: tick jerk limit (Hz per second squared), or None for "ramp"
+    ##########################
+    steps = [numpy.asarray(axisSteps) for axisSteps in steps]
+    ticks = steps[0]
+    for axisSteps in steps[1:]:
+        ticks = numpy.maximum(ticks, axisSteps)
+    limits = [numpy.inf, numpy.inf, numpy.inf]
+    for axis, axisSteps in zip(axes, steps):
+        # Axes that don't move don't limit the move, unless no axis moves
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            scale = numpy.where(ticks > 0, ticks/axisSteps, 1.0)
+        for i, limit in enumerate(axis.profileLimits(targetSpeed)):
+            if limit is not None:
+                limits[i] = numpy.minimum(limits[i], limit*scale)
+    maxFreq, accel, jerk = limits
+    if axes[0].profileShape == "ramp":
+        accel = None
+        jerk = None
+    return ticks, maxFreq, accel, jerk
+
+
+def moveProfile(axes, steps, targetSpeed):
+    ######## moveProfile ########
+    # Function: Build the delay profile of a move shared by several axes
+    #
+    # Inputs:
+    # - axes: list of motor objects. They must use the same profile shape
+    # - steps: list of the steps each axis makes in the move
+    # - targetSpeed: speed (in RPM) for the axis with the furthest to go, or None for its maxSpeed
+    #
+    # Return Values:
+    # - delay: read-only numpy array with one delay (in seconds) per tick
+    ##########################
+    if axes[0].profileShape == "ramp":
+        # ramp.csv is followed at the speed of the axis with the furthest to go, as it always has been
+        ticks = max(steps)
+        return axes[steps.index(ticks)].profile(ticks, targetSpeed)
+    ticks, maxFreq, accel, jerk = timelineLimits(axes, steps, targetSpeed)
+    return buildCurve(int(ticks), float(maxFreq), float(accel), float(jerk))
+
+
+def slewDuration(axes, steps, targetSpeed):
+    ######## slewDuration ########
+    # Function: Find how long moveAxes takes without building the delay profiles
+    #
+    # Inputs:
+    # - axes: list of motor objects. They must use the same profile shape
+    # - steps: numpy arrays of the steps each axis makes in each move
+    # - targetSpeed: speed (in RPM) for the axis with the furthest to go, or None for its maxSpeed
+    #
+    # Return Values:
+    # - duration: time (in seconds) each move takes
+    ##########################
+    ticks, maxFreq, accel, jerk = timelineLimits(axes, steps, targetSpeed)
+    ticks = numpy.asarray(ticks, dtype=numpy.int64)
+    if axes[0].profileShape != "ramp":
+        return curveDuration(ticks, maxFreq, accel, jerk)
+
+    # Each move runs at the speed of its axis with the furthest to go
+    duration = None
+    for axis, axisSteps in reversed(list(zip(axes, steps))):
+        axisDuration = profileDuration(ticks, axis.profileLimits(targetSpeed)[0])
+        if duration is None:
+            duration = axisDuration
+        duration = numpy.where(numpy.asarray(axisSteps) == ticks, axisDuration, duration)
+    return duration
+
+
+def moveAxes(axes, rotations, targetSpeed, lock):
+    ######## moveAxes ########
+    # Function: Move several motors together from one timeline so they start and finish together.
+    #           The axis with the furthest to go follows the speed profile and the others step in
+    #           proportion to it. The profile keeps every axis within its own limits
+    #
+    # Inputs:
+    # - axes: list of motor objects. They must share the same pulse backend and profile shape
+    # - rotations: rotation of each motor in degrees. Negative values turn anticlockwise
+    # - targetSpeed: The desired target speed in RPM of the axis with the furthest to go, or None for its maxSpeed
+    # - lock: threading lock passed on to motor.run when backing off a limit switch
+    #
+    # Return Values:
+    # - switchPin: the limit switch that stopped the move short, or None
+    ##########################
+    steps = []
+    for axis, rotation in zip(axes, rotations):
+        degPerStep = 1.8/axis.uSteps
+        steps.append(int(abs(rotation)/degPerStep))
+        # Set the direction for the motor to move
+        if rotation < 0:
+            gpio.output(axis.direction, gpio.LOW)
+        else:
+            gpio.output(axis.direction, gpio.HIGH)
+
+    ticks = max(steps)
+    major = steps.index(ticks)
+    delay = moveProfile(axes, steps, targetSpeed)
+    masks = [bresenhamMask(axisSteps, ticks) for axisSteps in steps]
+
+    switchPins = []
+    for axis in axes:
+        switchPins.append(axis.switch1)
+        switchPins.append(axis.switch2)
+
+    for axis in axes:
+        gpio.output(axis.enable, gpio.LOW)
+    ticksSent, switchPin, elapsed = axes[major].backend.play([axis.step for axis in axes], delay, masks, switchPins, True)
+
+    # Update tracked positions from the number of steps each axis made
+    commandedTime = 2*float(delay[:ticksSent].sum())
+    for axis, rotation, mask in zip(axes, rotations, masks):
+        stepsSent = int(numpy.count_nonzero(mask[:ticksSent]))
+        if rotation < 0:
+            axis.position = axis.position - stepsSent
+        else:
+            axis.position = axis.position + stepsSent
+        axis.recordMove(stepsSent, commandedTime, elapsed)
+
+    if switchPin is not None:
+        # Back off the axis whose switch was pressed
+        print("Switch Pressed!")
+        time.sleep(0.5)
+        for axis, rotation in zip(axes, rotations):
+            if switchPin in (axis.switch1, axis.switch2):
+                axis.run(rotation < 0, 90, 60, lock, True)
+    for axis in axes:
+        gpio.output(axis.enable, gpio.HIGH)
+    return switchPin
@@ -1,23 +1,287 @@
 import RPi.GPIO as gpio
 import time
 import csv
+import functools
+import os
+import numpy
+from pulseBackend import SleepBackend, switchMonitor
 
 MAX_FREQ = 9600
 
 PAN_ENABLE = 29
 TILT_ENABLE = 23
 
-# Read CSV file into list to create acceleration profile
-ramp = []
-with open('ramp.csv', 'r') as file:
-    fileRow = csv.reader(file)
-    for row in fileRow:
-        ramp.append(float(row[0]))
+# Number of delay profiles kept in memory. Each entry is one (steps, frequency) pair
+PROFILE_CACHE_SIZE = 16
+
+# Homing seeks a limit switch quickly with the motor's speed profile, backs off HOMING_BACKOFF steps,
+# then approaches again slowly so the switch trips at the same place every time.
+# The back off runs at the fixed frequency the old single speed homing used, so needs no ramp
+HOMING_SEEK_SPEED = 120         # RPM. Limited to the motor's maxSpeed for generated profiles
+HOMING_BACKOFF_FREQ = 2000      # Hz
+HOMING_APPROACH_FREQ = 500      # Hz
+HOMING_BACKOFF = 400            # Steps
+HOMING_MAX_STEPS = 80000        # Furthest a seek goes before giving up. More than the travel of either axis
+
+# Moves either follow ramp.csv ("ramp") or a profile generated from each motor's speed, acceleration
+# and jerk limits: "trapezoid" (constant acceleration) or "scurve" (jerk limited acceleration)
+PROFILE_SHAPES = ("ramp", "trapezoid", "scurve")
+
+# Generated profiles start and finish at this pulse frequency, the same as the ends of ramp.csv
+PROFILE_START_FREQ = 52
+
+# Points the velocity of a generated acceleration is worked out at before it is spread over the steps
+CURVE_SAMPLES = 2001
+
+# The acceleration ramp is edited as CSV, but loaded from a binary copy that is made the first time
+# and remade whenever the CSV is newer than it
+RAMP_FILE = "ramp.csv"
+RAMP_CACHE = "ramp.npy"
+
+
+def loadRamp(filename, cacheName):
+    ######## loadRamp ########
+    # Function: Load the acceleration ramp, from the binary copy if it is up to date
+    #
+    # Inputs:
+    # - filename: ramp CSV file, one delay (in seconds) per row
+    # - cacheName: binary copy of the ramp
+    #
+    # Return Values:
+    # - ramp: numpy array of delays
+    ##########################
+    try:
+        if os.path.getmtime(cacheName) >= os.path.getmtime(filename):
+            return numpy.load(cacheName)
+    except (OSError, ValueError):
+        pass
+
+    # Read CSV file into array to create acceleration profile
+    ramp = []
+    with open(filename, 'r') as file:
+        fileRow = csv.reader(file)
+        for row in fileRow:
+            ramp.append(float(row[0]))
+    ramp = numpy.array(ramp)
+
+    # Written under a temporary name so a half written copy is never loaded
+    try:
+        with open(cacheName + ".tmp", "wb") as cacheFile:
+            numpy.save(cacheFile, ramp)
+        os.replace(cacheName + ".tmp", cacheName)
+    except OSError as error:
+        print("Warning: Could not save", cacheName, "(" + str(error) + ")")
+    return ramp
+
+
+ramp = loadRamp(RAMP_FILE, RAMP_CACHE)
 rampMaxIndex = len(ramp) - 1
-minDelay = min(ramp)
+minDelay = ramp.min()
+
+# The ramp accelerates down to the minimum delay and then decelerates back up.
+# The accelerating half is used to search for the index of a target delay
+rampMinIndex = int(ramp.argmin())
+accelRamp = ramp[:rampMinIndex + 1]
+
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def buildProfile(steps, targetFreq):
+    ######## buildProfile ########
+    # Function: Build the array of half-period delays for a move
+    #
+    # Inputs:
+    # - steps: number of pulses in the move
+    # - targetFreq: pulse frequency to cruise at once the ramp has been climbed
+    #
+    # Return Values:
+    # - delay: read-only numpy array with one delay (in seconds) per step
+    ##########################
+    targetMinDelay = 1/(2*targetFreq)
+
+    # Find index in accel profile of the target speed's delay
+    # accelRamp is decreasing, so search the negated values
+    stopIndex = int(numpy.searchsorted(-accelRamp, -targetMinDelay, side="left"))
+    stopIndex = min(stopIndex, rampMinIndex)
+
+    # Find the step number to stop accelerating or start decelerating
+    if steps > 2*stopIndex:
+        stopAccel = stopIndex
+        startDecel = (steps - 1) - stopIndex
+    else:
+        stopIndex = round(steps/2) - 1
+        stopAccel = stopIndex
+        startDecel = stopIndex + 1
+
+    # Fill in array containing all the relevant delays
+    # Should work for runs where targetMinDelay is not reached
+    delay = numpy.empty(steps)
+    delay[:stopAccel + 1] = ramp[:stopAccel + 1]
+    delay[stopAccel + 1:startDecel] = targetMinDelay
+    decelSteps = steps - startDecel
+    delay[startDecel:] = ramp[rampMaxIndex + 1 - decelSteps:]
+    delay.setflags(write=False)
+    return delay
+
+
+# Time spent on the accelerating steps of a profile, and on the decelerating steps at the end of the ramp.
+# accelTime[n] is the time of the first n ramp steps, decelTime[n] the time of the last n ramp steps
+accelTime = numpy.concatenate(([0.0], numpy.cumsum(2*accelRamp)))
+decelTime = numpy.concatenate(([0.0], numpy.cumsum(2*ramp[::-1])))
+
+
+def profileDuration(steps, targetFreq):
+    ######## profileDuration ########
+    # Function: Find how long a move takes without building its delay profile
+    #
+    # Inputs:
+    # - steps: number of pulses in the move. Can be a numpy array of step counts
+    # - targetFreq: pulse frequency to cruise at once the ramp has been climbed
+    #
+    # Return Values:
+    # - duration: time the pulses take (in seconds), same shape as steps
+    ##########################
+    steps = numpy.asarray(steps, dtype=numpy.int64)
+    targetMinDelay = 1/(2*targetFreq)
+    stopIndex = int(numpy.searchsorted(-accelRamp, -targetMinDelay, side="left"))
+    stopIndex = min(stopIndex, rampMinIndex)
+
+    # Same split into accelerating, cruising and decelerating steps as buildProfile
+    longMove = steps > 2*stopIndex
+    accelSteps = numpy.where(longMove, stopIndex + 1, numpy.round(steps/2).astype(numpy.int64))
+    decelSteps = numpy.where(longMove, stopIndex + 1, steps - accelSteps)
+    cruiseSteps = steps - accelSteps - decelSteps
+    return accelTime[accelSteps] + decelTime[decelSteps] + 2*cruiseSteps*targetMinDelay
+
+
+def curveTime(startFreq, peakFreq, accel, jerk):
+    ######## curveTime ########
+    # Function: Find how long a jerk limited acceleration between two pulse frequencies takes.
+    #           The acceleration climbs at the jerk limit, holds at the acceleration limit if it
+    #           gets there, and falls back to zero at the jerk limit. Works on numpy arrays
+    #
+    # Inputs:
+    # - startFreq, peakFreq: pulse frequencies at the start and end of the acceleration (Hz)
+    # - accel: acceleration limit (Hz per second)
+    # - jerk: jerk limit (Hz per second squared). numpy.inf for constant acceleration
+    #
+    # Return Values:
+    # - totalTime: time the acceleration takes (in seconds)
+    # - jerkTime: time spent climbing to (or falling from) the highest acceleration reached
+    ##########################
+    change = peakFreq - startFreq
+    jerkTime = numpy.minimum(accel/jerk, numpy.sqrt(change/jerk))
+    holdTime = numpy.maximum(change/accel - jerkTime, 0)
+    return 2*jerkTime + holdTime, jerkTime
+
+
+def peakFrequency(steps, maxFreq, accel, jerk):
+    ######## peakFrequency ########
+    # Function: Find the highest pulse frequency a move reaches. Moves too short to reach maxFreq
+    #           accelerate for half the move and decelerate for the other half. Works on numpy arrays
+    #
+    # Inputs:
+    # - steps: number of pulses in the move
+    # - maxFreq: pulse frequency to cruise at if the move is long enough
+    # - accel: acceleration limit (Hz per second)
+    # - jerk: jerk limit (Hz per second squared)
+    #
+    # Return Values:
+    # - peakFreq: highest pulse frequency of the move (Hz)
+    ##########################
+    startFreq = numpy.minimum(PROFILE_START_FREQ, maxFreq)
+    halfSteps = numpy.maximum((numpy.asarray(steps) - 1)/2, 0)
+
+    # The steps taken while accelerating are the average frequency times the time taken.
+    # If the acceleration limit is reached, that is a quadratic in the peak frequency
+    jerkTime = accel/jerk
+    a = 1/(2*accel)
+    b = jerkTime/2
+    c = startFreq*jerkTime/2 - startFreq*startFreq/(2*accel) - halfSteps
+    holdPeak = (-b + numpy.sqrt(b*b - 4*a*c))/(2*a)
+
+    # If not, it is a cubic in the square root of the frequency change
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        q = halfSteps*numpy.sqrt(jerk)
+        root = numpy.sqrt(q*q/4 + (2*startFreq)**3/27)
+        w = numpy.cbrt(q/2 + root) + numpy.cbrt(q/2 - root)
+        noHoldPeak = startFreq + w*w
+
+    # Steps needed to just reach the acceleration limit decide which applies
+    limitSteps = (2*startFreq + accel*jerkTime)/2*2*jerkTime
+    peakFreq = numpy.where(halfSteps >= limitSteps, holdPeak, noHoldPeak)
+    return numpy.clip(peakFreq, startFreq, maxFreq)
+
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def buildCurve(steps, maxFreq, accel, jerk):
+    ######## buildCurve ########
+    # Function: Build the array of half-period delays for a move with a trapezoidal or S-curve
+    #           speed profile, from the pulse frequency limits of the motor
+    #
+    # Inputs:
+    # - steps: number of pulses in the move
+    # - maxFreq: pulse frequency to cruise at once the acceleration is finished
+    # - accel: acceleration limit (Hz per second)
+    # - jerk: jerk limit (Hz per second squared). numpy.inf for a trapezoidal profile
+    #
+    # Return Values:
+    # - delay: read-only numpy array with one delay (in seconds) per step
+    ##########################
+    if steps <= 0:
+        delay = numpy.empty(0)
+        delay.setflags(write=False)
+        return delay
+    startFreq = min(PROFILE_START_FREQ, maxFreq)
+    peakFreq = float(peakFrequency(steps, maxFreq, accel, jerk))
+    totalTime, jerkTime = curveTime(startFreq, peakFreq, accel, jerk)
+    totalTime = float(totalTime)
+    jerkTime = float(jerkTime)
+
+    # Pulse frequency through the acceleration, against time
+    t = numpy.linspace(0, totalTime, CURVE_SAMPLES)
+    holdEnd = totalTime - jerkTime
+    highestAccel = (peakFreq - startFreq)/max(holdEnd, 1e-12)
+    rounding = highestAccel/(2*max(jerkTime, 1e-12))
+    freq = startFreq + highestAccel*(t - jerkTime/2)
+    freq = numpy.where(t < jerkTime, startFreq + rounding*t*t, freq)
+    freq = numpy.where(t > holdEnd, peakFreq - rounding*(totalTime - t)**2, freq)
+
+    # Steps taken by each point in time, so the frequency can be looked up for each step.
+    # Steps past the end of the acceleration cruise at the peak frequency
+    stepsTaken = numpy.concatenate(([0.0], numpy.cumsum((freq[1:] + freq[:-1])/2*numpy.diff(t))))
+    accelFreq = numpy.interp(numpy.arange(steps), stepsTaken, freq)
+
+    # The deceleration mirrors the acceleration
+    delay = 1/(2*numpy.minimum(accelFreq, accelFreq[::-1]))
+    delay.setflags(write=False)
+    return delay
+
+
+def curveDuration(steps, maxFreq, accel, jerk):
+    ######## curveDuration ########
+    # Function: Find how long a move made by buildCurve takes without building its delay profile
+    #
+    # Inputs:
+    # - steps: number of pulses in the move. The inputs can be numpy arrays
+    # - maxFreq: pulse frequency to cruise at once the acceleration is finished
+    # - accel: acceleration limit (Hz per second)
+    # - jerk: jerk limit (Hz per second squared)
+    #
+    # Return Values:
+    # - duration: time the pulses take (in seconds)
+    ##########################
+    steps = numpy.asarray(steps)
+    startFreq = numpy.minimum(PROFILE_START_FREQ, maxFreq)
+    peakFreq = peakFrequency(steps, maxFreq, accel, jerk)
+    totalTime, jerkTime = curveTime(startFreq, peakFreq, accel, jerk)
+    accelSteps = (startFreq + peakFreq)/2*totalTime
+    cruiseTime = numpy.maximum(steps - 1 - 2*accelSteps, 0)/peakFreq
+    # The first and last steps are each a whole period at the start frequency
+    return numpy.where(steps > 0, 2*totalTime + cruiseTime + 1/startFreq, 0.0)
+
 
 class motor:
-    def __init__(self, pins):
+    def __init__(self, pins, backend=None):
         # Set internal variables for GPIO pins
         self.direction = pins[0]
         self.step = pins[1]
@@ -31,6 +295,17 @@ class motor:
         self.totalSteps = 0
         self.maxStep = 0
         self.minStep = 0
+        self.commandedRate = 0
+        self.achievedRate = 0
+        # Speed profile and limits. By default moves follow ramp.csv at 60 RPM, as they always have
+        self.profileShape = "ramp"
+        self.maxSpeed = 60
+        self.maxAccel = None
+        self.maxJerk = None
+        # Pulse backend that plays out the delay profile. Defaults to bit-banging from Python
+        if backend is None:
+            backend = SleepBackend()
+        self.backend = backend
         #print("Created motor object with step pin: ", self.step)
 
 
@@ -53,6 +328,8 @@ class motor:
         gpio.setup(self.enable, gpio.OUT)
         gpio.setup(self.switch1, gpio.IN)
         gpio.setup(self.switch2, gpio.IN)
+        # Switch presses are caught by edge detection rather than read on every step
+        switchMonitor.watch([self.switch1, self.switch2])
 
         #Disable motor
         gpio.output(self.enable, gpio.HIGH)
@@ -103,112 +380,284 @@ class motor:
         steps = int(angle/degPerStep)
         #print("Steps:", steps)
 
-        # Calculate the frequency of pulses needed to rotate at the target speed
+        # Delays are cached, so repeated moves of the same length start immediately
+        delay = self.profile(steps, targetSpeed)
+
+        # Send one pulse per required step
+        gpio.output(self.enable, gpio.LOW)
+        stepsSent, switchPin, elapsed = self.pulse(clockwise, delay, not reverse)
+        self.recordMove(stepsSent, 2*float(delay[:stepsSent].sum()), elapsed)
+
+        if switchPin is not None:
+            print("Switch Pressed!")
+            time.sleep(0.5)
+            self.run(not clockwise, 90, 60, lock, True)
+        gpio.output(self.enable, gpio.HIGH)
+
+
+    def stepFrequency(self, targetSpeed):
+        ######## stepFrequency ########
+        # Function: Find the pulse frequency for a motor speed
+        #
+        # Inputs:
+        # - targetSpeed: The desired target speed in RPM
+        #
+        # Return Values:
+        # - targetFreq: pulse frequency in Hz, limited to MAX_FREQ
+        ##########################
+        degPerStep = 1.8/self.uSteps
         targetFreq = ((360/degPerStep)*targetSpeed)/60
         if targetFreq > MAX_FREQ:                          # Limit to pre-set max frequency
             targetFreq = MAX_FREQ
-        targetMinDelay = 1/(2*targetFreq)
+        return targetFreq
+
+
+    def setLimits(self, shape, maxSpeed, maxAccel=None, maxJerk=None):
+        ######## setLimits ########
+        # Function: Set the speed profile the motor's moves follow
+        #
+        # Inputs:
+        # - shape: "ramp" (ramp.csv), "trapezoid" or "scurve". See PROFILE_SHAPES
+        # - maxSpeed: fastest the motor is run (in RPM). For "ramp" this is only the default speed
+        # - maxAccel: acceleration limit (in RPM per second). Not used for "ramp"
+        # - maxJerk: jerk limit (in RPM per second squared). Only used for "scurve"
+        #
+        # Return Values: None
+        ##########################
+        if shape not in PROFILE_SHAPES:
+            print("Error: Unknown profile shape", shape + ". Using ramp.")
+            shape = "ramp"
+        if shape != "ramp" and not maxAccel:
+            print("Error: No acceleration limit set. Using ramp.")
+            shape = "ramp"
+        if shape == "scurve" and not maxJerk:
+            print("Error: No jerk limit set. Using trapezoid.")
+            shape = "trapezoid"
+        self.profileShape = shape
+        self.maxSpeed = maxSpeed
+        self.maxAccel = maxAccel
+        self.maxJerk = maxJerk
+
+
+    def profileLimits(self, targetSpeed=None):
+        ######## profileLimits ########
+        # Function: Find the pulse frequency limits of a move
+        #
+        # Inputs:
+        # - targetSpeed: optional. Speed to cruise at (in RPM). Limited to maxSpeed except for
+        #                "ramp", which runs at whatever speed it is asked for
+        #
+        # Return Values:
+        # - maxFreq: cruising pulse frequency (Hz)
+        # - accel: acceleration limit (Hz per second), or None for "ramp"
+        # - jerk: jerk limit (Hz per second squared). numpy.inf for "trapezoid", None for "ramp"
+        ##########################
+        if targetSpeed is None:
+            targetSpeed = self.maxSpeed
+        if self.profileShape == "ramp":
+            return self.stepFrequency(targetSpeed), None, None
+        maxFreq = self.stepFrequency(min(targetSpeed, self.maxSpeed))
+        # One RPM is stepsPerRev/60 Hz
+        hzPerRpm = (360/(1.8/self.uSteps))/60
+        accel = self.maxAccel*hzPerRpm
+        jerk = numpy.inf
+        if self.profileShape == "scurve":
+            jerk = self.maxJerk*hzPerRpm
+        return maxFreq, accel, jerk
+
 
-        # Set the direction for the motor to move
+    def profile(self, steps, targetSpeed=None):
+        ######## profile ########
+        # Function: Build the delay profile for a move of this motor on its own
+        #
+        # Inputs:
+        # - steps: number of pulses in the move
+        # - targetSpeed: optional. Speed to cruise at (in RPM). Defaults to maxSpeed
+        #
+        # Return Values:
+        # - delay: read-only numpy array with one delay (in seconds) per step
+        ##########################
+        maxFreq, accel, jerk = self.profileLimits(targetSpeed)
+        if self.profileShape == "ramp":
+            return buildProfile(steps, maxFreq)
+        return buildCurve(steps, maxFreq, accel, jerk)
+
+
+    def recordMove(self, stepsSent, commandedTime, elapsed):
+        ######## recordMove ########
+        # Function: Store and print the commanded and achieved step rate of the last move
+        #
+        # Inputs:
+        # - stepsSent: number of pulses actually sent
+        # - commandedTime: time the pulses should have taken (in seconds)
+        # - elapsed: time taken to send the pulses (in seconds)
+        #
+        # Return Values: None
+        ##########################
+        if stepsSent == 0:
+            self.commandedRate = 0
+            self.achievedRate = 0
+            return
+        self.commandedRate = stepsSent/commandedTime
+        self.achievedRate = stepsSent/elapsed
+        print("Steps:", stepsSent, "Commanded rate: %.1f Hz" % self.commandedRate, "Achieved rate: %.1f Hz" % self.achievedRate)
+
+
+    def pulse(self, clockwise, delay, checkSwitches):
+        ######## pulse ########
+        # Function: Send a delay profile to the motor and update the tracked position. The motor must be enabled
+        #
+        # Inputs:
+        # - clockwise: the direction to turn the motor
+        # - delay: array of half-period delays (in seconds), one per step
+        # - checkSwitches: stop if a limit switch is pressed
+        #
+        # Return Values:
+        # - stepsSent: number of steps sent
+        # - switchPin: the switch that stopped the motor, or None
+        # - elapsed: time taken to send the steps (in seconds)
+        ##########################
         if clockwise:
             gpio.output(self.direction, gpio.HIGH)
         else:
             gpio.output(self.direction, gpio.LOW)
+        stepsSent, switchPin, elapsed = self.backend.play([self.step], delay, None, [self.switch1, self.switch2], checkSwitches)
+        if clockwise:
+            self.position = self.position + stepsSent
+        else:
+            self.position = self.position - stepsSent
+        return stepsSent, switchPin, elapsed
+
+
+    def switchPressed(self):
+        return gpio.input(self.switch1) == gpio.LOW or gpio.input(self.switch2) == gpio.LOW
 
-        delay = []
 
-        # Find index in accel profile of the target speed's delay
-        for i in ramp:
-            if i <= targetMinDelay:
-                stopIndex = ramp.index(i)
-                #print("Stop Index: ", stopIndex)
-                break
+    def seekSwitch(self, clockwise, leaveSwitch=False):
+        ######## seekSwitch ########
+        # Function: Move until a limit switch trips. Seek at speed, back off, then approach slowly.
+        #           The motor must be enabled
+        #
+        # Inputs:
+        # - clockwise: the direction to seek in
+        # - leaveSwitch: a switch pressed at the start is the other end of travel, so move off it.
+        #                Otherwise it is taken as the switch being looked for, as there is no way to
+        #                tell which end it is without driving into the end stop
+        #
+        # Return Values:
+        # - found: False if no switch was found within HOMING_MAX_STEPS
+        ##########################
+        backoff = numpy.full(HOMING_BACKOFF, 1/(2*HOMING_BACKOFF_FREQ))
 
-        # Find the step number to stop accelerating or start decelerating
-        if steps > 2* stopIndex:
-            stopAccel = stopIndex
-            startDecel = (steps - 1) - stopIndex
+        if self.switchPressed():
+            if not leaveSwitch:
+                return True
+            self.pulse(clockwise, backoff, False)
+            # A switch that sticks or is still bouncing would stop the seek straight away
+            if self.switchPressed():
+                print("Error: Switch still pressed after backing off.")
+                return False
+
+        stepsSent, switchPin, elapsed = self.pulse(clockwise, self.profile(HOMING_MAX_STEPS, HOMING_SEEK_SPEED), True)
+        if switchPin is None:
+            print("Error: Limit switch not found.")
+            return False
+        time.sleep(0.2)
+
+        # The fast stop may have overshot, so come back off the switch and find it again slowly
+        self.pulse(not clockwise, backoff, False)
+        if self.switchPressed():
+            print("Error: Switch still pressed after backing off.")
+            return False
+        approach = numpy.full(2*HOMING_BACKOFF, 1/(2*HOMING_APPROACH_FREQ))
+        stepsSent, switchPin, elapsed = self.pulse(clockwise, approach, True)
+        if switchPin is None:
+            print("Error: Limit switch not found on slow approach.")
+            return False
+        return True
+
+
+    def verifyPosition(self):
+        ######## verifyPosition ########
+        # Function: Check the tracked position against the nearest limit switch, without homing.
+        #           Moves to just short of where the switch should be, then approaches it slowly.
+        #           The position is corrected if the switch trips within HOMING_BACKOFF steps
+        #           either side of where it is expected, and the motor is left just off the switch
+        #
+        # Inputs: None
+        #
+        # Return Values:
+        # - verified: False if the switch wasn't where it should be. The position is then unknown
+        ##########################
+        clockwise = self.maxStep - self.position <= self.position - self.minStep
+        if clockwise:
+            switchPosition = self.maxStep
         else:
-            stopIndex = round(steps/2) - 1
-            stopAccel = stopIndex
-            startDecel = stopIndex + 1
-
-        # Fill in array containing all the relevant delays
-        # Should work for runs where targetMinDelay is not reached
-        for i in range(steps):
-            if i <= stopAccel:
-                delay.append(ramp[i])
-            elif i > stopAccel and i < startDecel:
-                delay.append(targetMinDelay)
-            else:
-                delay.append(ramp[rampMaxIndex-((steps-1)-i)])
-                
-        # Send one pulse per required step
+            switchPosition = self.minStep
+        backoff = numpy.full(HOMING_BACKOFF, 1/(2*HOMING_BACKOFF_FREQ))
         gpio.output(self.enable, gpio.LOW)
-        for i in range(steps):
-            # Increment/decrement tracked position
-            if clockwise:
-                self.position = self.position + 1
-            else:
-                self.position = self.position - 1
-            gpio.output(self.step, gpio.HIGH)
-            time.sleep(delay[i])
-            gpio.output(self.step, gpio.LOW)
-            time.sleep(delay[i])
-            if (gpio.input(self.switch1) == gpio.LOW or gpio.input(self.switch2) == gpio.LOW) and not reverse:
-                print("Switch Pressed!")
-                time.sleep(0.5)
-                self.run(not clockwise, 90, 60, lock, True)
-                break
-        gpio.output(self.enable, gpio.HIGH)  
-
-
-    def fullCalibrate(self, threadLock):
+
+        verified = True
+        if self.switchPressed():
+            self.pulse(not clockwise, backoff, False)
+        else:
+            distance = int(abs(switchPosition - self.position)) - HOMING_BACKOFF
+            if distance > 0:
+                stepsSent, switchPin, elapsed = self.pulse(clockwise, self.profile(distance, HOMING_SEEK_SPEED), True)
+                verified = switchPin is None
+        if verified:
+            approach = numpy.full(2*HOMING_BACKOFF, 1/(2*HOMING_APPROACH_FREQ))
+            stepsSent, switchPin, elapsed = self.pulse(clockwise, approach, True)
+            verified = switchPin is not None
+
+        if verified:
+            print("Position error: %.0f steps" % (self.position - switchPosition))
+            self.position = switchPosition
+            time.sleep(0.2)
+            self.pulse(not clockwise, backoff, False)
+        else:
+            print("Error: Limit switch not where expected.")
+        gpio.output(self.enable, gpio.HIGH)
+        return verified
+
+
+    def fullCalibrate(self, threadLock, minSteps=0):
         ####### Full Calibration #######
         # Function: Calibrate incl. finding total no. of steps
         #
         # Inputs:
         # - threadLock: thread lock object for multithreading. Unused now as motor run has been moved out of this function
+        # - minSteps: shortest travel accepted. A shorter one means a switch was found in the wrong place
         #
-        # Return Values: None
+        # Return Values:
+        # - calibrated: False if either limit switch wasn't found, or the travel was too short. The steps and limits are then unchanged
         ################################
-
-        freq = 2000
-        stop = False
-        gpio.output(self.direction, gpio.LOW)
         gpio.output(self.enable, gpio.LOW)
 
-        # Run in one direction
+        # Find one end of travel, then measure the steps to the other end
         print("Direction 1")
-        while(not stop):
-            gpio.output(self.step, gpio.HIGH)
-            time.sleep(1/(2*freq))
-            gpio.output(self.step, gpio.LOW)
-            time.sleep(1/(2*freq))
-            if gpio.input(self.switch1) == gpio.LOW or gpio.input(self.switch2) == gpio.LOW:
-                print("Switch Pressed!")
-                stop=True
+        if not self.seekSwitch(False):
+            gpio.output(self.enable, gpio.HIGH)
+            return False
+        print("Switch Pressed!")
+        lowerSwitch = self.position
         time.sleep(0.5)
-        self.totalSteps = 0
-        gpio.output(self.direction, gpio.HIGH)
-        stop = False
-
-        # Run in the other direction
         print("Direction 2")
-        while(not stop):
-            gpio.output(self.step, gpio.HIGH)
-            self.totalSteps = self.totalSteps + 1
-            time.sleep(1/(2*freq))
-            gpio.output(self.step, gpio.LOW)
-            time.sleep(1/(2*freq))
-            if (gpio.input(self.switch1) == gpio.LOW or gpio.input(self.switch2) == gpio.LOW) and self.totalSteps > 100:
-                stop = True
+        if not self.seekSwitch(True, True):
+            gpio.output(self.enable, gpio.HIGH)
+            return False
+        totalSteps = self.position - lowerSwitch
         gpio.output(self.enable, gpio.HIGH)
+        if totalSteps < minSteps:
+            print("Error: Measured travel of", int(totalSteps), "steps is less than", minSteps)
+            return False
+        self.totalSteps = totalSteps
         time.sleep(0.2)
         self.position = self.totalSteps/2
         self.maxStep = self.position
         self.minStep = -self.position
-                    
+        return True
+
 
 
     def calibrate(self, threadLock):
@@ -218,22 +667,16 @@ class motor:
     # Inputs:
     # - threadLock: thread lock object for multithreading. Unused now as motor run has been moved out of this function
     #
-    # Return Values: None
+    # Return Values:
+    # - calibrated: False if the limit switch wasn't found. The position is then unknown
     ##########################
-
-        freq = 2000
-        stop = False
-        gpio.output(self.direction, gpio.HIGH)
         gpio.output(self.enable, gpio.LOW)
-        while(not stop):
-            gpio.output(self.step, gpio.HIGH)
-            time.sleep(1/(2*freq))
-            gpio.output(self.step, gpio.LOW)
-            time.sleep(1/(2*freq))
-            if gpio.input(self.switch1) == gpio.LOW or gpio.input(self.switch2) == gpio.LOW:
-                stop = True
+        found = self.seekSwitch(True)
         gpio.output(self.enable, gpio.HIGH)
+        if not found:
+            return False
         time.sleep(0.2)
         self.position = self.totalSteps/2
         self.maxStep = self.position
-        self.minStep = -self.position
\ No newline at end of file
+        self.minStep = -self.position
+        return True
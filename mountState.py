@@ -0,0 +1,98 @@
+import csv
+import os
+from timerScheduler import wallTime
+
+# What the mount was doing when the state was saved
+MOVING = "moving"       # A move was in progress. The saved positions can't be trusted
+STOPPED = "stopped"     # Between moves. Positions are right unless the mount was pushed while the motors were off
+PARKED = "parked"       # Shut down cleanly at the end of the night
+
+STATES = (MOVING, STOPPED, PARKED)
+
+
+class MountState:
+    # Position and limits of each axis as last saved
+    __slots__ = ("state", "savedTime", "axes")
+
+    def __init__(self, state, savedTime, axes):
+        self.state = state
+        self.savedTime = savedTime
+        self.axes = axes        # Axis name to (position, minStep, maxStep, totalSteps)
+
+
+def saveMountState(filename, state, axes):
+    ######## saveMountState ########
+    # Function: Save the position and limits of each axis. The file is replaced in one step, so a
+    #           power cut leaves either the old or the new state, never half of one
+    #
+    # Inputs:
+    # - filename: path of the state file
+    # - state: MOVING, STOPPED or PARKED
+    # - axes: dictionary of axis name to motor object
+    #
+    # Return Values: None
+    ##########################
+    tempName = filename + ".tmp"
+    try:
+        with open(tempName, "w", newline="") as stateFile:
+            writer = csv.writer(stateFile)
+            writer.writerow(["state", state])
+            writer.writerow(["time", wallTime()])
+            for name, axis in axes.items():
+                writer.writerow([name, axis.position, axis.minStep, axis.maxStep, axis.totalSteps])
+            stateFile.flush()
+            os.fsync(stateFile.fileno())
+        os.replace(tempName, filename)
+    except OSError as error:
+        print("Error: Could not save mount state (" + str(error) + ")")
+
+
+def loadMountState(filename):
+    ######## loadMountState ########
+    # Function: Read the state saved by saveMountState
+    #
+    # Inputs:
+    # - filename: path of the state file
+    #
+    # Return Values:
+    # - mountState: MountState, or None if there is no usable saved state
+    ##########################
+    state = None
+    savedTime = None
+    axes = {}
+    try:
+        with open(filename, "r", newline="") as stateFile:
+            for row in csv.reader(stateFile):
+                if len(row) == 2 and row[0] == "state":
+                    state = row[1]
+                elif len(row) == 2 and row[0] == "time":
+                    savedTime = float(row[1])
+                elif len(row) == 5:
+                    axes[row[0]] = tuple(float(value) for value in row[1:])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        print("Error: Could not read mount state (" + str(error) + ")")
+        return None
+
+    if state not in STATES or savedTime is None:
+        print("Error: Mount state file is incomplete.")
+        return None
+    return MountState(state, savedTime, axes)
+
+
+def restoreAxis(axis, values):
+    ######## restoreAxis ########
+    # Function: Set a motor's position and limits from saved values
+    #
+    # Inputs:
+    # - axis: motor object
+    # - values: (position, minStep, maxStep, totalSteps) from a MountState
+    #
+    # Return Values: None
+    ##########################
+    position, minStep, maxStep, totalSteps = values
+    axis.position = position
+    axis.minStep = minStep
+    axis.maxStep = maxStep
+    axis.totalSteps = int(totalSteps)
@@ -0,0 +1,51 @@
+import numpy
+
+# Angle the mount's base is rotated from horizontal (in degrees)
+MOUNT_ROTATION = -40
+
+
+def solvePointing(azimuth, elevation, panLimits, tiltLimits):
+    ######## solvePointing ########
+    # Function: Find the mount angles needed to point at targets. Works on single values or on
+    #           numpy arrays of targets, solving the whole schedule in one pass
+    #
+    # Inputs:
+    # - azimuth: The target azimuth angle(s) in degrees
+    # - elevation: The target elevation angle(s) in degrees
+    # - panLimits: (min, max) mount pan angles the pan motor can reach, in degrees
+    # - tiltLimits: (min, max) mount tilt angles the tilt motor can reach, in degrees
+    #
+    # Return Values:
+    # - panValid: False if the pan angle can't be reached
+    # - tiltValid: False if the tilt angle can't be reached
+    # - mountAzimuth: mount pan angle in degrees
+    # - mountElevation: mount tilt angle in degrees
+    # - flipped: True if the mount points over the top (pan turned by 180 degrees)
+    ##########################
+    ROTATION_ANGLE = numpy.radians(MOUNT_ROTATION)
+    azimuth = numpy.radians(azimuth)
+    elevation = numpy.radians(elevation)
+
+    posE = numpy.sin(azimuth) * numpy.cos(elevation)
+    posN = numpy.cos(azimuth) * numpy.cos(elevation)
+    posU = numpy.sin(elevation)
+
+    RposE = posE
+    RposN = (posN * numpy.cos(ROTATION_ANGLE)) + (posU * numpy.sin(ROTATION_ANGLE))
+    RposU = (-posN * numpy.sin(ROTATION_ANGLE)) + (posU * numpy.cos(ROTATION_ANGLE))
+
+    mountAzimuth = numpy.degrees(numpy.arctan2(RposE, RposN))
+    mountElevation = numpy.degrees(numpy.arcsin(numpy.clip(RposU, -1, 1)))
+
+    # Flip over the top if the pan angle is out of range
+    overMax = mountAzimuth > panLimits[1]
+    underMin = mountAzimuth < panLimits[0]
+    flipped = overMax | underMin
+    mountAzimuth = numpy.where(overMax, mountAzimuth - 180, numpy.where(underMin, mountAzimuth + 180, mountAzimuth))
+    mountElevation = numpy.where(flipped, 180 - mountElevation, mountElevation)
+
+    mountElevation = -mountElevation
+
+    panValid = (mountAzimuth < panLimits[1]) & (mountAzimuth > panLimits[0])
+    tiltValid = (mountElevation < tiltLimits[1]) & (mountElevation > tiltLimits[0])
+    return panValid, tiltValid, mountAzimuth, mountElevation, flipped
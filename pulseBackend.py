@@ -0,0 +1,353 @@
+import RPi.GPIO as gpio
+import threading
+import time
+import numpy
+
+# Waits shorter than this are busy-waited. Longer waits sleep until this close to the deadline
+SPIN_THRESHOLD = 0.0005
+
+# Limit switch edges closer together than this are treated as contact bounce (in milliseconds)
+SWITCH_BOUNCE_TIME = 5
+
+# Number of steps sent to pigpio in each waveform. pigpio limits the number of pulses per wave
+WAVE_CHUNK_STEPS = 4000
+
+# The motor class uses BOARD pin numbers, pigpio uses BCM numbers
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23,
+                18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5,
+                31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21}
+
+
+def waitUntil(deadline):
+    ######## waitUntil ########
+    # Function: Wait until a deadline on the time.perf_counter clock
+    #
+    # Inputs:
+    # - deadline: time.perf_counter value to wait for
+    #
+    # Return Values: None
+    ##########################
+    remaining = deadline - time.perf_counter()
+    if remaining > SPIN_THRESHOLD:
+        time.sleep(remaining - SPIN_THRESHOLD)
+    while time.perf_counter() < deadline:
+        pass
+
+
+def pinsPerTick(stepPins, stepMasks, ticks):
+    ######## pinsPerTick ########
+    # Function: List the step pins to pulse on each tick
+    #
+    # Inputs:
+    # - stepPins: list of BOARD numbers of the STEP pins
+    # - stepMasks: list of boolean arrays, one per step pin. None pulses every pin on every tick
+    # - ticks: number of ticks in the pulse train
+    #
+    # Return Values:
+    # - tickPins: list with one list of pins per tick
+    ##########################
+    if stepMasks is None:
+        return [list(stepPins)] * ticks
+    # Number each combination of pins, then look the combination up for every tick
+    combination = numpy.zeros(ticks, dtype=numpy.int64)
+    for i, mask in enumerate(stepMasks):
+        combination[mask[:ticks]] |= 1 << i
+    pinLists = [[pin for i, pin in enumerate(stepPins) if number & (1 << i)] for number in range(1 << len(stepPins))]
+    return [pinLists[number] for number in combination.tolist()]
+
+
+class SwitchMonitor:
+    # Watches the limit switches with edge detection interrupts, so the step loop only has to check
+    # a flag instead of reading both switches on every pulse. RPi.GPIO calls pressed() from its
+    # own thread when a switch closes. Pins that can't have edge detection are polled instead, and
+    # the step loop reads a pin itself from its first edge until it reads closed
+
+    def __init__(self):
+        self.watched = set()
+        self.armed = ()
+        self.hitPin = None
+
+    def watch(self, pins):
+        ######## watch ########
+        # Function: Start edge detection on limit switch pins. The pins must already be set up as inputs
+        #
+        # Inputs:
+        # - pins: BOARD numbers of the switch pins
+        #
+        # Return Values: None
+        ##########################
+        for pin in pins:
+            if pin in self.watched:
+                continue
+            try:
+                gpio.add_event_detect(pin, gpio.FALLING, callback=self.pressed, bouncetime=SWITCH_BOUNCE_TIME)
+                self.watched.add(pin)
+            except (RuntimeError, AttributeError) as error:
+                print("Warning: No edge detection on pin", pin, "(" + str(error) + "). Polling it instead.")
+
+    def pressed(self, pin):
+        # Edge detection callback. The level isn't read here: a bouncing switch can read open on
+        # its first edge, and the bounce time then hides the edges after it. The step loop checks it
+        if pin in self.armed and self.hitPin is None:
+            self.hitPin = pin
+
+    def arm(self, pins):
+        ######## arm ########
+        # Function: Clear any earlier hit and start watching for these switches
+        #
+        # Inputs:
+        # - pins: BOARD numbers of the switch pins that stop the next pulse train
+        #
+        # Return Values:
+        # - polled: the pins without edge detection, which the caller has to read itself
+        ##########################
+        self.hitPin = None
+        self.armed = tuple(pins)
+        # A switch that is already closed won't make an edge, so check the level once
+        for pin in self.armed:
+            if pin in self.watched and gpio.input(pin) == gpio.LOW:
+                self.hitPin = pin
+                break
+        return [pin for pin in self.armed if pin not in self.watched]
+
+    def disarm(self):
+        self.armed = ()
+
+
+# Shared by every motor, as the switches of all axes stop the same pulse trains
+switchMonitor = SwitchMonitor()
+
+
+def createBackend(name):
+    ######## createBackend ########
+    # Function: Create a pulse backend by name
+    #
+    # Inputs:
+    # - name: "sleep", "waveform" or "simulated"
+    #
+    # Return Values:
+    # - backend: the backend object. Falls back to the sleep backend if the waveform backend can't start
+    ##########################
+    if name == "waveform":
+        try:
+            return WaveformBackend()
+        except Exception as error:
+            print("Error: Waveform backend unavailable (" + str(error) + "). Using sleep backend.")
+            return SleepBackend()
+    elif name == "simulated":
+        return SimulatedBackend()
+    else:
+        return SleepBackend()
+
+
+class SleepBackend:
+    # Bit-bangs the STEP pins from Python, timing each edge against an absolute deadline
+
+    def __init__(self):
+        self.lastLateness = 0.0     # Latest a falling edge finished after its deadline in the last play (seconds)
+
+    def play(self, stepPins, delay, stepMasks, switchPins, checkSwitches):
+        ######## play ########
+        # Function: Send one pulse per entry in the delay profile
+        #
+        # Inputs:
+        # - stepPins: list of BOARD numbers of the STEP pins
+        # - delay: array of half-period delays (in seconds), one per tick
+        # - stepMasks: list of boolean arrays, one per step pin, True on the ticks where that
+        #              pin pulses. None pulses every pin on every tick
+        # - switchPins: limit switch pins to watch
+        # - checkSwitches: stop the pulse train if a switch is pressed
+        #
+        # Return Values:
+        # - ticksSent: number of ticks sent
+        # - switchPin: the switch that stopped the pulse train, or None
+        # - elapsed: time taken to send the pulses (in seconds)
+        ##########################
+        tickPins = pinsPerTick(stepPins, stepMasks, len(delay))
+        ticksSent = len(delay)
+        switchPin = None
+        polledPins = []
+        if checkSwitches:
+            polledPins = switchMonitor.arm(switchPins)
+        startTime = time.perf_counter()
+        deadline = startTime
+        lateness = 0.0
+        for tick, (halfPeriod, pins) in enumerate(zip(delay.tolist(), tickPins)):
+            gpio.output(pins, gpio.HIGH)
+            deadline = deadline + halfPeriod
+            waitUntil(deadline)
+            gpio.output(pins, gpio.LOW)
+            deadline = deadline + halfPeriod
+            waitUntil(deadline)
+            # If an edge is more than a half period late, carry the lateness forward
+            # rather than sending a burst of pulses to catch up
+            now = time.perf_counter()
+            if now - deadline > lateness:
+                lateness = now - deadline
+            if now - deadline > halfPeriod:
+                deadline = now
+            if checkSwitches:
+                # The edge detection callback sets hitPin, so until a switch closes this is only an
+                # attribute read. From then on the pin is read on every pulse, and the train stops
+                # once it reads closed, so contact bounce or a glitch can't stop or miss a press
+                hitPin = switchMonitor.hitPin
+                if hitPin is not None:
+                    switchMonitor.hitPin = None
+                    if hitPin not in polledPins:
+                        polledPins.append(hitPin)
+                for pin in polledPins:
+                    if gpio.input(pin) == gpio.LOW:
+                        switchPin = pin
+                if switchPin is not None:
+                    # The position is worked out from the tick the pulse train stopped on
+                    ticksSent = tick + 1
+                    break
+        if checkSwitches:
+            switchMonitor.disarm()
+        self.lastLateness = lateness
+        return ticksSent, switchPin, time.perf_counter() - startTime
+
+
+class WaveformBackend:
+    # Plays the pulse train out of the pigpio daemon's DMA-timed waveform generator.
+    # The pigpio daemon must be running (sudo pigpiod)
+
+    def __init__(self):
+        import pigpio
+        self.pigpio = pigpio
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise RuntimeError("pigpio daemon not running")
+        # pigpio can only transmit one waveform at a time
+        self.lock = threading.Lock()
+
+    def play(self, stepPins, delay, stepMasks, switchPins, checkSwitches):
+        ######## play ########
+        # Function: Send one pulse per entry in the delay profile using hardware timed waveforms
+        #
+        # Inputs:
+        # - stepPins: list of BOARD numbers of the STEP pins
+        # - delay: array of half-period delays (in seconds), one per tick
+        # - stepMasks: list of boolean arrays, one per step pin, True on the ticks where that
+        #              pin pulses. None pulses every pin on every tick
+        # - switchPins: limit switch pins to watch
+        # - checkSwitches: stop the pulse train if a switch is pressed
+        #
+        # Return Values:
+        # - ticksSent: number of ticks sent
+        # - switchPin: the switch that stopped the pulse train, or None
+        # - elapsed: time taken to send the pulses (in seconds)
+        ##########################
+        pigpio = self.pigpio
+        ticks = len(delay)
+        halfPeriods = numpy.maximum(numpy.rint(numpy.asarray(delay)*1e6), 1).astype(int).tolist()
+        tickEnds = numpy.cumsum(2*numpy.asarray(delay))
+
+        # Bit mask of the BCM pins that pulse on each tick
+        tickMasks = numpy.zeros(ticks, dtype=numpy.int64)
+        for i, pin in enumerate(stepPins):
+            if stepMasks is None:
+                tickMasks |= 1 << BOARD_TO_BCM[pin]
+            else:
+                tickMasks[stepMasks[i][:ticks]] |= 1 << BOARD_TO_BCM[pin]
+        tickMasks = tickMasks.tolist()
+        bcmToBoard = {BOARD_TO_BCM[pin]: pin for pin in switchPins}
+
+        with self.lock:
+            for pin in stepPins:
+                self.pi.set_mode(BOARD_TO_BCM[pin], pigpio.OUTPUT)
+            self.pi.wave_clear()
+
+            # A switch press stops the waveform straight away from the pigpio callback thread
+            hits = []
+            callbacks = []
+            def switchPressed(gpioNumber, level, tick):
+                if not hits:
+                    self.pi.wave_tx_stop()
+                    hits.append((bcmToBoard[gpioNumber], tick))
+            if checkSwitches:
+                for pin in switchPins:
+                    callbacks.append(self.pi.callback(BOARD_TO_BCM[pin], pigpio.FALLING_EDGE, switchPressed))
+                # A switch that is already closed won't make an edge, so check the levels once. The
+                # callbacks are already running, so a switch closing after this is still caught
+                for pin in switchPins:
+                    if self.pi.read(BOARD_TO_BCM[pin]) == 0:
+                        for callback in callbacks:
+                            callback.cancel()
+                        return 0, pin, 0.0
+
+            startTick = self.pi.get_current_tick()
+            startTime = time.perf_counter()
+            waves = []
+            for start in range(0, ticks, WAVE_CHUNK_STEPS):
+                if hits:
+                    break
+                pulses = []
+                for halfPeriod, mask in zip(halfPeriods[start:start + WAVE_CHUNK_STEPS], tickMasks[start:start + WAVE_CHUNK_STEPS]):
+                    pulses.append(pigpio.pulse(mask, 0, halfPeriod))
+                    pulses.append(pigpio.pulse(0, mask, halfPeriod))
+                self.pi.wave_add_generic(pulses)
+                waveId = self.pi.wave_create()
+                # SYNC mode queues the wave to start when the previous one finishes
+                self.pi.wave_send_using_mode(waveId, pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+                waves.append(waveId)
+                # Keep at most two waves queued, deleting the old one once the new one is playing
+                while len(waves) > 1 and self.pi.wave_tx_at() not in (waveId, pigpio.WAVE_NOT_FOUND, pigpio.NO_TX_WAVE) and not hits:
+                    time.sleep(0.001)
+                if len(waves) > 1:
+                    self.pi.wave_delete(waves.pop(0))
+
+            while self.pi.wave_tx_busy() and not hits:
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - startTime
+            for callback in callbacks:
+                callback.cancel()
+            for waveId in waves:
+                self.pi.wave_delete(waveId)
+
+        if hits:
+            # Work out how many ticks had been sent when the switch was pressed
+            switchPin, hitTick = hits[0]
+            hitTime = pigpio.tickDiff(startTick, hitTick)/1e6
+            ticksSent = min(int(numpy.searchsorted(tickEnds, hitTime, side="right")) + 1, ticks)
+            return ticksSent, switchPin, hitTime
+        return ticks, None, elapsed
+
+
+class SimulatedBackend:
+    # Software stand-in for the motor hardware. Records every pulse train instead of driving pins.
+    # Set realTime to take as long as the real move would, and switchAfter to trip the first
+    # limit switch after that many ticks
+
+    def __init__(self, realTime=False, switchAfter=None):
+        self.realTime = realTime
+        self.switchAfter = switchAfter
+        self.history = []
+
+    def play(self, stepPins, delay, stepMasks, switchPins, checkSwitches):
+        ######## play ########
+        # Function: Simulate sending one pulse per entry in the delay profile
+        #
+        # Inputs:
+        # - stepPins: list of BOARD numbers of the STEP pins
+        # - delay: array of half-period delays (in seconds), one per tick
+        # - stepMasks: list of boolean arrays, one per step pin, True on the ticks where that
+        #              pin pulses. None pulses every pin on every tick
+        # - switchPins: limit switch pins to watch
+        # - checkSwitches: stop the pulse train if a switch is pressed
+        #
+        # Return Values:
+        # - ticksSent: number of ticks sent
+        # - switchPin: the switch that stopped the pulse train, or None
+        # - elapsed: time the pulses would take (in seconds)
+        ##########################
+        ticksSent = len(delay)
+        switchPin = None
+        if checkSwitches and self.switchAfter is not None and self.switchAfter <= ticksSent:
+            ticksSent = self.switchAfter
+            switchPin = switchPins[0]
+        elapsed = 2*float(numpy.sum(delay[:ticksSent]))
+        if self.realTime:
+            time.sleep(elapsed)
+        self.history.append((list(stepPins), ticksSent, switchPin, elapsed))
+        return ticksSent, switchPin, elapsed
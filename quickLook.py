@@ -0,0 +1,218 @@
+import multiprocessing
+import os
+import re
+import threading
+import numpy
+
+# Images are shrunk by this factor in each direction before they are analysed. JPEGs are decoded
+# straight to the smaller size, which is much faster than decoding the full frame
+QUICKLOOK_BINNING = 4
+
+# Stars are local peaks this many noise levels above the background
+STAR_SIGMA = 5.0
+
+# Pixels this many noise levels above the background are searched for streaks
+STREAK_SIGMA = 3.0
+
+# A streak is reported if at least this many bright (binned) pixels lie on one line
+STREAK_MIN_POINTS = 40
+
+# Only the brightest pixels are searched for streaks, which limits the memory and time used
+STREAK_MAX_POINTS = 5000
+
+# Line angles tried by the streak search, over 180 degrees
+STREAK_ANGLES = 180
+
+# Scheduling priority of the worker processes (nice value). Higher is lower priority, so the capture
+# and motion threads always get the CPU first
+WORKER_NICENESS = 19
+
+# Binary PGM header: magic number, width, height and maximum value, with optional comments
+PGM_HEADER = re.compile(rb"P5(?:\s+#[^\n]*)*\s+(\d+)(?:\s+#[^\n]*)*\s+(\d+)(?:\s+#[^\n]*)*\s+(\d+)\s")
+
+
+def binPixels(pixels, factor):
+    # Average blocks of factor x factor pixels
+    if factor <= 1:
+        return pixels
+    height = pixels.shape[0] - pixels.shape[0] % factor
+    width = pixels.shape[1] - pixels.shape[1] % factor
+    return pixels[:height, :width].reshape(height//factor, factor, width//factor, factor).mean(axis=(1, 3))
+
+
+def loadImage(path, binning=QUICKLOOK_BINNING):
+    ######## loadImage ########
+    # Function: Read an image as a binned greyscale array. Binary PGM files are read with NumPy.
+    #           Anything else (the camera's JPEGs) needs Pillow: python3 -m pip install pillow
+    #
+    # Inputs:
+    # - path: image file
+    # - binning: factor to shrink the image by in each direction
+    #
+    # Return Values:
+    # - pixels: 2D float32 array
+    ##########################
+    with open(path, "rb") as imageFile:
+        start = imageFile.read(64)
+        header = PGM_HEADER.match(start)
+        if header is not None:
+            width, height, maxValue = (int(value) for value in header.groups())
+            imageFile.seek(header.end())
+            dtype = numpy.uint8 if maxValue < 256 else numpy.dtype(">u2")
+            pixels = numpy.fromfile(imageFile, dtype=dtype, count=width*height).reshape(height, width)
+            return binPixels(pixels.astype(numpy.float32), binning)
+
+    from PIL import Image
+    with Image.open(path) as image:
+        fullWidth = image.size[0]
+        # Lets the JPEG decoder skip straight to a reduced size, in greyscale
+        image.draft("L", (fullWidth//binning, image.size[1]//binning))
+        pixels = numpy.asarray(image.convert("L"), dtype=numpy.float32)
+    # draft() only shrinks by the factors the decoder supports, so bin the rest of the way
+    return binPixels(pixels, max(1, binning//max(1, fullWidth//pixels.shape[1])))
+
+
+def analyseImage(pixels):
+    ######## analyseImage ########
+    # Function: Measure the background, count the stars and look for a satellite streak
+    #
+    # Inputs:
+    # - pixels: 2D float32 greyscale array
+    #
+    # Return Values:
+    # - stats: dictionary of background, noise, stars, streak (True/False), streakLength (binned
+    #          pixels) and streakAngle (degrees from the image x axis)
+    ##########################
+    # The median and median absolute deviation aren't pulled up by stars or the streak
+    sample = pixels[::4, ::4]
+    background = float(numpy.median(sample))
+    noise = 1.4826*float(numpy.median(numpy.abs(sample - background)))
+    noise = max(noise, 1e-3)
+
+    # Stars: pixels above the threshold that are brighter than their eight neighbours. Ties are
+    # broken one way, so a flat topped (saturated) star is only counted once
+    height, width = pixels.shape
+    core = pixels[1:-1, 1:-1]
+    peaks = core > background + STAR_SIGMA*noise
+    for dy, dx in ((-1, -1), (-1, 0), (-1, 1), (0, -1)):
+        peaks &= core > pixels[1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+    for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        peaks &= core >= pixels[1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+    starYs, starXs = numpy.nonzero(peaks)
+
+    # Streak: the line through the most bright pixels, found with a Hough transform
+    ys, xs = numpy.nonzero(pixels > background + STREAK_SIGMA*noise)
+    streakPoints = 0
+    streakLength = 0.0
+    streakAngle = 0.0
+    if len(xs) > 0:
+        if len(xs) > STREAK_MAX_POINTS:
+            brightest = numpy.argpartition(pixels[ys, xs], -STREAK_MAX_POINTS)[-STREAK_MAX_POINTS:]
+            ys = ys[brightest]
+            xs = xs[brightest]
+        angles = numpy.linspace(0, numpy.pi, STREAK_ANGLES, endpoint=False)
+        diagonal = int(numpy.ceil(numpy.hypot(height, width)))
+        # Distance of the line through each point from the origin, at each angle
+        rho = numpy.rint(numpy.outer(xs, numpy.cos(angles)) + numpy.outer(ys, numpy.sin(angles))).astype(numpy.int64) + diagonal
+        votes = numpy.bincount((rho + numpy.arange(STREAK_ANGLES)*(2*diagonal + 1)).ravel(),
+                               minlength=STREAK_ANGLES*(2*diagonal + 1))
+        best = int(numpy.argmax(votes))
+        streakPoints = int(votes[best])
+        angleIndex, bestRho = divmod(best, 2*diagonal + 1)
+        onLine = rho[:, angleIndex] == bestRho
+        # The line runs at right angles to the angle of its normal
+        along = -xs[onLine]*numpy.sin(angles[angleIndex]) + ys[onLine]*numpy.cos(angles[angleIndex])
+        streakLength = float(along.max() - along.min())
+        streakAngle = float((numpy.degrees(angles[angleIndex]) + 90) % 180)
+
+    streak = streakPoints >= STREAK_MIN_POINTS
+    if streak:
+        # Noise along the streak makes peaks that aren't stars
+        distance = (starXs + 1)*numpy.cos(angles[angleIndex]) + (starYs + 1)*numpy.sin(angles[angleIndex]) + diagonal - bestRho
+        stars = int(numpy.count_nonzero(numpy.abs(distance) > 2))
+    else:
+        stars = len(starXs)
+    return {"background": background, "noise": noise, "stars": stars, "streak": streak,
+            "streakLength": streakLength if streak else 0.0, "streakAngle": streakAngle if streak else 0.0}
+
+
+def lowerPriority():
+    # Run in each worker process as it starts
+    try:
+        os.nice(WORKER_NICENESS)
+    except OSError:
+        pass
+
+
+def analyseFile(path, binning=QUICKLOOK_BINNING):
+    # Run in the worker processes. Errors are passed back rather than raised, so one bad file is just logged
+    try:
+        return analyseImage(loadImage(path, binning)), None
+    except Exception as error:
+        return None, type(error).__name__ + ": " + str(error)
+
+
+class QuickLook:
+    # Analyses downloaded images in a pool of worker processes. Only the file name is passed to a
+    # worker, and the number of images waiting or being analysed is limited. When the limit is
+    # reached new images are skipped rather than queued, so the memory used stays bounded and the
+    # analysis never falls further and further behind the camera
+
+    def __init__(self, workers, limit, onResult):
+        ######## QuickLook ########
+        # Inputs:
+        # - workers: number of worker processes
+        # - limit: most images waiting or being analysed at once
+        # - onResult: function called with (CaptureResult, stats, error) for each image, from a
+        #             thread of the pool. stats is None if the analysis failed
+        ##########################
+        # Forked, as OS3_1.0.py has no main guard for spawned workers to import it with. Create the
+        # pool before any other thread starts
+        self.pool = multiprocessing.get_context("fork").Pool(workers, lowerPriority)
+        self.slots = threading.BoundedSemaphore(limit)
+        self.onResult = onResult
+        self.skipped = 0
+        self.closed = False
+
+
+    def submit(self, result, path):
+        ######## submit ########
+        # Function: Queue a downloaded image for analysis, unless too many are already waiting
+        #
+        # Inputs:
+        # - result: CaptureResult of the image
+        # - path: where the image was saved
+        #
+        # Return Values:
+        # - queued: False if the image was skipped
+        ##########################
+        if self.closed or not self.slots.acquire(blocking=False):
+            self.skipped = self.skipped + 1
+            return False
+
+        def finished(output):
+            self.slots.release()
+            stats, error = output
+            self.onResult(result, stats, error)
+
+        def failed(error):
+            self.slots.release()
+            self.onResult(result, None, str(error))
+
+        self.pool.apply_async(analyseFile, (path,), callback=finished, error_callback=failed)
+        return True
+
+
+    def close(self):
+        ######## close ########
+        # Function: Wait for the images already queued and stop the workers
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.close()
+        self.pool.join()
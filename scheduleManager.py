@@ -1,11 +1,32 @@
 import csv
 import shutil
 import os
+import bisect
+from datetime import datetime
+
+
+class ScheduleEntry:
+    # One target from the schedule, with the values already parsed
+    __slots__ = ("name", "catalogNumber", "azimuth", "elevation", "time", "timeString", "priority", "shutterSpeed", "aperture", "sequence")
+
+    def __init__(self, name, catalogNumber, azimuth, elevation, time, timeString, priority, shutterSpeed=None, aperture=None, sequence=None):
+        self.name = name
+        self.catalogNumber = catalogNumber
+        self.azimuth = azimuth
+        self.elevation = elevation
+        self.time = time                # Culmination time as a timestamp
+        self.timeString = timeString    # Culmination time as written in the schedule
+        self.priority = priority
+        self.shutterSpeed = shutterSpeed    # Camera settings for this target, or None for the defaults
+        self.aperture = aperture
+        self.sequence = sequence        # Name of the imaging sequence for this target, or None for the default
 
 
 class Schedule:
     def __init__(self):
-        self.list = []
+        # Entries are kept in culmination time order. times holds the same order for searching
+        self.entries = []
+        self.times = []
 
 
     def copyFile(self, source):
@@ -22,13 +43,19 @@ class Schedule:
 
 
     def open(self, filename):
+        ######## open ########
+        # Function: Read a schedule file, one row at a time, into the time ordered list of entries.
+        #           Opening more than one file (e.g. one per night) merges them
+        #
+        # Inputs:
+        # - filename: path of the schedule CSV file
+        #
+        # Return Values:
+        # - success: False if the file couldn't be read or has the wrong format
+        ##########################
         print("Opening", filename)
-        tempList = []
         try:
-            with open(filename, 'r') as scheduleFile:
-                fileRow = csv.reader(scheduleFile)
-                for row in fileRow:
-                    tempList.append(row)
+            scheduleFile = open(filename, 'r')
         except FileNotFoundError:
             print("Error: Schedule file not found.")
             return False
@@ -36,32 +63,111 @@ class Schedule:
             print("Error opening schedule file.")
             return False
 
+        with scheduleFile:
+            fileRow = csv.reader(scheduleFile)
+            try:
+                header = next(fileRow)
+            except StopIteration:
+                header = []
+            except:
+                print("Error opening schedule file.")
+                return False
 
-        # Now check the schedule is OK
-        #validFormat = True
-        if tempList[0][0] != "Sat Name":
-            validFormat = False
-            print("Error: Invalid Schedule Format (Sat Name)")
-        elif tempList[0][1] != "Catalog No":
-            validFormat = False
-            print("Error: Invalid Schedule Format (Catalog No)")
-        elif tempList[0][10] != "Culmination AZ (deg)":
-            validFormat = False
-            print("Error: Invalid Schedule Format (Culmination Az (deg))")
-        elif tempList[0][11] != "Culmination EL (deg)":
-            validFormat = False
-            print("Error: Invalid Schedule Format (Culmination EL (deg))")
-        elif tempList[0][13] != "Culmination Date":
-            validFormat = False
-            print("Error: Invalid Schedule Format (Culmination Date)")
-        else:
-            validFormat = True
-
-        if validFormat:
-            # Copy only the relevant information into the list to keep
-            self.list.append(["Name", "Catalog Number", "Azimuth", "Elevation", "Time"])
-            for row in tempList[1:]:
-                self.list.append([row[0], row[1], row[10], row[11], row[13]])
-            return True
-        else:
-            return False
\ No newline at end of file
+            # Now check the schedule is OK
+            if len(header) < 14:
+                validFormat = False
+                print("Error: Invalid Schedule Format (missing columns)")
+            elif header[0] != "Sat Name":
+                validFormat = False
+                print("Error: Invalid Schedule Format (Sat Name)")
+            elif header[1] != "Catalog No":
+                validFormat = False
+                print("Error: Invalid Schedule Format (Catalog No)")
+            elif header[10] != "Culmination AZ (deg)":
+                validFormat = False
+                print("Error: Invalid Schedule Format (Culmination Az (deg))")
+            elif header[11] != "Culmination EL (deg)":
+                validFormat = False
+                print("Error: Invalid Schedule Format (Culmination EL (deg))")
+            elif header[13] != "Culmination Date":
+                validFormat = False
+                print("Error: Invalid Schedule Format (Culmination Date)")
+            else:
+                validFormat = True
+
+            if not validFormat:
+                return False
+
+            # Optional column giving the importance of each target. Defaults to 1
+            if "Priority" in header:
+                priorityColumn = header.index("Priority")
+            else:
+                priorityColumn = None
+            # Optional columns giving the camera settings and imaging sequence for each target
+            cameraColumns = [header.index(name) if name in header else None for name in ("Shutter Speed", "Aperture", "Sequence")]
+
+            # Parse only the relevant information from each row as it is read
+            newEntries = []
+            try:
+                for row in fileRow:
+                    entry = self.parseRow(row, priorityColumn, cameraColumns, fileRow.line_num)
+                    if entry is not None:
+                        newEntries.append(entry)
+            except:
+                print("Error reading schedule file.")
+                return False
+
+        # Schedules are normally written in time order, so this sort is quick
+        self.entries.extend(newEntries)
+        self.entries.sort(key=lambda entry: entry.time)
+        self.times = [entry.time for entry in self.entries]
+        print("Loaded", len(newEntries), "targets.")
+        return True
+
+
+    def parseRow(self, row, priorityColumn, cameraColumns, lineNumber):
+        ######## parseRow ########
+        # Function: Check one schedule row and convert it to a ScheduleEntry
+        #
+        # Inputs:
+        # - row: list of strings from the CSV reader
+        # - priorityColumn: index of the Priority column, or None
+        # - cameraColumns: indexes of the Shutter Speed, Aperture and Sequence columns, or None for each
+        # - lineNumber: line in the file, for error messages
+        #
+        # Return Values:
+        # - entry: the ScheduleEntry, or None if the row is invalid
+        ##########################
+        if len(row) == 0:
+            return None
+        try:
+            azimuth = float(row[10])
+            elevation = float(row[11])
+            # Timestamps are taken the same way as datetime.utcnow().timestamp(), so they can be compared
+            time = datetime.fromisoformat(row[13]).timestamp()
+            if priorityColumn is not None and row[priorityColumn] != "":
+                priority = float(row[priorityColumn])
+            else:
+                priority = 1.0
+        except (ValueError, IndexError):
+            print("Skipping invalid schedule row on line", lineNumber)
+            return None
+        if not (0 <= azimuth <= 360 and -90 <= elevation <= 90):
+            print("Skipping schedule row on line", lineNumber, "(position out of range)")
+            return None
+        shutterSpeed, aperture, sequence = (row[column].strip() or None if column is not None and column < len(row) else None
+                                            for column in cameraColumns)
+        return ScheduleEntry(row[0], row[1], azimuth, elevation, time, row[13], priority, shutterSpeed, aperture, sequence)
+
+
+    def upcoming(self, fromTime):
+        ######## upcoming ########
+        # Function: Find the entries still to come
+        #
+        # Inputs:
+        # - fromTime: timestamp. Entries culminating before this are past due and skipped
+        #
+        # Return Values:
+        # - entries: time ordered list of entries culminating at or after fromTime
+        ##########################
+        return self.entries[bisect.bisect_left(self.times, fromTime):]
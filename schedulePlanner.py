@@ -0,0 +1,138 @@
+import numpy
+
+# Seconds before culmination that the move to a target starts, unless moves start just in time
+MOVE_LEAD = 120
+
+# Time allowed between the end of a move and the first image (in seconds)
+SETTLE_TIME = 1.0
+
+# Rows of the slew matrix worked out at once. Limits the memory used for large schedules
+SLEW_BLOCK_ROWS = 256
+
+
+def slewMatrix(panSteps, tiltSteps, slewTime):
+    ######## slewMatrix ########
+    # Function: Find the slew time between every pair of mount positions
+    #
+    # Inputs:
+    # - panSteps: array of pan motor positions in steps
+    # - tiltSteps: array of tilt motor positions in steps
+    # - slewTime: function taking arrays of pan and tilt steps and returning the move times
+    #
+    # Return Values:
+    # - slews: n x n float32 array. slews[i, j] is the time (in seconds) to move from position i to position j
+    ##########################
+    n = len(panSteps)
+    slews = numpy.empty((n, n), dtype=numpy.float32)
+    for start in range(0, n, SLEW_BLOCK_ROWS):
+        rows = slice(start, start + SLEW_BLOCK_ROWS)
+        slews[rows] = slewTime(numpy.abs(panSteps[rows, None] - panSteps[None, :]),
+                               numpy.abs(tiltSteps[rows, None] - tiltSteps[None, :]))
+    return slews
+
+
+def planNight(targets, startTime, startSteps, pointTargets, slewTime, firstShot=-20, lastShot=20, moveLead=MOVE_LEAD):
+    ######## planNight ########
+    # Function: Choose which targets to image so that the most passes are captured (weighted by
+    #           priority) without a slew running into the previous target's images
+    #
+    # Inputs:
+    # - targets: list of ScheduleEntry objects
+    # - startTime: timestamp from which the mount is free to move
+    # - startSteps: (pan, tilt) position of the mount at startTime, in steps
+    # - pointTargets: function taking arrays of (azimuth, elevation) and returning arrays of
+    #                 (panValid, tiltValid, panStep, tiltStep, flipped)
+    # - slewTime: function taking arrays of pan and tilt steps and returning the move times
+    # - firstShot: offset of the first image from culmination, in seconds. One value, or an array
+    #              with one per target
+    # - lastShot: offset from culmination at which the mount is free after the last image, in
+    #             seconds. One value, or an array with one per target
+    # - moveLead: seconds before culmination that each move starts, or None if moves start just in
+    #             time for the first image. slewTime should then include any margin wanted
+    #
+    # Return Values:
+    # - plan: entries to image, in time order
+    # - dropped: list of (entry, reason) for the targets left out of the plan
+    ##########################
+    dropped = []
+    if not targets:
+        return [], dropped
+
+    # Solve the pointing for every target in one pass
+    azimuths = numpy.array([entry.azimuth for entry in targets])
+    elevations = numpy.array([entry.elevation for entry in targets])
+    panValid, tiltValid, panSteps, tiltSteps, flipped = pointTargets(azimuths, elevations)
+    reachable = panValid & tiltValid
+    for index in numpy.nonzero(~reachable)[0].tolist():
+        dropped.append((targets[index], "Position unreachable"))
+
+    times = numpy.array([entry.time for entry in targets])
+    order = numpy.nonzero(reachable)[0]
+    order = order[numpy.argsort(times[order], kind="stable")]
+    entries = [targets[index] for index in order.tolist()]
+    firstShots = numpy.broadcast_to(numpy.asarray(firstShot, dtype=float), times.shape)[order]
+    endTimes = times[order] + numpy.broadcast_to(numpy.asarray(lastShot, dtype=float), times.shape)[order]
+    times = times[order]
+    pans = panSteps[order]
+    tilts = tiltSteps[order]
+    weights = numpy.array([entry.priority for entry in entries])
+    n = len(entries)
+
+    slews = slewMatrix(pans, tilts, slewTime)
+    startSlews = slewTime(numpy.abs(pans - startSteps[0]), numpy.abs(tilts - startSteps[1]))
+
+    def feasible(freeTime, slew, target):
+        # The move starts at the lead time, or as soon as the mount is free if that is later. A
+        # move started just in time only needs the mount to be free early enough
+        if moveLead is None:
+            moveStart = freeTime
+        else:
+            moveStart = numpy.maximum(times[target] - moveLead, freeTime)
+        return moveStart + slew + SETTLE_TIME <= times[target] + firstShots[target]
+
+    # Longest path through the targets, where one target can follow another if the slew between them fits
+    startFeasible = feasible(startTime, startSlews, numpy.arange(n))
+    best = numpy.where(startFeasible, weights, -numpy.inf)
+    previous = numpy.full(n, -1)
+    for j in range(1, n):
+        fits = feasible(endTimes[:j], slews[:j, j], j)
+        candidates = numpy.where(fits, best[:j], -numpy.inf)
+        i = int(numpy.argmax(candidates))
+        if candidates[i] + weights[j] > best[j]:
+            best[j] = candidates[i] + weights[j]
+            previous[j] = i
+
+    # Follow the best path back from its last target
+    chosen = []
+    if n and numpy.isfinite(best).any():
+        j = int(numpy.argmax(best))
+        while j != -1:
+            chosen.append(j)
+            j = int(previous[j])
+    chosen.reverse()
+    plan = [entries[j] for j in chosen]
+
+    # Explain why each remaining target was left out
+    chosen = numpy.array(chosen, dtype=numpy.int64)
+    chosenSet = set(chosen.tolist())
+    for j in range(n):
+        if j in chosenSet:
+            continue
+        if not numpy.isfinite(best[j]):
+            dropped.append((entries[j], "Not enough time to slew to the target"))
+            continue
+        before = chosen[chosen < j]
+        after = chosen[chosen > j]
+        clashBefore = before[~feasible(endTimes[before], slews[before, j], j)]
+        clashAfter = after[~feasible(endTimes[j], slews[j, after], after)]
+        conflicts = []
+        for k in clashBefore.tolist():
+            conflicts.append(entries[k].name + " at " + entries[k].timeString[11:19] + " (slew %.1f s)" % slews[k, j])
+        for k in clashAfter.tolist():
+            conflicts.append(entries[k].name + " at " + entries[k].timeString[11:19] + " (slew %.1f s)" % slews[j, k])
+        if conflicts:
+            dropped.append((entries[j], "Conflicts with " + ", ".join(conflicts)))
+        else:
+            dropped.append((entries[j], "Lower priority than the targets around it"))
+
+    return plan, dropped
@@ -0,0 +1,997 @@
+# Simulated OS3 hardware, for testing on an ordinary Linux machine without a Pi, motors or camera.
+# RPi.GPIO and gphoto2 are replaced with fake modules and time runs on a virtual clock, so a whole
+# night of OS3_1.0.py (calibration, moves and captures) plays out in a few seconds. The timeline of
+# what the hardware did is printed at the end and saved to timeline.csv
+#
+# Usage: python3 simulator.py [schedule.csv] [--start "YYYY-MM-DD HH:MM:SS"] [--set NAME=VALUE ...]
+# Run python3 simulator.py --help for the other options
+
+import argparse
+import ast
+import builtins
+import contextlib
+import csv
+import datetime as datetimeModule
+import functools
+import os
+import queue     # Imported before the clock is replaced, so queue timeouts stay in real time
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+import numpy
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds of virtual time each clock read takes, so busy-wait loops finish
+CLOCK_READ_COST = 1e-6
+
+# Real seconds a thread has to go without reading the clock before it is treated as blocked.
+# Time only jumps forward while every other thread is asleep or blocked
+IDLE_TIME = 0.002
+
+# Simulated mount. The pins must match OS3_1.0.py
+PAN_PINS = [33, 31, 37, 35, 29, 3, 5]
+TILT_PINS = [19, 21, 13, 15, 23, 7, 11]
+LED_PINS = {40: "Yellow LED", 38: "Red LED"}
+
+# Microsteps between the two limit switches of each axis
+PAN_RANGE = 60210
+TILT_RANGE = 47491
+
+# Camera timing in seconds. Each capture takes CAPTURE_LATENCY plus the shutter speed
+CAPTURE_LATENCY = 0.3
+DOWNLOAD_TIME = 1.5
+CONFIG_TREE_TIME = 0.25     # Reading or writing the whole configuration tree
+CONFIG_SINGLE_TIME = 0.02   # Writing one setting
+BURST_FRAME_TIME = 0.15     # Readout between the images of a burst, in the continuous drive mode
+
+# gphoto2 camera event types, with the library's values
+GP_EVENT_TIMEOUT = 1
+GP_EVENT_FILE_ADDED = 2
+
+# Simulated images: a star field with a satellite streak across it. They are written as binary PGM
+# whatever their name, so the quick-look can read them without Pillow
+SIM_IMAGE_SIZE = (1200, 800)
+SIM_STARS = 150
+SIM_BACKGROUND = 40
+SIM_NOISE = 4
+SIM_IMAGE_VARIETY = 8       # Different images made. They are made before the night starts and reused
+
+# Seconds before the first culmination that the night starts, if no start time is given
+START_LEAD = 600
+
+# Keep the real clock functions and thread primitives for the parts of the simulator that need them
+realMonotonic = time.monotonic
+RealCondition = threading.Condition
+RealLock = threading.Lock
+
+
+class VirtualClock:
+    # Virtual time for every thread in the simulation. time.sleep() jumps straight to the wake up
+    # time once no other thread is running, instead of waiting in real time
+
+    def __init__(self, startTime):
+        ######## VirtualClock ########
+        # Inputs:
+        # - startTime: Unix time the simulation starts at
+        ##########################
+        self.now = startTime
+        self.condition = RealCondition()
+        self.sleepers = {}
+        self.nextWake = float("inf")
+        self.lastRead = {}
+        self.working = set()
+        self.saved = None
+
+    def peek(self):
+        return self.now
+
+    def read(self):
+        ident = threading.get_ident()
+        with self.condition:
+            self.now = self.now + CLOCK_READ_COST
+            self.lastRead[ident] = realMonotonic()
+            if self.now >= self.nextWake:
+                self.condition.notify_all()
+            return self.now
+
+    def blocked(self, ident):
+        # The thread is waiting on a queue or event, so it can't hold up the clock
+        with self.condition:
+            self.lastRead.pop(ident, None)
+
+    def woken(self, idents):
+        # Threads woken by a queue or event count as running until they next block or sleep,
+        # so the clock doesn't run on before they have had a chance to read it
+        with self.condition:
+            realNow = realMonotonic()
+            for ident in idents:
+                self.lastRead[ident] = realNow
+
+    @contextlib.contextmanager
+    def busy(self):
+        # For real work that doesn't read the clock, e.g. writing an image. The thread counts as
+        # running for as long as it takes, except while it sleeps on the clock
+        ident = threading.get_ident()
+        with self.condition:
+            self.working.add(ident)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.working.discard(ident)
+                self.lastRead[ident] = realMonotonic()
+
+    def othersIdle(self, ident):
+        for other in self.working:
+            if other != ident and other not in self.sleepers:
+                return False
+        realNow = realMonotonic()
+        for other, lastRead in self.lastRead.items():
+            if other != ident and other not in self.sleepers and realNow - lastRead < IDLE_TIME:
+                return False
+        return True
+
+    def sleep(self, seconds):
+        ident = threading.get_ident()
+        with self.condition:
+            if seconds > 0:
+                wake = self.now + seconds
+                self.sleepers[ident] = wake
+                self.nextWake = min(self.sleepers.values())
+                self.condition.notify_all()
+                while self.now < wake:
+                    # The thread with the earliest wake up time moves the clock on
+                    if wake <= self.nextWake and self.othersIdle(ident):
+                        self.now = wake
+                        self.condition.notify_all()
+                    else:
+                        self.condition.wait(IDLE_TIME)
+                del self.sleepers[ident]
+                self.nextWake = min(self.sleepers.values(), default=float("inf"))
+            self.lastRead[ident] = realMonotonic()
+
+    def install(self):
+        ######## install ########
+        # Function: Replace the time and datetime clocks with this clock
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        self.saved = (time.time, time.monotonic, time.perf_counter, time.sleep, datetimeModule.datetime, threading.Condition, threading.Lock)
+        VirtualDatetime.clock = self
+        SimCondition.clock = self
+        SimLock.clock = self
+        threading.Condition = SimCondition
+        threading.Lock = SimLock
+        time.time = self.read
+        time.monotonic = self.read
+        time.perf_counter = self.read
+        time.sleep = self.sleep
+        datetimeModule.datetime = VirtualDatetime
+
+    def uninstall(self):
+        time.time, time.monotonic, time.perf_counter, time.sleep, datetimeModule.datetime, threading.Condition, threading.Lock = self.saved
+
+
+class VirtualDatetime(datetimeModule.datetime):
+    # datetime that reads the current time from the virtual clock
+    clock = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.fromtimestamp(cls.clock.read(), tz)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.utcfromtimestamp(cls.clock.read())
+
+    @classmethod
+    def today(cls):
+        return cls.now()
+
+
+class SimCondition(RealCondition):
+    # threading.Condition that tells the virtual clock which threads are blocked. Queues and
+    # events made while the simulation runs use it
+    clock = None
+
+    def __init__(self, lock=None):
+        super().__init__(lock)
+        self.waitingThreads = []
+
+    def wait(self, timeout=None):
+        ident = threading.get_ident()
+        self.waitingThreads.append(ident)
+        self.clock.blocked(ident)
+        try:
+            return super().wait(timeout)
+        finally:
+            if ident in self.waitingThreads:
+                self.waitingThreads.remove(ident)
+            self.clock.woken([ident])
+
+    def notify(self, n=1):
+        self.clock.woken(self.waitingThreads[:n])
+        del self.waitingThreads[:n]
+        super().notify(n)
+
+    def notify_all(self):
+        self.notify(len(self.waitingThreads))
+
+
+class SimLock:
+    # threading.Lock that tells the virtual clock which threads are waiting for it, like
+    # SimCondition. A thread let through by release() counts as running straight away, so the
+    # clock can't run on before it gets the CPU (e.g. a capture waiting for a download to let go of
+    # the camera)
+    clock = None
+
+    def __init__(self):
+        self.lock = RealLock()
+        self.waitingThreads = []
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        ident = threading.get_ident()
+        self.waitingThreads.append(ident)
+        self.clock.blocked(ident)
+        try:
+            return self.lock.acquire(True, timeout)
+        finally:
+            if ident in self.waitingThreads:
+                self.waitingThreads.remove(ident)
+            self.clock.woken([ident])
+
+    def release(self):
+        if self.waitingThreads:
+            self.clock.woken(self.waitingThreads[:])
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def _at_fork_reinit(self):
+        # Called in forked processes (the quick-look workers) by the threading module
+        self.lock._at_fork_reinit()
+        self.waitingThreads = []
+
+    __enter__ = acquire
+
+    def __exit__(self, *exception):
+        self.release()
+
+
+class SimAxis:
+    # One motor of the mount. Position is in microsteps from the lower limit switch
+
+    def __init__(self, name, pins, switchRange, position):
+        self.name = name
+        self.direction = pins[0]
+        self.step = pins[1]
+        self.enable = pins[4]
+        self.switch1 = pins[5]
+        self.switch2 = pins[6]
+        self.switchRange = switchRange
+        self.position = position
+        self.segmentStart = None
+
+    def pressed(self, pin, position):
+        # switch1 is at the lower end of travel and switch2 at the upper end. Works on arrays too
+        if pin == self.switch1:
+            return position <= 0
+        return position >= self.switchRange
+
+
+class SimHardware:
+    # Fake RPi.GPIO. Tracks pin states, moves the axes on STEP pulses and reads the limit switches
+    # from the axis positions. Everything the hardware does is added to the timeline
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock, panStart=None, tiltStart=None):
+        ######## SimHardware ########
+        # Inputs:
+        # - clock: VirtualClock used to time stamp the timeline
+        # - panStart: optional. Starting pan position in microsteps from the lower switch. Random if None
+        # - tiltStart: optional. Starting tilt position in microsteps from the lower switch. Random if None
+        ##########################
+        if panStart is None:
+            panStart = random.randint(1, PAN_RANGE - 1)
+        if tiltStart is None:
+            tiltStart = random.randint(1, TILT_RANGE - 1)
+        self.clock = clock
+        self.axes = [SimAxis("Pan", PAN_PINS, PAN_RANGE, panStart), SimAxis("Tilt", TILT_PINS, TILT_RANGE, tiltStart)]
+        self.stepAxes = {axis.step: axis for axis in self.axes}
+        self.enableAxes = {axis.enable: axis for axis in self.axes}
+        self.switchAxes = {}
+        for axis in self.axes:
+            self.switchAxes[axis.switch1] = axis
+            self.switchAxes[axis.switch2] = axis
+        self.state = {}
+        self.switchState = {}
+        # Edge detection: pin to (edge, callback), and the switch levels last seen by it
+        self.edgeCallbacks = {}
+        self.switchLevels = {}
+        self.timeline = []
+        self.timelineLock = threading.Lock()
+
+    def record(self, kind, detail):
+        with self.timelineLock:
+            self.timeline.append((self.clock.peek(), kind, detail))
+
+    def module(self):
+        ######## module ########
+        # Function: Build the fake RPi.GPIO module
+        #
+        # Inputs: None
+        #
+        # Return Values:
+        # - gpioModule: module with the RPi.GPIO functions and constants used by OS3
+        ##########################
+        gpioModule = types.ModuleType("RPi.GPIO")
+        for name in ("BOARD", "BCM", "OUT", "IN", "LOW", "HIGH", "PUD_OFF", "PUD_DOWN", "PUD_UP", "RISING", "FALLING", "BOTH"):
+            setattr(gpioModule, name, getattr(self, name))
+        for name in ("setwarnings", "setmode", "setup", "output", "input", "cleanup", "PWM", "add_event_detect", "remove_event_detect"):
+            setattr(gpioModule, name, getattr(self, name))
+        return gpioModule
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def cleanup(self, pins=None):
+        pass
+
+    def setup(self, pins, mode, pull_up_down=None, initial=None):
+        if initial is not None:
+            self.output(pins, initial)
+
+    def output(self, pins, values):
+        if not isinstance(pins, (list, tuple)):
+            pins = [pins]
+        if not isinstance(values, (list, tuple)):
+            values = [values] * len(pins)
+        for pin, value in zip(pins, values):
+            value = int(bool(value))
+            old = self.state.get(pin, self.LOW)
+            self.state[pin] = value
+            if pin in self.stepAxes and value == self.HIGH and old == self.LOW:
+                self.stepAxis(self.stepAxes[pin], 1)
+            elif pin in self.enableAxes and value != old:
+                self.enableChanged(self.enableAxes[pin], value)
+            elif pin in LED_PINS and value != old:
+                self.record("LED", LED_PINS[pin] + (" on" if value else " off"))
+
+    def input(self, pin):
+        if pin in self.switchAxes:
+            axis = self.switchAxes[pin]
+            pressed = bool(axis.pressed(pin, axis.position))
+            if pressed and not self.switchState.get(pin, False):
+                self.record("Switch", axis.name + " switch " + str(pin) + " pressed at " + str(axis.position))
+            self.switchState[pin] = pressed
+            return self.LOW if pressed else self.HIGH
+        return self.state.get(pin, self.HIGH)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if pin in self.edgeCallbacks:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        self.edgeCallbacks[pin] = (edge, callback)
+        if pin in self.switchAxes:
+            axis = self.switchAxes[pin]
+            self.switchLevels[pin] = bool(axis.pressed(pin, axis.position))
+
+    def remove_event_detect(self, pin):
+        self.edgeCallbacks.pop(pin, None)
+
+    def switchEdges(self, axis):
+        # Call the edge detection callbacks of any of the axis' switches that changed
+        for pin in (axis.switch1, axis.switch2):
+            if pin not in self.edgeCallbacks:
+                continue
+            pressed = bool(axis.pressed(pin, axis.position))
+            if pressed == self.switchLevels.get(pin):
+                continue
+            self.switchLevels[pin] = pressed
+            edge, callback = self.edgeCallbacks[pin]
+            # Pressing a switch pulls its pin low
+            if callback is not None and edge in (self.BOTH, self.FALLING if pressed else self.RISING):
+                callback(pin)
+
+    def stepAxis(self, axis, steps):
+        # Move an axis the given number of pulses in the direction set on its DIR pin
+        if self.state.get(axis.enable, self.HIGH) != self.LOW:
+            return
+        if self.state.get(axis.direction, self.LOW) == self.HIGH:
+            axis.position = axis.position + steps
+        else:
+            axis.position = axis.position - steps
+        self.switchEdges(axis)
+
+    def enableChanged(self, axis, value):
+        # Each period the driver is enabled is recorded as one movement on the timeline
+        if value == self.LOW:
+            axis.segmentStart = (self.clock.peek(), axis.position)
+        elif axis.segmentStart is not None:
+            startTime, startPosition = axis.segmentStart
+            axis.segmentStart = None
+            if axis.position != startPosition:
+                self.record("Motion", "%s %d -> %d (%+d steps, %.2f s)" % (axis.name, startPosition, axis.position,
+                                                                          axis.position - startPosition, self.clock.peek() - startTime))
+
+    def PWM(self, pin, frequency):
+        return SimPWM(self, pin)
+
+    def createBackend(self, name):
+        # Every pulse backend is replaced by the simulated one
+        return SimBackend(self)
+
+
+class SimPWM:
+    def __init__(self, hardware, pin):
+        self.hardware = hardware
+        self.pin = pin
+
+    def start(self, dutyCycle):
+        self.hardware.record("LED", LED_PINS.get(self.pin, str(self.pin)) + " flashing")
+
+    def stop(self):
+        self.hardware.record("LED", LED_PINS.get(self.pin, str(self.pin)) + " stopped flashing")
+
+    def ChangeFrequency(self, frequency):
+        pass
+
+    def ChangeDutyCycle(self, dutyCycle):
+        pass
+
+
+class SimBackend:
+    # Pulse backend for the simulated axes. Works out the whole pulse train at once, including
+    # where a limit switch is hit, and sleeps on the virtual clock for as long as it would take
+
+    def __init__(self, hardware):
+        self.hardware = hardware
+
+    def play(self, stepPins, delay, stepMasks, switchPins, checkSwitches):
+        ######## play ########
+        # Function: Simulate sending one pulse per entry in the delay profile
+        #
+        # Inputs:
+        # - stepPins: list of BOARD numbers of the STEP pins
+        # - delay: array of half-period delays (in seconds), one per tick
+        # - stepMasks: list of boolean arrays, one per step pin, True on the ticks where that
+        #              pin pulses. None pulses every pin on every tick
+        # - switchPins: limit switch pins to watch
+        # - checkSwitches: stop the pulse train if a switch is pressed
+        #
+        # Return Values:
+        # - ticksSent: number of ticks sent
+        # - switchPin: the switch that stopped the pulse train, or None
+        # - elapsed: time the pulses take (in seconds)
+        ##########################
+        hardware = self.hardware
+        ticks = len(delay)
+        ticksSent = ticks
+        switchPin = None
+        paths = []
+        for i, pin in enumerate(stepPins):
+            axis = hardware.stepAxes[pin]
+            if stepMasks is None:
+                mask = numpy.ones(ticks, dtype=numpy.int64)
+            else:
+                mask = numpy.asarray(stepMasks[i][:ticks], dtype=numpy.int64)
+            if hardware.state.get(axis.enable, hardware.HIGH) != hardware.LOW:
+                mask = numpy.zeros(ticks, dtype=numpy.int64)
+            if hardware.state.get(axis.direction, hardware.LOW) == hardware.LOW:
+                mask = -mask
+            path = axis.position + numpy.cumsum(mask)
+            paths.append((axis, path))
+            if checkSwitches:
+                for pin in (axis.switch1, axis.switch2):
+                    if pin in switchPins:
+                        hits = numpy.flatnonzero(axis.pressed(pin, path))
+                        if len(hits) > 0 and hits[0] + 1 <= ticksSent:
+                            ticksSent = int(hits[0]) + 1
+                            switchPin = pin
+
+        elapsed = 2*float(numpy.sum(delay[:ticksSent]))
+        time.sleep(elapsed)
+        for axis, path in paths:
+            if ticksSent > 0:
+                axis.position = int(path[ticksSent - 1])
+        if switchPin is not None:
+            axis = hardware.switchAxes[switchPin]
+            hardware.switchState[switchPin] = True
+            hardware.record("Switch", axis.name + " switch " + str(switchPin) + " pressed at " + str(axis.position))
+        for axis, path in paths:
+            hardware.switchEdges(axis)
+        return ticksSent, switchPin, elapsed
+
+
+class SimWidget:
+    # Camera setting in the fake gphoto2 config tree
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def get_name(self):
+        return self.name
+
+    def get_value(self):
+        return self.value
+
+    def set_value(self, value):
+        self.value = value
+
+
+class SimConfig:
+    def __init__(self, widgets):
+        self.widgets = widgets
+
+    def get_child_by_name(self, name):
+        return self.widgets[name]
+
+
+class SimFilePath:
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+
+
+class SimCameraFile:
+    def __init__(self, name, clock=None):
+        self.name = name
+        self.clock = clock      # Virtual clock to mark busy while the image is written, if any
+
+    def save(self, path):
+        # The images are made before the night starts, so saving one is just a write
+        busy = self.clock.busy() if self.clock is not None else contextlib.nullcontext()
+        with busy, open(path, "wb") as imageFile:
+            imageFile.write(starField(zlib.crc32(self.name.encode()) % SIM_IMAGE_VARIETY))
+
+
+def writeStarField(path, seed, size=SIM_IMAGE_SIZE):
+    # Write a simulated image to a file
+    with open(path, "wb") as imageFile:
+        imageFile.write(starField(seed, size))
+
+
+@functools.lru_cache(maxsize=SIM_IMAGE_VARIETY)
+def starField(seed, size=SIM_IMAGE_SIZE):
+    ######## starField ########
+    # Function: Make a simulated image: background noise, stars and one satellite streak
+    #
+    # Inputs:
+    # - seed: random seed, so the same seed always gives the same image
+    # - size: (width, height) in pixels
+    #
+    # Return Values:
+    # - image: the image as a binary PGM file
+    ##########################
+    random = numpy.random.default_rng(seed)
+    width, height = size
+    pixels = random.normal(SIM_BACKGROUND, SIM_NOISE, (height, width))
+    offsets = numpy.arange(-4, 5)
+    for x, y, brightness in zip(random.uniform(5, width - 5, SIM_STARS), random.uniform(5, height - 5, SIM_STARS),
+                                random.uniform(20, 200, SIM_STARS)):
+        column = numpy.exp(-((offsets + int(y) - y)**2)/2.0)
+        row = numpy.exp(-((offsets + int(x) - x)**2)/2.0)
+        pixels[int(y) - 4:int(y) + 5, int(x) - 4:int(x) + 5] += brightness*numpy.outer(column, row)
+    start = random.uniform((0, 0), (width, height))
+    angle = random.uniform(0, numpy.pi)
+    along = numpy.linspace(-400, 400, 3200)
+    streakXs = numpy.rint(start[0] + along*numpy.cos(angle)).astype(int)
+    streakYs = numpy.rint(start[1] + along*numpy.sin(angle)).astype(int)
+    inside = (streakXs >= 0) & (streakXs < width) & (streakYs >= 0) & (streakYs < height)
+    pixels[streakYs[inside], streakXs[inside]] += 60
+    return b"P5 %d %d 255\n" % (width, height) + numpy.clip(pixels, 0, 255).astype(numpy.uint8).tobytes()
+
+
+class SimCamera:
+    # Fake gphoto2 camera. Captures take CAPTURE_LATENCY plus the shutter speed on the virtual clock.
+    # In the "Burst" capture mode, trigger_capture() takes "burstnumber" images, which are reported
+    # by wait_for_event() as they finish
+
+    def __init__(self, hardware, connected=True):
+        self.hardware = hardware
+        self.connected = connected
+        self.settings = {"shutterspeed": "1", "aperture": "4", "capturemode": "Single Shot", "burstnumber": "1"}
+        self.imageCount = 0
+        # Images of a triggered burst still to finish, and the name of the next one
+        self.burstFrames = 0
+        self.burstName = None
+
+    def init(self):
+        if not self.connected:
+            raise SimGPhoto2Error("No camera found")
+
+    def exit(self):
+        pass
+
+    def get_summary(self):
+        return "Simulated camera"
+
+    def get_config(self):
+        time.sleep(CONFIG_TREE_TIME)
+        return SimConfig({name: SimWidget(name, value) for name, value in self.settings.items()})
+
+    def set_config(self, config):
+        time.sleep(CONFIG_TREE_TIME)
+        for name, widget in config.widgets.items():
+            if self.settings[name] != widget.value:
+                self.hardware.record("Camera", "Set " + name + " to " + widget.value)
+            self.settings[name] = widget.value
+
+    def set_single_config(self, name, widget):
+        time.sleep(CONFIG_SINGLE_TIME)
+        if self.settings[name] != widget.value:
+            self.hardware.record("Camera", "Set " + name + " to " + widget.value)
+        self.settings[name] = widget.value
+
+    def exposureTime(self):
+        shutterSpeed = self.settings["shutterspeed"]
+        if "/" in shutterSpeed:
+            numerator, denominator = shutterSpeed.split("/")
+            return float(numerator)/float(denominator)
+        return float(shutterSpeed)
+
+    def capture(self, captureType):
+        name = self.nextImage()
+        time.sleep(CAPTURE_LATENCY + self.exposureTime())
+        self.hardware.record("Capture", name + " finished")
+        return SimFilePath("/store_00020001/DCIM/100CANON", name)
+
+    def nextImage(self):
+        self.imageCount = self.imageCount + 1
+        name = "IMG_%04d.JPG" % self.imageCount
+        self.hardware.record("Capture", name + " started")
+        return name
+
+    def trigger_capture(self):
+        self.burstFrames = int(self.settings["burstnumber"]) if self.settings["capturemode"] == "Burst" else 1
+        self.burstName = self.nextImage()
+        time.sleep(CAPTURE_LATENCY)
+
+    def wait_for_event(self, timeout):
+        if self.burstFrames == 0:
+            time.sleep(timeout/1000)
+            return GP_EVENT_TIMEOUT, None
+        time.sleep(self.exposureTime() + BURST_FRAME_TIME)
+        self.hardware.record("Capture", self.burstName + " finished")
+        filePath = SimFilePath("/store_00020001/DCIM/100CANON", self.burstName)
+        self.burstFrames = self.burstFrames - 1
+        if self.burstFrames > 0:
+            self.burstName = self.nextImage()
+        return GP_EVENT_FILE_ADDED, filePath
+
+    def file_get(self, folder, name, fileType):
+        time.sleep(DOWNLOAD_TIME)
+        self.hardware.record("Download", name)
+        return SimCameraFile(name, self.hardware.clock)
+
+
+class SimGPhoto2Error(Exception):
+    def __init__(self, message, code=-1):
+        super().__init__(message)
+        self.code = code
+
+
+def gphoto2Module(camera):
+    ######## gphoto2Module ########
+    # Function: Build the fake gphoto2 module around a simulated camera
+    #
+    # Inputs:
+    # - camera: SimCamera returned by gphoto2.Camera()
+    #
+    # Return Values:
+    # - gpModule: module with the gphoto2 functions and constants used by OS3
+    ##########################
+    gpModule = types.ModuleType("gphoto2")
+    gpModule.GP_OK = 0
+    gpModule.GP_ERROR = -1
+    gpModule.GP_ERROR_NOT_SUPPORTED = -6
+    gpModule.GP_CAPTURE_IMAGE = 0
+    gpModule.GP_FILE_TYPE_NORMAL = 1
+    gpModule.GP_EVENT_TIMEOUT = GP_EVENT_TIMEOUT
+    gpModule.GP_EVENT_FILE_ADDED = GP_EVENT_FILE_ADDED
+    gpModule.GPhoto2Error = SimGPhoto2Error
+    gpModule.Camera = lambda: camera
+
+    def gp_widget_get_child_by_name(config, name):
+        if name in config.widgets:
+            return [gpModule.GP_OK, config.widgets[name]]
+        return [gpModule.GP_ERROR, None]
+    gpModule.gp_widget_get_child_by_name = gp_widget_get_child_by_name
+    return gpModule
+
+
+def writeSchedule(filename, startTime, targets, spacing=600):
+    ######## writeSchedule ########
+    # Function: Write a schedule of random targets, for when no schedule is given
+    #
+    # Inputs:
+    # - filename: path of the schedule to write
+    # - startTime: naive UTC datetime of the first culmination
+    # - targets: number of targets
+    # - spacing: seconds between culminations
+    #
+    # Return Values: None
+    ##########################
+    header = [""] * 14
+    header[0] = "Sat Name"
+    header[1] = "Catalog No"
+    header[10] = "Culmination AZ (deg)"
+    header[11] = "Culmination EL (deg)"
+    header[13] = "Culmination Date"
+    with open(filename, "w", newline="") as scheduleFile:
+        writer = csv.writer(scheduleFile)
+        writer.writerow(header)
+        for i in range(targets):
+            row = [""] * 14
+            row[0] = "SIM-%d" % (i + 1)
+            row[1] = str(90000 + i)
+            row[10] = "%.2f" % random.uniform(0, 360)
+            row[11] = "%.2f" % random.uniform(20, 85)
+            row[13] = (startTime + datetimeModule.timedelta(seconds=i*spacing)).isoformat(sep=" ")
+            writer.writerow(row)
+
+
+def firstCulmination(filename):
+    # Earliest culmination in a schedule, as a naive UTC datetime
+    with open(filename, "r") as scheduleFile:
+        rows = csv.reader(scheduleFile)
+        next(rows)
+        times = []
+        for row in rows:
+            try:
+                times.append(datetimeModule.datetime.fromisoformat(row[13]))
+            except (ValueError, IndexError):
+                pass
+    return min(times)
+
+
+def applySettings(source, filename, settings):
+    ######## applySettings ########
+    # Function: Compile OS3_1.0.py with some of its top level settings replaced
+    #
+    # Inputs:
+    # - source: text of the script
+    # - filename: path of the script, for error messages
+    # - settings: dictionary of setting name to a Python expression (str)
+    #
+    # Return Values:
+    # - code: compiled script
+    ##########################
+    tree = ast.parse(source, filename)
+    remaining = set(settings)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in remaining:
+                node.value = ast.parse(settings[name], mode="eval").body
+                remaining.discard(name)
+    if remaining:
+        raise ValueError("Unknown setting: " + ", ".join(sorted(remaining)))
+    return compile(ast.fix_missing_locations(tree), filename, "exec")
+
+
+def simulate(workDirectory, scheduleFile=None, startTime=None, settings=None, cameraConnected=True,
+             calibrated=False, panStart=None, tiltStart=None, targets=10, tleFile=None, verbose=False):
+    ######## simulate ########
+    # Function: Run OS3_1.0.py through a night on the simulated hardware
+    #
+    # Inputs:
+    # - workDirectory: folder to run in. Logs, images and the simulated USB drive ("usb") go here
+    # - scheduleFile: optional. Schedule to use. A random schedule is written if None
+    # - startTime: optional. Naive UTC datetime to start at. Defaults to START_LEAD before the first culmination
+    # - settings: optional. Dictionary of OS3_1.0.py setting name to a Python expression (str)
+    # - cameraConnected: False to run without a camera
+    # - calibrated: True to start with a calibration file, so only the quick calibration runs
+    # - panStart, tiltStart: optional. Starting axis positions in microsteps from the lower switch
+    # - targets: number of targets in the random schedule
+    # - tleFile: optional. TLE file put on the simulated USB drive for tracking mode
+    # - verbose: print the OS3 output instead of saving it to os3.log
+    #
+    # Return Values:
+    # - hardware: SimHardware holding the timeline and the final axis positions
+    # - realTime: real seconds the simulation took
+    ##########################
+    # OS3 runs in workDirectory, so the paths given to it must not be relative
+    workDirectory = os.path.abspath(workDirectory)
+    usbDirectory = os.path.join(workDirectory, "usb")
+    os.makedirs(usbDirectory, exist_ok=True)
+    shutil.copy(os.path.join(PACKAGE_DIRECTORY, "ramp.csv"), workDirectory)
+    if scheduleFile is None:
+        firstTime = datetimeModule.datetime.utcnow().replace(microsecond=0) + datetimeModule.timedelta(days=1)
+        writeSchedule(os.path.join(usbDirectory, "schedule.csv"), firstTime, targets)
+    else:
+        shutil.copy(scheduleFile, os.path.join(usbDirectory, "schedule.csv"))
+    if tleFile is not None:
+        shutil.copy(tleFile, os.path.join(usbDirectory, "tle.txt"))
+    if calibrated:
+        with open(os.path.join(workDirectory, "calibration.csv"), "w") as calibrationFile:
+            calibrationFile.write("pan," + str(PAN_RANGE) + "\ntilt," + str(TILT_RANGE))
+    if startTime is None:
+        startTime = firstCulmination(os.path.join(usbDirectory, "schedule.csv")) - datetimeModule.timedelta(seconds=START_LEAD)
+
+    # The metrics server is left off so simulations don't hold a port. --set METRICS_PORT=9101 turns it on
+    # The simulated USB drive is a plain folder, not a mount point
+    allSettings = {"USB_DIRECTORY": repr(usbDirectory), "METRICS_PORT": "None", "USB_MOUNT_CHECK": "False"}
+    # The quick-look workers are processes the virtual clock can't see. If they have to share a core
+    # with the simulation, a thread waiting for the CPU looks idle and the clock runs on past it
+    if (os.cpu_count() or 1) < 4:
+        allSettings["QUICKLOOK_WORKERS"] = str(max(0, (os.cpu_count() or 1) - 1))
+    if settings:
+        allSettings.update(settings)
+    scriptPath = os.path.join(PACKAGE_DIRECTORY, "OS3_1.0.py")
+    with open(scriptPath, "r") as scriptFile:
+        code = applySettings(scriptFile.read(), scriptPath, allSettings)
+
+    for seed in range(SIM_IMAGE_VARIETY):
+        starField(seed)
+    clock = VirtualClock(startTime.replace(tzinfo=datetimeModule.timezone.utc).timestamp())
+    hardware = SimHardware(clock, panStart, tiltStart)
+    camera = SimCamera(hardware, cameraConnected)
+    rpiModule = types.ModuleType("RPi")
+    rpiModule.GPIO = hardware.module()
+    fakeModules = {"RPi": rpiModule, "RPi.GPIO": rpiModule.GPIO, "gphoto2": gphoto2Module(camera)}
+
+    # The OS3 modules are imported fresh so they pick up the fake modules and the virtual clock
+    packageModules = [name for name, module in sys.modules.items()
+                      if os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or "/")) == PACKAGE_DIRECTORY
+                      and name != __name__]
+    savedModules = {name: sys.modules.pop(name) for name in packageModules}
+    savedModules.update({name: sys.modules.get(name) for name in fakeModules})
+    sys.modules.update(fakeModules)
+    savedPath = list(sys.path)
+    sys.path.insert(0, PACKAGE_DIRECTORY)
+    savedDirectory = os.getcwd()
+    savedInput = builtins.input
+    # Answers to the "camera not detected" questions: don't try again, proceed without camera
+    answers = iter(["n", "y"])
+    builtins.input = lambda prompt="": next(answers, "n")
+
+    os.chdir(workDirectory)
+    clock.install()
+    realStart = realMonotonic()
+    try:
+        import pulseBackend
+        pulseBackend.createBackend = hardware.createBackend
+        # Copying to the USB drive is real file work (writes and checksums) between clock reads
+        import usbSync
+        usbSync.UsbSync.syncAll = clockBusy(clock, usbSync.UsbSync.syncAll)
+        with open("os3.log", "w") as logFile:
+            output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(logFile)
+            with output:
+                try:
+                    exec(code, {"__name__": "__main__", "__file__": scriptPath})
+                except SystemExit:
+                    pass
+    finally:
+        realTime = realMonotonic() - realStart
+        clock.uninstall()
+        os.chdir(savedDirectory)
+        builtins.input = savedInput
+        sys.path[:] = savedPath
+        for name in [name for name, module in sys.modules.items()
+                     if os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or "/")) == PACKAGE_DIRECTORY
+                     and name != __name__]:
+            del sys.modules[name]
+        for name, module in savedModules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    with open(os.path.join(workDirectory, "timeline.csv"), "w", newline="") as timelineFile:
+        writer = csv.writer(timelineFile)
+        writer.writerow(["Time", "Event", "Details"])
+        for eventTime, kind, detail in hardware.timeline:
+            writer.writerow([timeString(eventTime), kind, detail])
+    return hardware, realTime
+
+
+def clockBusy(clock, function):
+    # Wrap a function so the thread running it counts as busy on the virtual clock
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with clock.busy():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def timeString(timestamp):
+    return datetimeModule.datetime.fromtimestamp(timestamp, datetimeModule.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def printReport(hardware, realTime):
+    ######## printReport ########
+    # Function: Print the timeline of a simulated night and a summary of it
+    #
+    # Inputs:
+    # - hardware: SimHardware from simulate()
+    # - realTime: real seconds the simulation took
+    #
+    # Return Values: None
+    ##########################
+    print("========== Timeline ==========")
+    for eventTime, kind, detail in hardware.timeline:
+        print(timeString(eventTime)[11:], kind.ljust(9), detail)
+
+    counts = {}
+    for eventTime, kind, detail in hardware.timeline:
+        counts[kind] = counts.get(kind, 0) + 1
+    print("========== Summary ==========")
+    if hardware.timeline:
+        simulatedTime = hardware.timeline[-1][0] - hardware.timeline[0][0]
+        print("Simulated %.0f s of hardware time in %.1f s" % (simulatedTime, realTime))
+    print("Motions:", counts.get("Motion", 0))
+    print("Switch presses:", counts.get("Switch", 0))
+    print("Images:", counts.get("Capture", 0)//2, "captured,", counts.get("Download", 0), "downloaded")
+    for axis in hardware.axes:
+        print(axis.name, "finished at", axis.position, "of", axis.switchRange)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run OS3_1.0.py through a night on simulated hardware")
+    parser.add_argument("schedule", nargs="?", help="schedule CSV file. A random schedule is used if not given")
+    parser.add_argument("--start", help="UTC start time, YYYY-MM-DD HH:MM:SS. Defaults to 10 minutes before the first culmination")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="replace an OS3_1.0.py setting, e.g. --set trackingMode=True")
+    parser.add_argument("--targets", type=int, default=10, help="number of targets in the random schedule")
+    parser.add_argument("--tle", help="TLE file for tracking mode (use with --set trackingMode=True)")
+    parser.add_argument("--no-camera", action="store_true", help="run without a camera connected")
+    parser.add_argument("--calibrated", action="store_true", help="start with a calibration file")
+    parser.add_argument("--output", help="folder for the logs, images and timeline. A temporary folder is used if not given")
+    parser.add_argument("--restart", action="store_true", help="run a second night in the same folder, starting where the first left the mount")
+    parser.add_argument("--seed", type=int, help="random seed for the schedule and starting positions")
+    parser.add_argument("--verbose", action="store_true", help="show the OS3 output")
+    arguments = parser.parse_args()
+
+    if arguments.seed is not None:
+        random.seed(arguments.seed)
+    settings = {}
+    for setting in arguments.set:
+        name, value = setting.split("=", 1)
+        settings[name.strip()] = value.strip()
+    startTime = None
+    if arguments.start:
+        startTime = datetimeModule.datetime.fromisoformat(arguments.start)
+    workDirectory = arguments.output or tempfile.mkdtemp(prefix="os3sim")
+    os.makedirs(workDirectory, exist_ok=True)
+    scheduleFile = os.path.abspath(arguments.schedule) if arguments.schedule else None
+    tleFile = os.path.abspath(arguments.tle) if arguments.tle else None
+
+    hardware, realTime = simulate(os.path.abspath(workDirectory), scheduleFile, startTime, settings,
+                                  not arguments.no_camera, arguments.calibrated, targets=arguments.targets,
+                                  tleFile=tleFile, verbose=arguments.verbose)
+    printReport(hardware, realTime)
+    if arguments.restart:
+        # The second night picks up the mount state saved by the first, as it would after a reboot
+        print("========== Restart ==========")
+        hardware, realTime = simulate(os.path.abspath(workDirectory), None, None, settings, not arguments.no_camera,
+                                      panStart=hardware.axes[0].position, tiltStart=hardware.axes[1].position,
+                                      targets=arguments.targets, tleFile=tleFile, verbose=arguments.verbose)
+        printReport(hardware, realTime)
+    print("Output saved to", workDirectory)
@@ -0,0 +1,64 @@
+import os
+import time
+
+
+def processAge():
+    ######## processAge ########
+    # Function: Find how long ago the process started, so the time spent starting Python and
+    #           importing modules is counted too
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - age: seconds since the process started, or 0 if it can't be read (not Linux)
+    ##########################
+    try:
+        with open("/proc/self/stat", "r") as statFile:
+            # The process name can contain spaces, so count fields from after it
+            fields = statFile.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as uptimeFile:
+            uptime = float(uptimeFile.read().split()[0])
+        return max(uptime - int(fields[19])/os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupTimer:
+    # Records the time from process start to the end of each stage of start up
+
+    def __init__(self):
+        self.start = time.monotonic() - processAge()
+        self.stages = []
+
+
+    def mark(self, stage):
+        ######## mark ########
+        # Function: Record that a stage of start up has finished
+        #
+        # Inputs:
+        # - stage: name of the stage
+        #
+        # Return Values: None
+        ##########################
+        self.stages.append((stage, time.monotonic() - self.start))
+
+
+    def report(self):
+        ######## report ########
+        # Function: Print the time each stage finished and how long it took
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        print("========== Start Up Time ==========")
+        previous = 0.0
+        for stage, finished in self.stages:
+            print("%-20s %8.3f s %+8.3f s" % (stage, finished, finished - previous))
+            previous = finished
+        print("===================================")
+
+
+    def details(self):
+        # Stage end times for the event log
+        return {stage.replace(" ", "_"): "%.3f" % finished for stage, finished in self.stages}
@@ -0,0 +1,128 @@
+import json
+import os
+import queue
+import threading
+import urllib.error
+import urllib.request
+
+# Seconds to wait for the coordinator to answer
+REQUEST_TIMEOUT = 10
+
+# Results are sent once this many are waiting, or when no more have arrived for this many seconds.
+# Results that couldn't be sent are tried again at the same interval
+REPORT_BATCH = 20
+REPORT_INTERVAL = 10.0
+
+# Largest number of results kept while the coordinator can't be reached. The oldest are dropped after that
+PENDING_LIMIT = 5000
+
+
+class StationAgent:
+    # Link from one OS3 station to the coordinator (coordinator.py). Pulls the station's schedule
+    # at start up, and sends capture results back from a background thread, so a slow or missing
+    # network never holds up a capture
+
+    def __init__(self, url, station):
+        ######## StationAgent ########
+        # Inputs:
+        # - url: address of the coordinator, e.g. "http://192.168.1.10:8700"
+        # - station: name of this station in the coordinator's stations file
+        ##########################
+        self.url = url.rstrip("/")
+        self.station = urllib.request.quote(station)
+        self.queue = queue.Queue()
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.sender, daemon=True)
+        self.thread.start()
+
+
+    def fetchSchedule(self, filename):
+        ######## fetchSchedule ########
+        # Function: Download this station's schedule from the coordinator
+        #
+        # Inputs:
+        # - filename: path to save the schedule to. Only replaced if the download succeeds
+        #
+        # Return Values:
+        # - success: False if the coordinator couldn't be reached
+        ##########################
+        try:
+            with urllib.request.urlopen(self.url + "/schedule/" + self.station, timeout=REQUEST_TIMEOUT) as response:
+                text = response.read()
+        except (urllib.error.URLError, OSError) as error:
+            print("Error: Could not get schedule from coordinator (" + str(error) + ")")
+            return False
+        tempName = filename + ".tmp"
+        try:
+            with open(tempName, "wb") as scheduleFile:
+                scheduleFile.write(text)
+            os.replace(tempName, filename)
+        except OSError as error:
+            print("Error: Could not save schedule (" + str(error) + ")")
+            return False
+        return True
+
+
+    def report(self, result):
+        ######## report ########
+        # Function: Queue a finished exposure to be sent to the coordinator
+        #
+        # Inputs:
+        # - result: CaptureResult of the exposure
+        #
+        # Return Values: None
+        ##########################
+        self.queue.put({"target": result.satelliteName, "image": result.numInSequence,
+                        "scheduled": result.scheduledTime, "trigger": result.triggerTime,
+                        "complete": result.completeTime, "file": result.fileName, "error": result.error})
+
+
+    def close(self):
+        ######## close ########
+        # Function: Send everything still queued and stop the thread
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped > 0:
+            print("Warning:", self.dropped, "results could not be sent to the coordinator.")
+
+
+    def send(self, results):
+        # Post a batch of results. False if the coordinator couldn't be reached
+        request = urllib.request.Request(self.url + "/results/" + self.station, data=json.dumps(results).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                response.read()
+            return True
+        except (urllib.error.URLError, OSError) as error:
+            print("Warning: Could not send results to coordinator (" + str(error) + ")")
+            return False
+
+
+    def sender(self):
+        pending = []
+        running = True
+        while running:
+            try:
+                result = self.queue.get(timeout=REPORT_INTERVAL if pending else None)
+            except queue.Empty:
+                result = False
+            if result is None:
+                running = False
+            elif result:
+                pending.append(result)
+                if len(pending) < REPORT_BATCH:
+                    continue
+
+            # Results that couldn't be sent are kept and tried again with the next batch
+            if pending and self.send(pending):
+                pending = []
+            if len(pending) > PENDING_LIMIT:
+                self.dropped = self.dropped + len(pending) - PENDING_LIMIT
+                pending = pending[-PENDING_LIMIT:]
+        self.dropped = self.dropped + len(pending)
@@ -0,0 +1,10 @@
+# The OS3 modules need RPi.GPIO and gphoto2. The tests use the simulator's fake ones, in real time,
+# as the benchmarks do
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+benchmark.installFakeModules()
@@ -0,0 +1,42 @@
+import coordinator
+from imagingSequence import parseSequence
+from scheduleManager import Schedule, ScheduleEntry
+
+SEQUENCES = {
+    "standard": parseSequence([{"offset": offset} for offset in (-20, -10, 0, 10, 20)]),
+    "long": parseSequence([{"offset": -60}, {"offset": 60, "shutterSpeed": "15"}]),
+}
+
+
+def makeEntry(name="SIM-1", sequence=None, shutterSpeed=None):
+    return ScheduleEntry(name, "90000", 120.0, 45.0, 1792361693.0, "2026-10-18 22:14:53", 1.0, shutterSpeed, None, sequence)
+
+
+def makeStation():
+    return coordinator.Station("north", "north.csv", (-96.0, 96.0), (-278.5, 26.8), 0.0, 8, 20.4, 20.4, 30.9, 30.9)
+
+
+def test_passSpanFollowsSequence():
+    station = makeStation()
+    margin = coordinator.CAPTURE_MARGIN
+    assert station.passSpan(makeEntry(), SEQUENCES, "standard") == (-20, 20 + 8 + margin)
+    assert station.passSpan(makeEntry(sequence="long"), SEQUENCES, "standard") == (-60, 60 + 15 + margin)
+    assert station.passSpan(makeEntry(shutterSpeed="1/2"), SEQUENCES, "standard") == (-20, 20 + 0.5 + margin)
+    # An unknown sequence gets the default
+    assert station.passSpan(makeEntry(sequence="missing"), SEQUENCES, "standard") == (-20, 20 + 8 + margin)
+
+
+def test_loadSequencesReadsStationSettings():
+    sequences, defaultSequence = coordinator.loadSequences(coordinator.STATION_SETTINGS)
+    assert defaultSequence in sequences
+    assert "packed" in sequences
+
+
+def test_scheduleTextRoundTrip(tmp_path):
+    entries = [makeEntry('SIM, "QUOTED"', "long", "1/4"), makeEntry("SIM-2")]
+    path = tmp_path / "schedule.csv"
+    path.write_text(coordinator.scheduleText(entries), newline="")
+    schedule = Schedule()
+    assert schedule.open(str(path))
+    assert [(entry.name, entry.sequence, entry.shutterSpeed) for entry in schedule.entries] == \
+        [('SIM, "QUOTED"', "long", "1/4"), ("SIM-2", None, None)]
@@ -0,0 +1,16 @@
+from datetime import datetime
+import eventLog
+
+
+def test_nightNameKeepsNightTogether():
+    evening = datetime(2026, 10, 18, 22, 0).timestamp()
+    morning = datetime(2026, 10, 19, 4, 0).timestamp()
+    assert eventLog.nightName(evening) == "20261018"
+    assert eventLog.nightName(morning) == "20261018"
+
+
+def test_nightNameChangesAtRollover():
+    before = datetime(2026, 10, 19, eventLog.NIGHT_ROLLOVER_HOUR - 1, 59).timestamp()
+    after = datetime(2026, 10, 19, eventLog.NIGHT_ROLLOVER_HOUR, 0).timestamp()
+    assert eventLog.nightName(before) == "20261018"
+    assert eventLog.nightName(after) == "20261019"
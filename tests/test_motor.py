@@ -0,0 +1,55 @@
+import numpy
+import pytest
+import motor
+
+
+class FakeAxis(motor.motor):
+    # An axis with a limit switch at each end of travel. Pulses move the position and stop on a
+    # switch when asked to. A sticky switch stays pressed after the motor has moved off it
+    def __init__(self, lowerSwitch, upperSwitch, position=0, sticky=False):
+        self.enable = motor.PAN_ENABLE
+        self.position = position
+        self.totalSteps = 0
+        self.lowerSwitch = lowerSwitch
+        self.upperSwitch = upperSwitch
+        self.sticky = sticky
+        self.stuck = False
+
+    def switchPressed(self):
+        return self.stuck or self.position <= self.lowerSwitch or self.position >= self.upperSwitch
+
+    def profile(self, steps, speed=None):
+        return numpy.zeros(steps)
+
+    def pulse(self, clockwise, delay, checkSwitches):
+        step = 1 if clockwise else -1
+        for stepsSent in range(len(delay)):
+            if checkSwitches and self.switchPressed():
+                return stepsSent, 3, 0.0
+            self.position = self.position + step
+        if self.sticky and not checkSwitches and len(delay) == motor.HOMING_BACKOFF:
+            self.stuck = True
+        return len(delay), None, 0.0
+
+
+@pytest.fixture(autouse=True)
+def noSleep(monkeypatch):
+    monkeypatch.setattr(motor.time, "sleep", lambda seconds: None)
+
+
+def test_fullCalibrateMeasuresTravel():
+    axis = FakeAxis(-30000, 30000)
+    assert axis.fullCalibrate(None, 45000)
+    assert axis.totalSteps == 60000
+
+
+def test_seekFailsWhenSwitchStaysPressed():
+    axis = FakeAxis(-30000, 30000, sticky=True)
+    assert not axis.seekSwitch(False)
+
+
+def test_fullCalibrateRejectsShortTravel():
+    axis = FakeAxis(-300, 300)
+    axis.totalSteps = 60210
+    assert not axis.fullCalibrate(None, 45000)
+    assert axis.totalSteps == 60210
@@ -0,0 +1,90 @@
+import threading
+import types
+import numpy
+import pulseBackend
+
+
+class FakePi:
+    # Stand-in for a pigpio connection. Records the waves sent, and reads the switch levels from levels
+    def __init__(self, levels):
+        self.levels = levels
+        self.sent = []
+        self.cancelled = 0
+
+    def read(self, gpioNumber):
+        return self.levels.get(gpioNumber, 1)
+
+    def callback(self, gpioNumber, edge, function):
+        pi = self
+
+        class Callback:
+            def cancel(self):
+                pi.cancelled = pi.cancelled + 1
+        return Callback()
+
+    def set_mode(self, gpioNumber, mode):
+        pass
+
+    def wave_clear(self):
+        pass
+
+    def get_current_tick(self):
+        return 0
+
+    def wave_add_generic(self, pulses):
+        self.pulses = pulses
+
+    def wave_create(self):
+        return len(self.sent)
+
+    def wave_send_using_mode(self, waveId, mode):
+        self.sent.append(self.pulses)
+
+    def wave_tx_at(self):
+        return fakePigpio.NO_TX_WAVE
+
+    def wave_tx_busy(self):
+        return False
+
+    def wave_tx_stop(self):
+        pass
+
+    def wave_delete(self, waveId):
+        pass
+
+
+fakePigpio = types.SimpleNamespace(OUTPUT=1, FALLING_EDGE=1, WAVE_MODE_ONE_SHOT_SYNC=3, WAVE_NOT_FOUND=9998,
+                                   NO_TX_WAVE=9999, pulse=lambda on, off, delay: (on, off, delay),
+                                   tickDiff=lambda start, end: end - start)
+
+
+def waveformBackend(levels):
+    # WaveformBackend talking to a FakePi instead of the pigpio daemon
+    backend = pulseBackend.WaveformBackend.__new__(pulseBackend.WaveformBackend)
+    backend.pigpio = fakePigpio
+    backend.pi = FakePi(levels)
+    backend.lock = threading.Lock()
+    return backend
+
+
+def test_waveformStopsOnSwitchClosedAtStart():
+    # Pin 3 (BCM 2) is closed before the move, so there is no edge to stop it
+    backend = waveformBackend({pulseBackend.BOARD_TO_BCM[3]: 0})
+    ticksSent, switchPin, elapsed = backend.play([8], numpy.full(100, 1e-4), None, [3, 5], True)
+    assert (ticksSent, switchPin) == (0, 3)
+    assert backend.pi.sent == []
+    assert backend.pi.cancelled == 2
+
+
+def test_waveformIgnoresClosedSwitchWhenNotChecking():
+    backend = waveformBackend({pulseBackend.BOARD_TO_BCM[3]: 0})
+    ticksSent, switchPin, elapsed = backend.play([8], numpy.full(100, 1e-4), None, [3, 5], False)
+    assert (ticksSent, switchPin) == (100, None)
+    assert len(backend.pi.sent) == 1
+
+
+def test_waveformSendsWholeTrainWithSwitchesOpen():
+    backend = waveformBackend({})
+    ticksSent, switchPin, elapsed = backend.play([8], numpy.full(100, 1e-4), None, [3, 5], True)
+    assert (ticksSent, switchPin) == (100, None)
+    assert len(backend.pi.sent[0]) == 200
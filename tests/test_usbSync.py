@@ -0,0 +1,52 @@
+import os
+import usbSync
+
+
+def makeSync(tmp_path, files):
+    # Copies the named files from tmp_path/sd to tmp_path/usb
+    source = tmp_path / "sd"
+    drive = tmp_path / "usb"
+    source.mkdir()
+    drive.mkdir()
+    for name, contents in files.items():
+        (source / name).write_bytes(contents)
+    listFiles = lambda: [(str(source / name), name) for name in files]
+    return usbSync.UsbSync(str(drive), listFiles, lambda: True, None, 1.0, mountCheck=False), source, drive
+
+
+def test_foreignFileIsMovedAside(tmp_path):
+    sync, source, drive = makeSync(tmp_path, {"20261018.csv": b"new log\n"})
+    (drive / "20261018.csv").write_bytes(b"a longer log from another station\n")
+    assert sync.close()
+    assert (drive / "20261018.csv").read_bytes() == b"new log\n"
+    assert (drive / "20261018.csv.1").read_bytes() == b"a longer log from another station\n"
+
+
+def test_foreignFileOfSameSizeIsMovedAside(tmp_path):
+    sync, source, drive = makeSync(tmp_path, {"20261018.csv": b"new log\n"})
+    (drive / "20261018.csv").write_bytes(b"old log\n")
+    (drive / "20261018.csv.1").write_bytes(b"older\n")
+    assert sync.close()
+    assert (drive / "20261018.csv").read_bytes() == b"new log\n"
+    assert (drive / "20261018.csv.1").read_bytes() == b"older\n"
+    assert (drive / "20261018.csv.2").read_bytes() == b"old log\n"
+
+
+def test_grownLogIsExtended(tmp_path):
+    sync, source, drive = makeSync(tmp_path, {"20261018.csv": b"line 1\n"})
+    assert sync.close()
+    with open(source / "20261018.csv", "ab") as logFile:
+        logFile.write(b"line 2\n")
+    assert sync.close()
+    assert (drive / "20261018.csv").read_bytes() == b"line 1\nline 2\n"
+    assert sorted(os.listdir(drive)) == [".os3sync.json", "20261018.csv"]
+
+
+def test_unrecordedCopyIsCarriedOn(tmp_path):
+    # The drive was pulled out before the record of the first copy was saved
+    sync, source, drive = makeSync(tmp_path, {"20261018.csv": b"line 1\nline 2\n"})
+    (drive / "20261018.csv").write_bytes(b"line 1\n")
+    assert sync.close()
+    assert (drive / "20261018.csv").read_bytes() == b"line 1\nline 2\n"
+    assert sync.copiedBytes == len(b"line 2\n")
+    assert sorted(os.listdir(drive)) == [".os3sync.json", "20261018.csv"]
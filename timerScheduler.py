@@ -0,0 +1,108 @@
+import heapq
+import time
+from datetime import datetime
+
+# Sleep in steps of at most this long while waiting for an event, so the clock display updates
+COARSE_SLEEP = 1.0
+
+# Once an event is this close, switch from the wall clock to the monotonic clock
+FINE_WINDOW = 1.5
+
+# Sleep until this close to an event, then busy-wait the rest
+SPIN_THRESHOLD = 0.002
+
+
+def wallTime():
+    ######## wallTime ########
+    # Function: Current time on the same scale as the schedule timestamps
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - time: current UTC time as a timestamp
+    ##########################
+    return datetime.utcnow().timestamp()
+
+
+def waitForTime(eventTime, showClock=False):
+    ######## waitForTime ########
+    # Function: Wait until a UTC timestamp
+    #
+    # Inputs:
+    # - eventTime: UTC timestamp to wait for
+    # - showClock: print the current time once a second while waiting
+    #
+    # Return Values: None
+    ##########################
+    # Far from the event, follow the wall clock so GPS/NTP corrections are picked up
+    remaining = eventTime - wallTime()
+    while remaining > FINE_WINDOW:
+        if showClock:
+            print("Current Time:", datetime.utcnow().strftime("%H:%M:%S"), "\r", end="")
+        time.sleep(min(COARSE_SLEEP, remaining - FINE_WINDOW))
+        remaining = eventTime - wallTime()
+
+    # Close to the event, time the rest of the wait on the monotonic clock
+    deadline = time.monotonic() + remaining
+    if remaining > SPIN_THRESHOLD:
+        time.sleep(remaining - SPIN_THRESHOLD)
+    while time.monotonic() < deadline:
+        pass
+
+
+class TimerScheduler:
+    # Runs timed actions (moves, exposures, LED changes) in time order from a single queue.
+    # Waits sleep until shortly before each action and then busy-wait for the last couple of
+    # milliseconds, so the CPU is idle between actions
+
+    def __init__(self, showClock=True):
+        self.queue = []
+        self.count = 0
+        self.showClock = showClock
+        self.current = None
+
+    def at(self, eventTime, action, *args):
+        ######## at ########
+        # Function: Add an action to the queue
+        #
+        # Inputs:
+        # - eventTime: UTC timestamp at which to run the action
+        # - action: function to call
+        # - args: arguments for the action
+        #
+        # Return Values: None
+        ##########################
+        # The counter keeps actions with the same time in the order they were added
+        heapq.heappush(self.queue, (eventTime, self.count, action, args))
+        self.count = self.count + 1
+
+    def run(self):
+        ######## run ########
+        # Function: Run queued actions at their times until the queue is empty.
+        #           Actions may add more actions to the queue while it runs.
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        while self.queue:
+            eventTime, count, action, args = heapq.heappop(self.queue)
+            self.current = eventTime
+            waitForTime(eventTime, self.showClock)
+            action(*args)
+        self.current = None
+
+    def nextTime(self):
+        # When the scheduler next needs the CPU, for other threads: the time of the action being
+        # waited for or run, or of the next one queued if that is sooner. None if there is nothing to do
+        nextTime = self.current
+        try:
+            queued = self.queue[0][0]
+        except IndexError:
+            queued = None
+        if nextTime is None or (queued is not None and queued < nextTime):
+            return queued
+        return nextTime
+
+    def clear(self):
+        self.queue = []
@@ -0,0 +1,222 @@
+import RPi.GPIO as gpio
+import time
+import numpy
+from datetime import datetime
+from motionPlanner import bresenhamMask
+
+MAX_FREQ = 9600
+
+# Number of position updates sent to the motors per second while tracking
+TRACK_RATE = 20
+
+# Largest change in step rate allowed between updates (steps/s^2), so the motors don't stall
+TRACK_MAX_ACCEL = 20000
+
+# WGS84 ellipsoid
+EARTH_RADIUS = 6378.137
+EARTH_FLATTENING = 1/298.257223563
+
+
+def loadTLEs(filename):
+    ######## loadTLEs ########
+    # Function: Read a file of two-line element sets. Name lines are optional
+    #
+    # Inputs:
+    # - filename: path of the TLE file
+    #
+    # Return Values:
+    # - tles: dictionary of catalog number (str) to (line1, line2). Empty if the file can't be read
+    ##########################
+    tles = {}
+    try:
+        with open(filename, 'r') as tleFile:
+            lines = [line.rstrip() for line in tleFile if line.strip() != ""]
+    except OSError:
+        print("Error: Could not read TLE file", filename)
+        return tles
+    for i in range(len(lines) - 1):
+        if lines[i].startswith("1 ") and lines[i + 1].startswith("2 "):
+            catalogNumber = lines[i][2:7].strip().lstrip("0")
+            tles[catalogNumber] = (lines[i], lines[i + 1])
+    return tles
+
+
+def epochOffset():
+    ######## epochOffset ########
+    # Function: Find the difference between schedule timestamps and true Unix time.
+    #           Schedule and wall clock timestamps treat UTC times as local time
+    #
+    # Inputs: None
+    #
+    # Return Values:
+    # - offset: seconds to subtract from a schedule timestamp to get Unix time
+    ##########################
+    return round(datetime.utcnow().timestamp() - time.time())
+
+
+def propagate(tle, times, latitude, longitude, altitude):
+    ######## propagate ########
+    # Function: Find where a satellite appears in the sky from the station at each time
+    #
+    # Inputs:
+    # - tle: (line1, line2) of the satellite's TLE
+    # - times: numpy array of schedule timestamps
+    # - latitude: station geodetic latitude in degrees
+    # - longitude: station longitude in degrees (east positive)
+    # - altitude: station height above the ellipsoid in metres
+    #
+    # Return Values:
+    # - azimuth: numpy array of azimuth angles in degrees
+    # - elevation: numpy array of elevation angles in degrees
+    ##########################
+    from sgp4.api import Satrec
+
+    satellite = Satrec.twoline2rv(tle[0], tle[1])
+    unixTimes = numpy.asarray(times, dtype=float) - epochOffset()
+    days = unixTimes/86400
+    jd = numpy.floor(days) + 2440587.5
+    fr = days - numpy.floor(days)
+    errors, positions, velocities = satellite.sgp4_array(jd, fr)
+
+    # TEME to Earth fixed, rotating by Greenwich mean sidereal time
+    t = (jd - 2451545.0 + fr)/36525
+    gmstSeconds = 67310.54841 + (876600*3600 + 8640184.812866)*t + 0.093104*t**2 - 6.2e-6*t**3
+    gmst = numpy.radians((gmstSeconds % 86400)/240)
+    x = numpy.cos(gmst)*positions[:, 0] + numpy.sin(gmst)*positions[:, 1]
+    y = -numpy.sin(gmst)*positions[:, 0] + numpy.cos(gmst)*positions[:, 1]
+    z = positions[:, 2]
+
+    # Station position, Earth fixed
+    lat = numpy.radians(latitude)
+    lon = numpy.radians(longitude)
+    e2 = EARTH_FLATTENING*(2 - EARTH_FLATTENING)
+    N = EARTH_RADIUS/numpy.sqrt(1 - e2*numpy.sin(lat)**2)
+    h = altitude/1000
+    dx = x - (N + h)*numpy.cos(lat)*numpy.cos(lon)
+    dy = y - (N + h)*numpy.cos(lat)*numpy.sin(lon)
+    dz = z - (N*(1 - e2) + h)*numpy.sin(lat)
+
+    # Look angles from the local east, north, up frame
+    east = -numpy.sin(lon)*dx + numpy.cos(lon)*dy
+    north = -numpy.sin(lat)*numpy.cos(lon)*dx - numpy.sin(lat)*numpy.sin(lon)*dy + numpy.cos(lat)*dz
+    up = numpy.cos(lat)*numpy.cos(lon)*dx + numpy.cos(lat)*numpy.sin(lon)*dy + numpy.sin(lat)*dz
+    azimuth = numpy.degrees(numpy.arctan2(east, north)) % 360
+    elevation = numpy.degrees(numpy.arcsin(up/numpy.sqrt(east**2 + north**2 + up**2)))
+    elevation[errors != 0] = numpy.nan
+    return azimuth, elevation
+
+
+class PassTracker:
+    # Follows a pre-computed track of motor positions, sending a burst of evenly spaced steps to both
+    # axes every 1/TRACK_RATE seconds. Run it in its own thread while the main thread takes images
+
+    def __init__(self, axes, trackTimes, trackSteps, degPerStep):
+        ######## PassTracker ########
+        # Inputs:
+        # - axes: list of motor objects. They must share the same pulse backend
+        # - trackTimes: numpy array of schedule timestamps, 1/TRACK_RATE seconds apart
+        # - trackSteps: list of numpy arrays, the position of each axis at each time, in steps
+        # - degPerStep: list of mount degrees per step for each axis, used to report the error
+        ##########################
+        self.axes = axes
+        self.trackTimes = trackTimes
+        self.trackSteps = trackSteps
+        self.degPerStep = degPerStep
+        self.stop = False
+        self.errors = [numpy.zeros(0) for axis in axes]
+        self.aborted = False
+
+    def run(self):
+        ######## run ########
+        # Function: Track the pass until the end of the track, or until stop is set
+        #
+        # Inputs: None
+        #
+        # Return Values: None. Tracking error is stored in self.errors (in mount degrees)
+        ##########################
+        tickTime = 1/TRACK_RATE
+        maxStepsPerTick = int(MAX_FREQ*tickTime)
+        maxChange = max(1, int(TRACK_MAX_ACCEL*tickTime*tickTime))
+        updates = len(self.trackTimes) - 1
+        errors = numpy.zeros((len(self.axes), updates))
+        velocity = [0] * len(self.axes)
+        backend = self.axes[0].backend
+        switchPins = []
+        for axis in self.axes:
+            switchPins.append(axis.switch1)
+            switchPins.append(axis.switch2)
+
+        # Time the updates on the monotonic clock from the first point of the track
+        startDeadline = time.monotonic() + (self.trackTimes[0] - datetime.utcnow().timestamp())
+        while time.monotonic() < startDeadline and not self.stop:
+            time.sleep(min(0.01, max(startDeadline - time.monotonic(), 0)))
+        for axis in self.axes:
+            gpio.output(axis.enable, gpio.LOW)
+
+        done = 0
+        for k in range(updates):
+            if self.stop:
+                break
+            deadline = startDeadline + (k + 1)*tickTime
+
+            # Steps needed to be at the next point of the track when this update ends,
+            # limited by the step rate and the acceleration of each motor
+            moves = []
+            for i, axis in enumerate(self.axes):
+                wanted = int(round(self.trackSteps[i][k + 1] - axis.position))
+                wanted = max(velocity[i] - maxChange, min(velocity[i] + maxChange, wanted))
+                wanted = max(-maxStepsPerTick, min(maxStepsPerTick, wanted))
+                velocity[i] = wanted
+                moves.append(wanted)
+                if wanted < 0:
+                    gpio.output(axis.direction, gpio.LOW)
+                else:
+                    gpio.output(axis.direction, gpio.HIGH)
+
+            # Spread the steps evenly over the time left until the deadline
+            ticks = max(abs(move) for move in moves)
+            if ticks > 0:
+                remaining = max(deadline - time.monotonic(), ticks/MAX_FREQ)
+                delay = numpy.full(ticks, remaining/(2*ticks))
+                masks = [bresenhamMask(abs(move), ticks) for move in moves]
+                ticksSent, switchPin, elapsed = backend.play([axis.step for axis in self.axes], delay, masks, switchPins, True)
+                for axis, move, mask in zip(self.axes, moves, masks):
+                    stepsSent = int(numpy.count_nonzero(mask[:ticksSent]))
+                    if move < 0:
+                        axis.position = axis.position - stepsSent
+                    else:
+                        axis.position = axis.position + stepsSent
+                if switchPin is not None:
+                    print("Switch Pressed! Tracking stopped.")
+                    self.aborted = True
+                    break
+
+            for i, axis in enumerate(self.axes):
+                errors[i, k] = (self.trackSteps[i][k + 1] - axis.position)*self.degPerStep[i]
+            done = k + 1
+
+            # Wait out the rest of the update
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+
+        for axis in self.axes:
+            gpio.output(axis.enable, gpio.HIGH)
+        self.errors = [errors[i, :done] for i in range(len(self.axes))]
+
+    def report(self):
+        ######## report ########
+        # Function: Summarise the tracking error of the pass
+        #
+        # Inputs: None
+        #
+        # Return Values:
+        # - summary: list of (rms, max) error in mount degrees for each axis
+        ##########################
+        summary = []
+        for error in self.errors:
+            if len(error) == 0:
+                summary.append((0.0, 0.0))
+            else:
+                summary.append((float(numpy.sqrt(numpy.mean(error**2))), float(numpy.max(numpy.abs(error)))))
+        return summary
@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Record of the files copied, kept in the top folder of the drive. A different drive has its own record
+MANIFEST_NAME = ".os3sync.json"
+
+# Files are copied in blocks of this many bytes. The copy can stop between any two blocks
+BLOCK_SIZE = 256*1024
+
+# The record is saved at least this often while files are copied, and at the end of each pass
+MANIFEST_SAVE_INTERVAL = 10.0
+
+def fileDigest(path, length=None, uncached=False):
+    ######## fileDigest ########
+    # Function: SHA-256 of the start of a file
+    #
+    # Inputs:
+    # - path: file to read
+    # - length: optional. Bytes to read. The whole file if None
+    # - uncached: optional. Read from the drive rather than from memory, so a copy is really checked
+    #
+    # Return Values:
+    # - digest: hashlib object, which can be carried on with the rest of the file
+    ##########################
+    digest = hashlib.sha256()
+    with open(path, "rb") as inputFile:
+        if uncached and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(inputFile.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        remaining = length
+        while remaining is None or remaining > 0:
+            block = inputFile.read(BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining = remaining - len(block)
+    return digest
+
+
+def fileSize(path):
+    # Size of a file, or None if it doesn't exist
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def spareName(path):
+    # First of path.1, path.2, ... that doesn't exist
+    number = 1
+    while os.path.lexists(path + "." + str(number)):
+        number = number + 1
+    return path + "." + str(number)
+
+
+class UsbSync:
+    # Copies new and changed files to a USB drive from a background thread. Files are only copied
+    # while isIdle() says nothing time critical is coming up, at a limited rate, and the copy stops
+    # between blocks as soon as that changes. A copy cut short is carried on from where it stopped,
+    # and a log file that has grown only has the new lines added. Each copy is read back and checked
+    # before it replaces the old one. The record of what has been copied is kept on the drive, so a
+    # drive that is pulled out and plugged back in (or swapped) is picked up where it left off
+
+    def __init__(self, destination, listFiles, isIdle, rate, interval, mountCheck=True):
+        ######## UsbSync ########
+        # Inputs:
+        # - destination: folder the drive is mounted at
+        # - listFiles: function returning (path, name on the drive) for every file to copy
+        # - isIdle: function returning False while copying would get in the way of the capture path
+        # - rate: most bytes per second written to the drive
+        # - interval: seconds between passes over the files
+        # - mountCheck: optional. Only copy while a drive is mounted at destination. If False any
+        #               existing folder will do (for testing)
+        ##########################
+        self.destination = destination
+        self.listFiles = listFiles
+        self.isIdle = isIdle
+        self.rate = rate
+        self.interval = interval
+        self.mountCheck = mountCheck
+        self.copiedFiles = 0
+        self.copiedBytes = 0
+        self.pendingFiles = 0
+        self.errors = 0
+        self.available = None
+        # Size and time stamp of each changed file at the last pass
+        self.seen = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+
+    def start(self):
+        ######## start ########
+        # Function: Start copying in the background
+        #
+        # Inputs: None
+        #
+        # Return Values: None
+        ##########################
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+        ######## close ########
+        # Function: Stop the background thread and copy everything still waiting, at full speed
+        #
+        # Inputs: None
+        #
+        # Return Values:
+        # - complete: False if some files couldn't be copied
+        ##########################
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.syncAll(lambda: True, None, False)
+
+
+    def worker(self):
+        # Waits on an event rather than polling, so close() stops it at once
+        while not self.stopping.is_set():
+            if self.isIdle():
+                self.syncAll(lambda: not self.stopping.is_set() and self.isIdle(), self.rate)
+            self.stopping.wait(self.interval)
+
+
+    def driveReady(self):
+        # True if there is a drive to copy to. Changes are printed once
+        if self.mountCheck:
+            ready = os.path.ismount(self.destination)
+        else:
+            ready = os.path.isdir(self.destination)
+        if ready != self.available:
+            if not ready:
+                print("Warning: No USB drive at", self.destination + ". Files will be copied when one is plugged in.")
+            elif self.available is not None:
+                print("USB drive found. Copying files.")
+            self.available = ready
+        return ready
+
+
+    def syncAll(self, canCopy, rate, settle=True):
+        ######## syncAll ########
+        # Function: Copy every new or changed file to the drive
+        #
+        # Inputs:
+        # - canCopy: function checked between blocks. Copying stops when it returns False
+        # - rate: most bytes per second written to the drive, or None for no limit
+        # - settle: optional. Leave files that changed since the last pass (e.g. an image still
+        #           being downloaded) until they stop changing. The system clock isn't used for
+        #           this, as it can jump when the GPS time is picked up
+        #
+        # Return Values:
+        # - complete: True if every file is on the drive
+        ##########################
+        if not self.driveReady():
+            return False
+        manifest = self.loadManifest()
+        files = self.listFiles()
+        done = 0
+        lastSave = time.monotonic()
+        changed = False
+        for source, name in files:
+            if not canCopy():
+                break
+            try:
+                copied = self.syncFile(source, name, manifest, canCopy, rate, settle)
+            except OSError as error:
+                print("Error: Could not copy", name, "to USB drive (" + str(error) + ")")
+                self.errors = self.errors + 1
+                # Most likely the drive was pulled out. Anything cut short is carried on next time
+                if not self.driveReady():
+                    break
+                continue
+            if copied is None:
+                continue
+            done = done + 1
+            changed = changed or copied
+            if changed and time.monotonic() - lastSave >= MANIFEST_SAVE_INTERVAL:
+                changed = not self.saveManifest(manifest)
+                lastSave = time.monotonic()
+        if changed:
+            self.saveManifest(manifest)
+        self.pendingFiles = len(files) - done
+        return self.pendingFiles == 0
+
+
+    def syncFile(self, source, name, manifest, canCopy, rate, settle=False):
+        ######## syncFile ########
+        # Function: Copy one file to the drive, unless the drive already has it
+        #
+        # Inputs:
+        # - source: file to copy
+        # - name: path of the copy, relative to the top of the drive
+        # - manifest: record of the files on the drive. Updated if the file is copied
+        # - canCopy: function checked between blocks
+        # - rate: most bytes per second written, or None for no limit
+        # - settle: optional. Leave the file for a later pass if it changed since the last one
+        #
+        # Return Values:
+        # - copied: False if the drive already had the file, True if it was copied or its record
+        #           updated, or None if it is left for a later pass
+        # Raises OSError if a file can't be read or written
+        ##########################
+        status = os.stat(source)
+        size = status.st_size
+        target = os.path.join(self.destination, name)
+        entry = manifest.get(name)
+        # Size and time stamp unchanged since the last copy
+        if entry is not None and entry["size"] == size and entry["mtime"] == status.st_mtime and fileSize(target) == size:
+            return False
+        if settle and self.seen.get(source) != (size, status.st_mtime):
+            self.seen[source] = (size, status.st_mtime)
+            return None
+
+        # Find how much of the file is already on the drive: a copy that was cut short, or the last
+        # copy of a file that has grown since. Checksums show whether the bytes there still match
+        part = target + ".part"
+        start = 0
+        digest = hashlib.sha256()
+        partSize = fileSize(part)
+        targetSize = fileSize(target)
+        recorded = entry is not None and entry["size"] == targetSize
+        prefix = None
+        if targetSize is not None and not recorded:
+            # No record of this copy. It is the start of the source if the drive was pulled out
+            # before the record was saved. Anything else wasn't written by this station (e.g. it is
+            # from an earlier install or another station), so it is moved aside, not overwritten
+            if targetSize <= size:
+                prefix = fileDigest(source, targetSize)
+            if prefix is None or prefix.hexdigest() != fileDigest(target, uncached=True).hexdigest():
+                spare = spareName(target)
+                os.rename(target, spare)
+                print("Warning:", name, "on USB drive wasn't copied by this station. Moved to", os.path.basename(spare))
+                targetSize = None
+        if partSize is not None:
+            if partSize <= size:
+                prefix = fileDigest(source, partSize)
+                if prefix.hexdigest() == fileDigest(part, uncached=True).hexdigest():
+                    start = partSize
+                    digest = prefix
+        elif targetSize is not None and targetSize <= size:
+            if recorded:
+                prefix = fileDigest(source, targetSize)
+                matches = prefix.hexdigest() == entry["sha256"]
+            else:
+                # Checked against the source above
+                matches = True
+            if matches and targetSize == size:
+                # Same contents, only the time stamp changed
+                manifest[name] = {"size": size, "mtime": status.st_mtime, "sha256": prefix.hexdigest()}
+                return True
+            if matches:
+                # Carry on from a copy of it, so the old copy stays in place until the new one is
+                # complete. This is copied on the drive, and only the new bytes come from the source
+                shutil.copyfile(target, part)
+                start = targetSize
+                digest = prefix
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(source, "rb") as inputFile, open(part, "ab" if start > 0 else "wb") as outputFile:
+            inputFile.seek(start)
+            copied = start
+            written = 0
+            copyStart = time.monotonic()
+            while copied < size:
+                if not canCopy():
+                    return None
+                block = inputFile.read(min(BLOCK_SIZE, size - copied))
+                if not block:
+                    # The file got shorter while it was copied. Copy it again next time
+                    return None
+                outputFile.write(block)
+                digest.update(block)
+                copied = copied + len(block)
+                written = written + len(block)
+                if rate is not None:
+                    wait = written/rate - (time.monotonic() - copyStart)
+                    if wait > 0:
+                        time.sleep(wait)
+            outputFile.flush()
+            os.fsync(outputFile.fileno())
+
+        if fileDigest(part, uncached=True).hexdigest() != digest.hexdigest():
+            print("Error: Copy of", name, "on USB drive is corrupt. It will be copied again.")
+            self.errors = self.errors + 1
+            os.remove(part)
+            return None
+        os.replace(part, target)
+        manifest[name] = {"size": size, "mtime": status.st_mtime, "sha256": digest.hexdigest()}
+        self.copiedFiles = self.copiedFiles + 1
+        self.copiedBytes = self.copiedBytes + written
+        return True
+
+
+    def loadManifest(self):
+        # Read the record of copied files from the drive. Files with no record are checked against the drive
+        path = os.path.join(self.destination, MANIFEST_NAME)
+        try:
+            with open(path, "r") as manifestFile:
+                return json.load(manifestFile)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            print("Warning: Could not read USB copy record (" + str(error) + ")")
+            return {}
+
+
+    def saveManifest(self, manifest):
+        # Write the record through a temporary file, so a drive pulled out half way keeps the old one
+        path = os.path.join(self.destination, MANIFEST_NAME)
+        tempName = path + ".tmp"
+        try:
+            with open(tempName, "w") as manifestFile:
+                json.dump(manifest, manifestFile)
+                manifestFile.flush()
+                os.fsync(manifestFile.fileno())
+            os.replace(tempName, path)
+        except OSError as error:
+            print("Warning: Could not save USB copy record (" + str(error) + ")")
+            return False
+        return True